@@ -1,43 +1,284 @@
+from backends import with_model
 from command_data import CommandData, CommandSession, SessionManager
-from ollamaapi import query_ollama
-from typing import Callable, Generator
+from embedding_index import EmbeddingIndex, RelatedCommand, related_commands
+from model_router import ModelRouter, RouteDecision
+from ollamaapi import Chunk, query_ollama, DEFAULT_MODEL
+from typing import AsyncGenerator, Callable, Generator, Any, Iterator
 from pathlib import Path
 from abbreviation import abbreviation
-from prompts import command_session_to_prompt
+from prompts import build_prompt, command_to_incremental_prompt, estimate_tokens, render_command
+from response_cache import ResponseCache
+from timings import Timings
+
+Prompt = str | list[dict[str, str]]
 
 
 class Assistant:
     initial_message: str
     session: CommandSession
     session_manager: SessionManager
-    ai_api: Callable[[str], Generator[str | list[int], None, None]]
+    ai_api: Callable[..., Generator[Chunk, None, None]]
+    model: str
+    incremental: bool
+    token_budget: int | None
+    cache: ResponseCache | None
+    timings: Timings
+    embeddings: EmbeddingIndex | None
+    related: int
+    router: ModelRouter | None
+    # How the router picked the model of the newest command
+    route: RouteDecision | None
+    _chunks: list[str]
 
-    def __init__(self, session_manager: SessionManager, session_id: int | None = None, 
-                 verbose: bool = False, ai_api: Callable[[str], Generator[str | list[int], None, None]] = query_ollama):
+    def __init__(self, session_manager: SessionManager, session_id: int | None = None,
+                 verbose: bool = False, ai_api: Callable[..., Generator[Chunk, None, None]] = query_ollama,
+                 model: str = DEFAULT_MODEL, incremental: bool = False, token_budget: int | None = None,
+                 cache: ResponseCache | None = None, timings: Timings | None = None,
+                 embeddings: EmbeddingIndex | None = None, related: int = 0, router: ModelRouter | None = None):
+        """With embeddings, the prompt includes up to related earlier commands of any session that are most like
+        the new one. With router, it picks the model for each command, and ai_api is copied to use it."""
+        self.router = router
+        self.route = None
         self.verbose = verbose
+        self.embeddings = embeddings
+        self.related = related
+        self.timings = timings if timings is not None else Timings()
+        self.cache = cache
+        self._chunks = []
+        self.token_budget = token_budget
         self.ai_api = ai_api
+        self.model = model
+        self.incremental = incremental
         self.session_manager = session_manager
         self.initial_message = ""
-        if session_id is None:
-            s = self.session_manager.load_most_recent_session()
-        else:
-            s = self.session_manager.load(session_id)
-            # Passing a session id indicates that the user switched sessions. 
-            # They should therefore see the last message from that session.
-            if s.commands:
-                self.initial_message = s.commands[-1].ai_response  # TODO: Truncate this and make it prettier.
+        with self.timings.span("session load"):
+            if session_id is None:
+                s = self.session_manager.load_most_recent_session()
+            else:
+                s = self.session_manager.load(session_id)
+                # Passing a session id indicates that the user switched sessions.
+                # They should therefore see the last message from that session.
+                if s.commands:
+                    self.initial_message = s.commands[-1].ai_response  # TODO: Truncate this and make it prettier.
         self.session = s
 
-    def new_command(self, command: CommandData, give_ai_response: bool = True) -> Generator[str, None, None]:
+    def can_reuse_context(self) -> bool:
+        """The stored context can replace the transcript if it was made by this model and covers every earlier command."""
+        return (self.incremental and getattr(self.ai_api, "supports_context", True)
+                and bool(self.session.context) and self.session.context_model == self.model
+                and self.session.context_commands == len(self.session.commands) - 1)
+
+    def prepare(self) -> None:
+        """Loads and renders the earlier commands of the session, so that it can be done while stdin is still read."""
+        build_prompt(self.session, self.token_budget).text
+
+    def _budget(self) -> int | None:
+        """The token budget of the prompt, which is less if the model takes shorter prompts."""
+        limit = self.route.max_prompt_tokens if self.route is not None else None
+        return min(self.token_budget, limit) if self.token_budget and limit else self.token_budget or limit
+
+    def _route(self) -> Iterator[str]:
+        """Lets the router pick the model for the newest command, and yields the decision for verbose mode."""
+        if self.router is None:
+            return iter(())
+        session = self.session
+        reusable = self.incremental and bool(session.context) and session.context_commands == len(session.commands) - 1
+        with self.timings.span("route"):
+            self.route = self.router.route(session, self.token_budget, session.context_model if reusable else None)
+        if self.route.model != self.model:
+            self.ai_api = with_model(self.ai_api, self.route.model)
+            self.model = self.route.model
+        self.timings.info["model"] = self.model
+        return iter([f"{self.route.report()}\n"] if self.verbose else [])
+
+    def _observe(self) -> None:
+        """Tells the router how fast the model answered."""
+        first_token = self.timings.first_token()
+        if self.router is not None and first_token is not None:
+            self.router.observe(self.model, first_token, self.timings.tokens_per_second())
+
+    def _receive(self, command: CommandData, chunk: Chunk) -> str | None:
+        """Stores a chunk from ai_api, and returns it if it is text for the user."""
+        if isinstance(chunk, dict):
+            self.timings.server.update(chunk)
+            return None
+        if isinstance(chunk, list):
+            self.session.context = chunk
+            self.session.context_model = self.model
+            self.session.context_commands = len(self.session.commands)
+            return None
+        self.timings.chunk_received()
+        # Joined once the answer is complete, instead of building a longer string with every chunk
+        self._chunks.append(chunk)
+        return chunk
+
+    def _lookup(self, command: CommandData) -> tuple[str | None, list[str] | None]:
+        """The cache key of the command, and the cached answer if there is one. The answer depends on the earlier
+        commands in the prompt, like for a follow-up question, so the key covers them too."""
+        if self.cache is None:
+            return None, None
+        history = build_prompt(self.session, self._budget()).commands[:-1]
+        key = self.cache.key(self.model, command, history)
+        return key, self.cache.get(key)
+
+    def _attempts(self, command: CommandData,
+                  give_ai_response: bool) -> Iterator[tuple[str, Prompt | None, dict[str, Any]]]:
+        """The requests to try in turn: continuing from the stored context, then sending the whole session.
+        Each is a note for verbose mode, the prompt (None if no answer is wanted) and more arguments for ai_api."""
+        prompt = command_to_incremental_prompt(command)
+        budget = self._budget()
+        fits_budget = not budget or len(self.session.context) + estimate_tokens(prompt) <= budget
+        if give_ai_response and self.can_reuse_context() and fits_budget:
+            yield (f"Prompt to {abbreviation} (continuing from {len(self.session.context)} context tokens):\n{prompt}\n",
+                   prompt, {"context": self.session.context})
+            # The server rejected the context. Fall back to sending the whole session.
+            self.session.context = []
+
+        related: list[RelatedCommand] = []
+        if self.embeddings is not None and self.related and give_ai_response:
+            with self.timings.span("related"):
+                try:
+                    # More than needed, because those in the prompt anyway are left out.
+                    related = related_commands(self.session_manager, self.embeddings, command, 2 * self.related)
+                except (ImportError, ValueError, KeyError, OSError):
+                    pass  # Answer without them
+        with self.timings.span("prompt"):
+            build = build_prompt(self.session, budget, related, self.related)
+            full_prompt: Prompt = build.messages() if getattr(self.ai_api, "uses_messages", False) else build.text
+        self.timings.info.update(prompt_tokens=build.tokens, prompt_commands=build.kept)
+        if build.related:
+            self.timings.info["related_commands"] = len(build.related)
+        if isinstance(full_prompt, list):
+            shown = "\n".join(f"[{message['role']}]\n{message['content']}" for message in full_prompt)
+            note = f"Messages to {abbreviation}:\n{shown}\n{build.report()}\n"
+        else:
+            note = f"Prompt to {abbreviation}:\n{full_prompt}\n{build.report()}\n"
+        yield note, full_prompt if give_ai_response else None, {}
+
+    def _start(self, command: CommandData,
+               give_ai_response: bool) -> tuple[list[str], str | None, list[str] | None]:
+        """Adds command to the session and picks its model. Returns the notes for verbose mode, the cache key of
+        the command and its cached answer, if there is one."""
         self.session.commands.append(command)
-        prompt = command_session_to_prompt(self.session)
-        if self.verbose:
-                yield f"Prompt to {abbreviation}:\n{prompt}\n"
-        if give_ai_response:
-            for chunk in self.ai_api(prompt):
-                if isinstance(chunk, list):
-                    self.session.context = chunk
-                else:
-                    command.ai_response += chunk
-                    yield chunk
-        self.session.save()
+        self._chunks = []
+        if not give_ai_response:
+            return [], None, None
+        notes = list(self._route())
+        key, cached = self._lookup(command)
+        if cached is not None:
+            self.timings.info["cached"] = True
+            if self.verbose:
+                notes.append("Answer from the response cache.\n")
+        return notes, key, cached
+
+    def _replay(self, command: CommandData, cached: list[str]) -> Iterator[str]:
+        for cached_text in ResponseCache.replay(cached):
+            self._receive(command, cached_text)
+            yield cached_text
+
+    def _answered(self) -> None:
+        self.timings.request_finished()
+        self._observe()
+
+    def _can_retry(self, error: IOError, kwargs: dict[str, Any]) -> bool:
+        """Whether the next attempt can follow one that failed: if the server rejected the stored context
+        before answering anything, the whole session is sent instead."""
+        return not self._chunks and "context" in kwargs and not isinstance(error, TimeoutError)
+
+    def new_command(self, command: CommandData, give_ai_response: bool = True) -> Generator[str, None, None]:
+        notes, key, cached = self._start(command, give_ai_response)
+        yield from notes
+        try:
+            if cached is not None:
+                yield from self._replay(command, cached)
+            else:
+                for note, prompt, kwargs in self._attempts(command, give_ai_response):
+                    if self.verbose:
+                        yield note
+                    if prompt is None:
+                        break
+                    self.timings.request_started()
+                    try:
+                        for chunk in self.ai_api(prompt, **kwargs):
+                            if (text := self._receive(command, chunk)) is not None:
+                                yield text
+                        self._answered()
+                        break
+                    except IOError as e:
+                        if not self._can_retry(e, kwargs):
+                            raise
+        except BaseException:
+            # Ctrl+C, or a lost connection. Keep what was answered so far.
+            self._finish(command, key, interrupted=True)
+            raise
+        yield from self._finish(command, key, interrupted=False)
+
+    async def anew_command(self, command: CommandData, give_ai_response: bool = True,
+                           deadline: float | None = None) -> AsyncGenerator[str, None]:
+        """Like new_command, streaming from the astream method of ai_api if it has one. Cancelling the task closes
+        the connection to the model server. Stops with TimeoutError if the answer is not complete after deadline
+        seconds. Either way, the partial answer is saved as interrupted."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        deadline_at = None if deadline is None else loop.time() + deadline
+        notes, key, cached = self._start(command, give_ai_response)
+        for note in notes:
+            yield note
+        try:
+            if cached is not None:
+                for cached_text in self._replay(command, cached):
+                    yield cached_text
+            else:
+                for note, prompt, kwargs in self._attempts(command, give_ai_response):
+                    if self.verbose:
+                        yield note
+                    if prompt is None:
+                        break
+                    self.timings.request_started()
+                    stream = self._astream(prompt, **kwargs)
+                    try:
+                        while True:
+                            remaining = None if deadline_at is None else deadline_at - loop.time()
+                            try:
+                                received: Chunk = await asyncio.wait_for(anext(stream), remaining)
+                            except StopAsyncIteration:
+                                break
+                            if (text := self._receive(command, received)) is not None:
+                                yield text
+                        self._answered()
+                        break
+                    except IOError as e:
+                        if not self._can_retry(e, kwargs):
+                            raise
+                    finally:
+                        await stream.aclose()
+        except BaseException:
+            self._finish(command, key, interrupted=True)
+            raise
+        for text in self._finish(command, key, interrupted=False):
+            yield text
+
+    def _astream(self, prompt: Prompt, **kwargs: Any) -> AsyncGenerator[Chunk, None]:
+        import async_api
+        astream = getattr(self.ai_api, "astream", None)
+        if astream is not None:
+            stream: AsyncGenerator[Chunk, None] = astream(prompt, **kwargs)
+            return stream
+        return async_api.iterate_in_thread(self.ai_api(prompt, **kwargs))
+
+    def _finish(self, command: CommandData, key: str | None, interrupted: bool) -> Iterator[str]:
+        command.ai_response += "".join(self._chunks)
+        command.interrupted = interrupted
+        if command.ai_response:
+            command.model = self.model
+        self._save(command)
+        if key is None or self.cache is None:
+            return iter(())
+        if self._chunks and not interrupted:
+            self.cache.put(key, self.model, self._chunks)
+        return iter([f"\n{self.cache.stats().report()}\n"] if self.verbose else [])
+
+    def _save(self, command: CommandData) -> None:
+        with self.timings.span("save"):
+            render_command(command)  # Stores the token count of the answered command with the session
+            self.session.save()
@@ -0,0 +1,39 @@
+import asyncio
+from typing import AsyncGenerator, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+async def iterate_in_thread(iterator: Iterator[T],
+                            cancel: Callable[[], None] | None = None) -> AsyncGenerator[T, None]:
+    """Runs a blocking iterator, like the generator of a synchronous ai_api, without blocking the event loop.
+    The streams of the backends run this way too, so that they use the pooled connections of ollamaapi.
+    Closing this generator, also by cancelling its task, closes the iterator, which closes the connection and
+    tells the server to stop generating. If a chunk is being read then, cancel is called to stop the read,
+    like Cancellation.cancel of the request, and the iterator is closed once it stopped. Without cancel,
+    that waits for the chunk."""
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Future[object] | None = None
+    try:
+        while True:
+            pending = loop.run_in_executor(None, next, iterator, _DONE)
+            # Shielded, so that a cancelled read still finishes in its thread, and the iterator is closed after it.
+            item = await asyncio.shield(pending)
+            if item is _DONE:
+                return
+            yield item  # type: ignore[misc]
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            if pending is None or pending.done():
+                close()
+            else:
+                if cancel is not None:
+                    cancel()
+
+                def closing(read: asyncio.Future[object]) -> None:
+                    read.exception()  # Nobody waits for the chunk any more, nor for an error reading it.
+                    close()
+                pending.add_done_callback(closing)
@@ -0,0 +1,231 @@
+import copy
+import functools
+from abc import ABC, abstractmethod
+from typing import Any, AsyncGenerator, Generator, Sequence
+from endpoint_pool import EndpointPool
+from ollamaapi import (DEFAULT_MODEL, DEFAULT_TIMEOUT, Cancellation, Cancelled, Chunk, iter_json_lines, loads,
+                       post_stream, server_stats)
+
+
+Message = dict[str, str]
+
+
+class ModelBackend(ABC):
+    """A model server that streams answers as text chunks. Backends that support it yield the new context
+    (a list of tokens) last. Assistant calls a backend like a plain ai_api function, or its astream method
+    from async code."""
+    name = ""
+    default_endpoint = ""
+    default_model = DEFAULT_MODEL
+    # Whether the backend can continue from the context of a previous answer
+    supports_context = False
+    # Whether the backend takes a list of chat messages instead of a single prompt
+    uses_messages = False
+    # The path of the API, and the prefix of the lines of its response stream, like b"data: " for server-sent events
+    path = ""
+    prefix = b""
+    # A path that answers GET requests when the server is running
+    health_path = "/"
+    model: str
+    # The first of the endpoints
+    endpoint: str
+    pool: EndpointPool
+    options: dict[str, Any]
+    timeout: tuple[float, float]
+    # How long the server keeps the model loaded after a request, like "30m" or seconds, for servers that unload it
+    keep_alive: str | float | None
+
+    def __init__(self, model: str | None = None, endpoint: str | Sequence[str] | None = None,
+                 options: dict[str, Any] | None = None, timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+                 keep_alive: str | float | None = None):
+        """endpoint can be several endpoints serving the same model, which share the requests."""
+        self.keep_alive = keep_alive
+        self.model = model or self.default_model
+        endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint or [self.default_endpoint])
+        self.pool = EndpointPool.shared([url.rstrip("/") for url in endpoints], self.health_path)
+        self.endpoint = self.pool.endpoints[0].url
+        self.options = options or {}
+        self.timeout = timeout
+
+    @abstractmethod
+    def request(self, prompt: str | list[Message], context: list[int] | None) -> dict[str, Any]:
+        """The JSON body of a request for an answer to prompt, continuing from context if the backend supports it."""
+
+    @abstractmethod
+    def warm_request(self, system_prompt: str) -> dict[str, Any]:
+        """A request that makes the server load the model and read the start of every prompt, answering a single
+        token. Servers that keep the state of the last prompt skip that start when it comes again."""
+
+    @abstractmethod
+    def parse(self, line: bytes) -> tuple[list[Chunk], bool]:
+        """The chunks in a line of the response stream, and whether it was the last line."""
+
+    def __call__(self, prompt: str | list[Message],
+                 context: list[int] | None = None) -> Generator[Chunk, None, None]:
+        return self._stream(self.request(prompt, context))
+
+    def warm(self, system_prompt: str) -> dict[str, int]:
+        """Sends the warm_request, and returns the statistics of the server, like the time it took to load the model."""
+        stats: dict[str, int] = {}
+        for chunk in self._stream(self.warm_request(system_prompt)):
+            if isinstance(chunk, dict):
+                stats.update(chunk)
+        return stats
+
+    def _stream(self, data: dict[str, Any],
+                cancellation: Cancellation | None = None) -> Generator[Chunk, None, None]:
+        """Streams the answer from the first endpoint of the pool that sends a chunk."""
+        def stream(endpoint: str) -> Generator[list[Chunk], None, None]:
+            try:
+                with post_stream(f"{endpoint}{self.path}", data, self.timeout, cancellation) as response:
+                    for line in iter_json_lines(response, self.prefix):
+                        chunks, done = self.parse(line)
+                        if chunks:
+                            yield chunks
+                        if done:
+                            break
+            except OSError as e:
+                if cancellation is not None and cancellation.cancelled:
+                    raise Cancelled("The request was cancelled.") from e
+                raise
+
+        for chunks in self.pool.stream(stream):
+            yield from chunks
+
+    def astream(self, prompt: str | list[Message],
+                context: list[int] | None = None) -> AsyncGenerator[Chunk, None]:
+        """Like calling the backend, from async code. The stream runs in a thread, on the pooled connections.
+        Closing it, also by cancelling its task, stops the request at once."""
+        import async_api
+        cancellation = Cancellation()
+        return async_api.iterate_in_thread(self._stream(self.request(prompt, context), cancellation),
+                                           cancellation.cancel)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(model={self.model!r}, endpoint={self.endpoint!r})"
+
+
+def _messages(prompt: str | list[Message]) -> list[Message]:
+    return [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+
+
+class OllamaGenerateBackend(ModelBackend):
+    """Ollama's /api/generate, which completes a raw prompt and returns its context."""
+    name = "ollama"
+    default_endpoint = "http://localhost:11434"
+    supports_context = True
+    path = "/api/generate"
+
+    def request(self, prompt: str | list[Message], context: list[int] | None) -> dict[str, Any]:
+        if not isinstance(prompt, str):
+            raise TypeError(f"{type(self).__name__} takes a prompt string, not messages.")
+        data: dict[str, Any] = {"model": self.model, "prompt": prompt, "stream": True}
+        if context:
+            # The server continues from the tokens of the previous exchange, so the prompt only holds the new turn.
+            data["context"] = context
+        if self.options:
+            data["options"] = self.options
+        if self.keep_alive is not None:
+            data["keep_alive"] = self.keep_alive
+        return data
+
+    def warm_request(self, system_prompt: str) -> dict[str, Any]:
+        # Every prompt starts like the text of build_prompt.
+        data = self.request(f"{system_prompt}\n\n", None)
+        data["options"] = {**self.options, "num_predict": 1}
+        return data
+
+    def parse(self, line: bytes) -> tuple[list[Chunk], bool]:
+        chunk = loads(line)
+        chunks: list[Chunk] = [chunk["response"]] if chunk.get("response") else []
+        if "context" in chunk:
+            chunks.append(chunk["context"])
+        if chunk.get("done", False) and (stats := server_stats(chunk)):
+            chunks.append(stats)
+        return chunks, chunk.get("done", False)
+
+
+class OllamaChatBackend(ModelBackend):
+    """Ollama's /api/chat, which takes structured messages and applies the model's chat template itself."""
+    name = "ollama-chat"
+    default_endpoint = "http://localhost:11434"
+    uses_messages = True
+    path = "/api/chat"
+
+    def request(self, prompt: str | list[Message], context: list[int] | None) -> dict[str, Any]:
+        data: dict[str, Any] = {"model": self.model, "messages": _messages(prompt), "stream": True}
+        if self.options:
+            data["options"] = self.options
+        if self.keep_alive is not None:
+            data["keep_alive"] = self.keep_alive
+        return data
+
+    def warm_request(self, system_prompt: str) -> dict[str, Any]:
+        data = self.request([{"role": "system", "content": system_prompt}], None)
+        data["options"] = {**self.options, "num_predict": 1}
+        return data
+
+    def parse(self, line: bytes) -> tuple[list[Chunk], bool]:
+        chunk = loads(line)
+        content = chunk.get("message", {}).get("content")
+        chunks: list[Chunk] = [content] if content else []
+        if chunk.get("done", False) and (stats := server_stats(chunk)):
+            chunks.append(stats)
+        return chunks, chunk.get("done", False)
+
+
+class OpenAICompatibleBackend(ModelBackend):
+    """The /v1/chat/completions endpoint of OpenAI compatible local servers, like llama.cpp, vLLM or LM Studio."""
+    name = "openai"
+    default_endpoint = "http://localhost:8080"
+    default_model = "default"
+    uses_messages = True
+    path = "/v1/chat/completions"
+    prefix = b"data: "
+    health_path = "/v1/models"
+
+    def request(self, prompt: str | list[Message], context: list[int] | None) -> dict[str, Any]:
+        return {**self.options, "model": self.model, "messages": _messages(prompt), "stream": True}
+
+    def warm_request(self, system_prompt: str) -> dict[str, Any]:
+        # llama.cpp keeps the prompt of the last request in its cache, and loads the model when it starts anyway.
+        return {**self.request([{"role": "system", "content": system_prompt}], None), "max_tokens": 1}
+
+    def parse(self, line: bytes) -> tuple[list[Chunk], bool]:
+        if line == b"[DONE]":
+            return [], True
+        chunk = loads(line)
+        chunks: list[Chunk] = []
+        for choice in chunk.get("choices") or []:
+            content = choice.get("delta", {}).get("content")
+            if content:
+                chunks.append(content)
+        if chunk.get("usage"):  # Sent last with the option stream_options={"include_usage": true}
+            usage = chunk["usage"]
+            chunks.append({"prompt_eval_count": usage.get("prompt_tokens", 0),
+                           "eval_count": usage.get("completion_tokens", 0)})
+        return chunks, False
+
+
+BACKENDS: dict[str, type[ModelBackend]] = {backend.name: backend for backend in
+                                           (OllamaGenerateBackend, OllamaChatBackend, OpenAICompatibleBackend)}
+
+
+def with_model(ai_api: Any, model: str) -> Any:
+    """A copy of a backend that answers with another model, sharing the endpoints. A plain ai_api function,
+    like query_ollama, gets the model as an argument instead."""
+    if not hasattr(ai_api, "model"):
+        return functools.partial(ai_api, model=model)
+    copied = copy.copy(ai_api)
+    copied.model = model
+    return copied
+
+
+def make_backend(name: str, model: str | None = None, endpoint: str | Sequence[str] | None = None,
+                 options: dict[str, Any] | None = None, timeout: float | None = None,
+                 keep_alive: str | float | None = None) -> ModelBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}'. Choose one of: {', '.join(BACKENDS)}")
+    read_timeout = (DEFAULT_TIMEOUT[0], timeout) if timeout is not None else DEFAULT_TIMEOUT
+    return BACKENDS[name](model=model, endpoint=endpoint, options=options, timeout=read_timeout,
+                          keep_alive=keep_alive)
@@ -0,0 +1,301 @@
+import asyncio
+import io
+import json
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, AsyncGenerator, Callable, Generator, TextIO
+from abbreviation import abbreviation
+from command_data import CommandData, CommandSession
+from ollamaapi import Chunk
+from prompts import build_prompt
+from response_cache import ResponseCache
+from stdin_capture import capture_stdin
+
+DEFAULT_JOBS = 4
+
+
+@dataclass
+class BatchInput:
+    name: str
+    command: CommandData
+    # Why the input can't be answered, like a line of a .jsonl file without a "command"
+    error: str | None = None
+    # The position in the batch, which tells inputs with the same name apart
+    index: int = 0
+
+
+@dataclass
+class BatchResult:
+    name: str
+    command: CommandData
+    seconds: float = 0.0
+    # Tokens generated, as counted by the model server
+    tokens: int = 0
+    cached: bool = False
+    error: str | None = None
+    index: int = 0
+
+    def record(self, answer: bool = True) -> dict[str, Any]:
+        record: dict[str, Any] = {"input": self.name, "command": self.command.command,
+                                  "seconds": round(self.seconds, 3), "tokens": self.tokens, "cached": self.cached,
+                                  "error": self.error}
+        if answer:
+            record["answer"] = self.command.ai_response
+        return record
+
+
+@dataclass
+class BatchStats:
+    inputs: int = 0
+    failed: int = 0
+    cached: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+    jobs: int = DEFAULT_JOBS
+    rate: float | None = None
+    # The most inputs that were answered at the same time
+    peak: int = 0
+
+    def report(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        limits = f"up to {self.jobs} at a time" + (f", {self.rate:g} per second" if self.rate else "")
+        return f"Batch: {self.inputs} inputs, {self.failed} failed, {self.cached} from the cache, " \
+               f"in {self.seconds:.1f} s ({limits}, {self.peak} at most): " \
+               f"{self.inputs / seconds:.2f} inputs/s, {self.tokens / seconds:.1f} tokens/s."
+
+
+def _command(command: str, stdin: IO[str], head_lines: int | None, tail_lines: int | None,
+             compact: bool) -> CommandData:
+    captured = capture_stdin(stdin, head_lines=head_lines, tail_lines=tail_lines, compact=compact)
+    return CommandData(command=command, stdin=captured.text, ai_response="", stdin_omitted=captured.omitted_lines)
+
+
+def read_inputs(path: Path, head_lines: int | None = None, tail_lines: int | None = None,
+                compact: bool = False) -> list[BatchInput]:
+    """A directory has one input per file, with the file as stdin, as if it was piped to kj with cat.
+    A .jsonl file has one per line, an object with "command" and optionally "stdin" and "name". A line that
+    isn't one is an input with an error, so that the batch reports it with the others.
+    Any other file has one per line that isn't empty, with the line as the command.
+    stdin is cut and compacted like piped stdin."""
+    if path.is_dir():
+        inputs: list[BatchInput] = []
+        for file in sorted(file for file in path.iterdir() if file.is_file()):
+            with file.open(encoding="utf-8", errors="replace") as stream:
+                command = _command(f"cat {file.name} | {abbreviation}", stream, head_lines, tail_lines, compact)
+            inputs.append(BatchInput(file.name, command, index=len(inputs)))
+        return inputs
+    inputs = []
+    for number, line in enumerate(path.read_text(encoding="utf-8").splitlines(), 1):
+        if not line.strip():
+            continue
+        if path.suffix != ".jsonl":
+            inputs.append(BatchInput(str(number), CommandData(command=line.strip(), stdin="", ai_response=""),
+                                     index=len(inputs)))
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record["command"], str):
+                raise TypeError(f"the command is {type(record['command']).__name__}, not a string")
+            command = _command(record["command"], io.StringIO(record.get("stdin", "")), head_lines, tail_lines, compact)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            error = f"{path.name}:{number}: expected an object with a \"command\" ({e!r})"
+            inputs.append(BatchInput(str(number), CommandData(command="", stdin="", ai_response=""), error,
+                                     len(inputs)))
+            continue
+        inputs.append(BatchInput(str(record.get("name", number)), command, index=len(inputs)))
+    return inputs
+
+
+class BatchWriter:
+    """Writes the answers as they arrive to a file per input in output_dir, with a report.jsonl of the results
+    next to them. Without output_dir, a JSON line with the answer is written to report for each finished input."""
+    output_dir: Path | None
+    report: TextIO
+    # By the index of the input
+    _paths: dict[int, Path]
+    _files: dict[int, TextIO]
+
+    def __init__(self, output_dir: Path | None, report: TextIO):
+        self.output_dir = output_dir
+        self.report = report
+        self._paths = {}
+        self._files = {}
+        if output_dir is not None:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            self.report = (output_dir / "report.jsonl").open("a", encoding="utf-8")
+
+    def output_path(self, name: str) -> Path | None:
+        """The file of the answer to the input with name. Names come from the inputs, so anything but letters,
+        digits, dots, dashes and underscores is replaced, and so are leading dots, to stay in output_dir."""
+        if self.output_dir is None:
+            return None
+        safe_name = re.sub(r"[^\w.-]", "_", name).lstrip(".") or "_"
+        return self.output_dir / f"{safe_name}.txt"
+
+    def assign(self, inputs: list[BatchInput]) -> None:
+        """Gives each input its own file. Inputs with the same name, or names that are the same once replaced,
+        would overwrite each other's answers, so the later ones get their position in the batch added."""
+        taken = {path.name.casefold() for path in self._paths.values()}
+        for item in inputs:
+            path = self.output_path(item.name)
+            if path is None or item.index in self._paths:
+                continue
+            stem, number = path.stem, item.index + 1
+            while path.name.casefold() in taken:
+                path = path.with_name(f"{stem}-{number}.txt")
+                number += 1
+            taken.add(path.name.casefold())
+            self._paths[item.index] = path
+
+    def chunk(self, item: BatchInput, text: str) -> None:
+        if item.index not in self._paths:
+            self.assign([item])
+        path = self._paths.get(item.index)
+        if path is None:
+            return
+        if item.index not in self._files:
+            self._files[item.index] = path.open("w", encoding="utf-8")
+        self._files[item.index].write(text)
+
+    def finish(self, result: BatchResult) -> None:
+        file = self._files.pop(result.index, None)
+        if file is not None:
+            if result.error is not None:
+                file.write(f"\n[{abbreviation}: {result.error}]")
+            file.close()
+        record = result.record(answer=self.output_dir is None)
+        if result.index in self._paths:
+            record["file"] = self._paths[result.index].name
+        self.report.write(json.dumps(record) + "\n")
+        self.report.flush()
+
+    def close(self) -> None:
+        if self.output_dir is not None:
+            self.report.close()
+
+
+class BatchRunner:
+    """Answers many commands, each on its own like the first command of a new session, with at most jobs
+    requests to the model at the same time, and at most rate requests started per second."""
+    ai_api: Callable[..., Generator[Chunk, None, None]]
+    model: str
+    system_prompt: str
+    save_dir: Path
+    token_budget: int | None
+    jobs: int
+    rate: float | None
+    cache: ResponseCache | None
+    deadline: float | None
+    stats: BatchStats
+    _next_start: float
+    _active: int
+
+    def __init__(self, ai_api: Callable[..., Generator[Chunk, None, None]], model: str, system_prompt: str,
+                 save_dir: Path, token_budget: int | None = None, jobs: int = DEFAULT_JOBS, rate: float | None = None,
+                 cache: ResponseCache | None = None, deadline: float | None = None):
+        """deadline is the most seconds an answer may take."""
+        if jobs < 1 or rate is not None and rate <= 0:
+            raise ValueError("The number of jobs and the rate must be positive.")
+        self.ai_api = ai_api
+        self.model = model
+        self.system_prompt = system_prompt
+        self.save_dir = save_dir
+        self.token_budget = token_budget
+        self.jobs = jobs
+        self.rate = rate
+        self.cache = cache
+        self.deadline = deadline
+        self.stats = BatchStats(jobs=jobs, rate=rate)
+        self._next_start = 0.0
+        self._active = 0
+
+    async def run(self, inputs: list[BatchInput], writer: BatchWriter,
+                  on_result: Callable[[BatchResult], None] | None = None) -> BatchStats:
+        """Answers the inputs, passing each result to writer as soon as it is complete, and to on_result if the
+        input was valid."""
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.jobs)
+        writer.assign(inputs)
+
+        async def answer(item: BatchInput) -> None:
+            async with semaphore:
+                await self._wait_turn()
+                self._active += 1
+                self.stats.peak = max(self.stats.peak, self._active)
+                try:
+                    result = await self.answer(item, writer)
+                finally:
+                    self._active -= 1
+            self.stats.inputs += 1
+            self.stats.failed += result.error is not None
+            self.stats.cached += result.cached
+            self.stats.tokens += result.tokens
+            writer.finish(result)
+            if on_result is not None and item.error is None:
+                on_result(result)
+
+        await asyncio.gather(*(answer(item) for item in inputs))
+        self.stats.seconds = time.perf_counter() - start
+        return self.stats
+
+    async def _wait_turn(self) -> None:
+        if self.rate is None:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_start)
+        self._next_start = start + 1 / self.rate
+        await asyncio.sleep(start - now)
+
+    async def answer(self, item: BatchInput, writer: BatchWriter) -> BatchResult:
+        command = item.command
+        result = BatchResult(item.name, command, index=item.index)
+        if item.error is not None:
+            result.error = item.error
+            return result
+        chunks: list[str] = []
+        start = time.perf_counter()
+        key = self.cache.key(self.model, command) if self.cache is not None else None
+        cached = self.cache.get(key) if self.cache is not None and key is not None else None
+        try:
+            if cached is not None:
+                result.cached = True
+                for text in ResponseCache.replay(cached):
+                    chunks.append(text)
+                    writer.chunk(item, text)
+            else:
+                await asyncio.wait_for(self._generate(item, writer, chunks, result), self.deadline)
+                if self.cache is not None and key is not None and chunks:
+                    self.cache.put(key, self.model, chunks)
+        except (OSError, ValueError) as e:  # Including TimeoutError. The other inputs go on.
+            result.error = str(e) or type(e).__name__
+        command.ai_response = "".join(chunks)
+        command.interrupted = result.error is not None
+        if command.ai_response:
+            command.model = self.model
+        result.seconds = time.perf_counter() - start
+        return result
+
+    async def _generate(self, item: BatchInput, writer: BatchWriter, chunks: list[str], result: BatchResult) -> None:
+        session = CommandSession(id=0, prompt=self.system_prompt, save_dir=str(self.save_dir),
+                                 commands=[item.command], context=[])
+        build = build_prompt(session, self.token_budget)
+        stream = self._astream(build.messages() if getattr(self.ai_api, "uses_messages", False) else build.text)
+        try:
+            async for chunk in stream:
+                if isinstance(chunk, str):
+                    chunks.append(chunk)
+                    writer.chunk(item, chunk)
+                elif isinstance(chunk, dict):
+                    result.tokens = chunk.get("eval_count", 0)
+        finally:
+            await stream.aclose()
+
+    def _astream(self, prompt: str | list[dict[str, str]]) -> AsyncGenerator[Chunk, None]:
+        import async_api
+        astream = getattr(self.ai_api, "astream", None)
+        if astream is not None:
+            stream: AsyncGenerator[Chunk, None] = astream(prompt)
+            return stream
+        return async_api.iterate_in_thread(self.ai_api(prompt))
@@ -0,0 +1,351 @@
+"""Benchmarks of the kj pipeline, against synthetic sessions and a local fake model server.
+
+    python bench.py [--quick] [--only NAME ...] [--output FILE] [--compare OLD_FILE]
+
+Every result is written as a JSON line, with the commit it was measured on, so that runs can be compared
+between commits with --compare."""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from abbreviation import abbreviation
+from assistant import Assistant
+from backends import make_backend
+from command_data import CommandData, CommandSession, SessionManager, directory_lock
+from embedding_index import EmbeddingIndex, HashingEmbedder
+from fake_model_server import FakeModelServer
+from prompts import command_session_to_prompt
+from search_index import SearchIndex
+from stdin_capture import capture_stdin
+
+REPO = Path(__file__).parent
+DEFAULT_OUTPUT = REPO / "bench_output.txt"
+MB = 1 << 20
+
+
+@dataclass
+class Result:
+    benchmark: str
+    params: dict[str, Any]
+    runs: int
+    median_s: float
+    min_s: float
+    # Anything else worth comparing, like throughput
+    extra: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        return self.benchmark + "".join(f" {name}={value}" for name, value in sorted(self.params.items()))
+
+
+def measure(benchmark: str, params: dict[str, Any], run: Callable[[], Any], runs: int,
+            setup: Callable[[], Any] | None = None) -> Result:
+    """Times run() runs times, calling setup() before each run without timing it."""
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return Result(benchmark, params, runs, statistics.median(times), min(times))
+
+
+def synthetic_stdin(size: int, seed: int = 0) -> str:
+    """Log-like output of about size bytes, with counters, timestamps and an occasional error."""
+    lines = []
+    total = 0
+    i = seed
+    while total < size:
+        if i % 997 == 0:
+            line = f"2024-05-01 12:{i // 60 % 60:02d}:{i % 60:02d} ERROR worker-{i % 17}: connection refused\n"
+        else:
+            line = f"2024-05-01 12:{i // 60 % 60:02d}:{i % 60:02d} INFO worker-{i % 17}: " \
+                   f"processed item {i * 7919 % 100000} in {i % 300} ms\n"
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return "".join(lines)
+
+
+def synthetic_commands(count: int, stdin_size: int = 200) -> list[CommandData]:
+    stdin = synthetic_stdin(stdin_size)
+    return [CommandData(command=f"make target{i} 2>&1 | {abbreviation}", stdin=stdin,
+                        ai_response=f"The build of target{i} failed, because the connection was refused.")
+            for i in range(count)]
+
+
+def make_session(save_dir: Path, commands: int, stdin_size: int = 200, session_id: int = 0) -> CommandSession:
+    session = CommandSession(id=session_id, prompt="<systemprompt>\nBenchmark\n</systemprompt>",
+                             save_dir=str(save_dir), commands=synthetic_commands(commands, stdin_size), context=[])
+    session.save()
+    return session
+
+
+def make_sessions(save_dir: Path, count: int) -> None:
+    for session_id in range(count):
+        make_session(save_dir, 3, session_id=session_id)
+
+
+def _env() -> dict[str, str]:
+    # Startup is measured with .pyc files, like an installed kj.
+    return {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+
+
+def bench_startup(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 3 if quick else 10
+    for module in ("shell", "kj_client"):
+        command = [sys.executable, "-c", f"import {module}"]
+        subprocess.run(command, cwd=REPO, env=_env(), check=True)
+        yield measure("startup.import", {"module": module},
+                      lambda: subprocess.run(command, cwd=REPO, env=_env(), check=True), runs)
+    path = work_dir / "listen"
+    path.mkdir()
+    command = [sys.executable, str(REPO / "shell.py"), "--listen", "--path", str(path)]
+    env = {**_env(), "HISTORY": f"1  {abbreviation} --listen"}
+    yield measure("startup.listen", {}, lambda: subprocess.run(command, cwd=REPO, env=env, input="hello\n",
+                                                              capture_output=True, text=True, check=True), runs)
+
+
+def bench_session_lookup(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 3 if quick else 10
+    for count in (5,) if quick else (10, 1000):
+        path = work_dir / f"lookup{count}"
+        path.mkdir()
+        make_sessions(path, count)
+        SessionManager(path).load_most_recent_session()  # Builds the manifest
+        yield measure("session.lookup", {"sessions": count},
+                      lambda: SessionManager(path).load_most_recent_session(), runs)
+        manifest = SessionManager(path).manifest.path
+        yield measure("session.lookup_rebuild", {"sessions": count},
+                      lambda: SessionManager(path).load_most_recent_session(), runs,
+                      setup=lambda: manifest.unlink(missing_ok=True))
+
+
+def bench_session_storage(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 3 if quick else 5
+    for count in (1, 10) if quick else (1, 100, 10000):
+        path = work_dir / f"storage{count}"
+        path.mkdir()
+        session = make_session(path, count)
+        file_size = session.path.stat().st_size
+        commands = synthetic_commands(count)
+        yield measure("session.save_all", {"commands": count},
+                      lambda: CommandSession(id=0, prompt=session.prompt, save_dir=str(path),
+                                             commands=list(commands), context=[]).save(), runs)
+        loaded = CommandSession.from_file(session.path)
+
+        def append() -> None:
+            loaded.commands.append(synthetic_commands(1)[0])
+            loaded.save()
+        yield measure("session.save_append", {"commands": count}, append, runs)
+        result = measure("session.from_file", {"commands": count}, lambda: CommandSession.from_file(session.path), runs)
+        result.extra["file_bytes"] = file_size
+        yield result
+        yield measure("session.load_all", {"commands": count},
+                      lambda: list(CommandSession.from_file(session.path).commands), runs)
+        for budget in (None, 8192):
+            yield measure("prompt.build", {"commands": count, "token_budget": budget},
+                          lambda: command_session_to_prompt(CommandSession.from_file(session.path), budget), runs)
+
+
+def bench_search(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 3 if quick else 10
+    for count in (10,) if quick else (100, 3000):
+        path = work_dir / f"search{count}"
+        path.mkdir()
+        for session_id in range(count):
+            make_session(path, 5, session_id=session_id)
+        manager = SessionManager(path)
+        index = SearchIndex(path)
+        # Searching refreshes the index first, which only has to read the manifest
+        yield measure("search.query", {"sessions": count},
+                      lambda: (index.refresh(manager), index.search("connection refused")), runs)
+        yield measure("search.rebuild", {"sessions": count}, lambda: index.refresh(manager),
+                      1 if quick else 3, setup=lambda: index.path.unlink())
+
+
+def bench_related(quick: bool, work_dir: Path) -> Iterator[Result]:
+    import numpy as np
+    runs = 3 if quick else 10
+    embedder = HashingEmbedder()
+    text = "\n".join(synthetic_stdin(2000).splitlines()[:20])
+    for turns in (1000,) if quick else (10_000, 100_000):
+        path = work_dir / f"related{turns}"
+        path.mkdir()
+        index = EmbeddingIndex.create(path, embedder)
+        # Random vectors near the query's in 100 sessions, because embedding that many commands would take a while
+        vectors = embedder.embed([text])
+        noise = np.random.default_rng(0).standard_normal((turns, embedder.dimensions), dtype=np.float32)
+        per_session = turns // 100
+        with directory_lock(path):
+            for session_id in range(100):
+                start = session_id * per_session
+                index.add(session_id, 0, noise[start:start + per_session] + vectors, time.time())
+        yield measure("related.search", {"turns": turns}, lambda: index.search(text, 5), runs)
+
+
+def bench_stdin(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 1 if quick else 3
+    for size in (64 * 1024,) if quick else (MB, 10 * MB, 100 * MB):
+        path = work_dir / f"stdin{size}.log"
+        path.write_text(synthetic_stdin(size), encoding="utf-8")
+        for compact in (False, True):
+            def ingest() -> None:
+                with path.open(encoding="utf-8") as stream:
+                    capture_stdin(stream, head_lines=100, tail_lines=300, compact=compact)
+            result = measure("stdin.capture", {"bytes": size, "compact": compact}, ingest, runs)
+            result.extra["mb_per_s"] = size / MB / result.median_s
+            yield result
+
+
+def bench_render(quick: bool, work_dir: Path) -> Iterator[Result]:
+    from shell import print_ai_response
+    runs = 3 if quick else 10
+    tokens = [f"word{i} " if i % 20 else "`code`\n" for i in range(1000 if quick else 100_000)]
+    with open(os.devnull, "w", encoding="utf-8") as out:
+        for markdown in (False, True):
+            result = measure("render", {"tokens": len(tokens), "markdown": markdown},
+                             lambda: print_ai_response(iter(tokens), out, markdown), runs)
+            result.extra["tokens_per_s"] = len(tokens) / result.median_s
+            yield result
+
+
+def _time_to_first_token(stream: Iterator[str]) -> tuple[float, float]:
+    start = time.perf_counter()
+    first = None
+    for _ in stream:
+        if first is None:
+            first = time.perf_counter() - start
+    return first if first is not None else float("nan"), time.perf_counter() - start
+
+
+async def _async_time_to_first_token(assistant: Assistant, command: CommandData) -> tuple[float, float]:
+    start = time.perf_counter()
+    first = None
+    async for _ in assistant.anew_command(command):
+        if first is None:
+            first = time.perf_counter() - start
+    return first if first is not None else float("nan"), time.perf_counter() - start
+
+
+def bench_time_to_first_token(quick: bool, work_dir: Path) -> Iterator[Result]:
+    runs = 3 if quick else 10
+    latency, rate, tokens = 0.05, 500.0, 50
+    with FakeModelServer(tokens=tokens, latency=latency, tokens_per_second=rate) as server:
+        for history in (0, 10) if quick else (0, 100, 1000):
+            for mode in ("sync", "async"):
+                path = work_dir / f"ttft{history}{mode}"
+                path.mkdir()
+                make_session(path, history)
+                backend = make_backend("ollama", endpoint=server.url)
+                firsts, totals = [], []
+                for i in range(runs):
+                    assistant = Assistant(SessionManager(path), ai_api=backend, model=backend.model)
+                    command = CommandData(f"make target{i}", synthetic_stdin(2000), "")
+                    if mode == "sync":
+                        first, total = _time_to_first_token(assistant.new_command(command))
+                    else:
+                        first, total = asyncio.run(_async_time_to_first_token(assistant, command))
+                    firsts.append(first)
+                    totals.append(total)
+                params = {"history": history, "mode": mode, "latency": latency, "tokens_per_second": rate}
+                yield Result("answer.first_token", params, runs, statistics.median(firsts), min(firsts))
+                yield Result("answer.total", params, runs, statistics.median(totals), min(totals))
+
+        # The whole way, from starting the process to the first word on stdout
+        path = work_dir / "ttft_process"
+        path.mkdir()
+        argv = [sys.executable, str(REPO / "shell.py"), "--path", str(path), "--endpoint", server.url, "--no-cache"]
+        env = {**_env(), "HISTORY": f"1  make 2>&1 | {abbreviation}"}
+        firsts = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = subprocess.Popen(argv, cwd=REPO, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       text=True)
+            assert process.stdin is not None and process.stdout is not None
+            process.stdin.write("error\n")
+            process.stdin.close()
+            first = float("nan")
+            for line in process.stdout:
+                if "word0" in line:
+                    first = time.perf_counter() - start
+                    break
+            process.stdout.read()
+            process.wait()
+            firsts.append(first)
+        yield Result("answer.process_first_token", {"latency": latency}, runs, statistics.median(firsts), min(firsts))
+
+
+BENCHMARKS: dict[str, Callable[[bool, Path], Iterator[Result]]] = {
+    "startup": bench_startup,
+    "lookup": bench_session_lookup,
+    "storage": bench_session_storage,
+    "search": bench_search,
+    "related": bench_related,
+    "stdin": bench_stdin,
+    "ttft": bench_time_to_first_token,
+    "render": bench_render,
+}
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(quick: bool = False, only: list[str] | None = None) -> Iterator[Result]:
+    with tempfile.TemporaryDirectory(prefix=f"{abbreviation}-bench-") as work_dir:
+        for name, benchmark in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            directory = Path(work_dir) / name
+            directory.mkdir()
+            yield from benchmark(quick, directory)
+
+
+def load_results(path: Path) -> dict[str, dict[str, Any]]:
+    results = {}
+    for line in path.read_text(encoding="utf-8").splitlines():
+        record = json.loads(line)
+        results[Result(record["benchmark"], record["params"], 0, 0, 0).key] = record
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="small sizes and few runs, to check that it works")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="only run these benchmarks")
+    parser.add_argument("--output", type=Path, default=DEFAULT_OUTPUT,
+                        help=f"file to write the JSON lines to. default is {DEFAULT_OUTPUT.name}")
+    parser.add_argument("--compare", type=Path, metavar="OLD_FILE", help="print how the results changed since OLD_FILE")
+    args = parser.parse_args(argv)
+
+    old = load_results(args.compare) if args.compare else {}
+    context = {"commit": commit(), "python": platform.python_version(), "quick": args.quick}
+    with args.output.open("w", encoding="utf-8") as output:
+        for result in run_benchmarks(args.quick, args.only):
+            output.write(json.dumps({**asdict(result), **context}) + "\n")
+            output.flush()
+            line = f"{result.key:<70} {result.median_s * 1000:10.2f} ms"
+            if result.key in old:
+                line += f"  {result.median_s / old[result.key]['median_s']:6.2f}x"
+            print(line, flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
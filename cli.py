@@ -1,10 +1,17 @@
 import argparse
 from abbreviation import abbreviation
 from pathlib import Path
+from config import default_config_path, parse_option
 
 def default_storage_path() -> Path:
     return Path.home() / f"{abbreviation}-assistant" / ".sessions"
 
+
+DEFAULT_TOKEN_BUDGET = 8192
+DEFAULT_STDIN_HEAD = 100
+DEFAULT_STDIN_TAIL = 300
+
+
 def get_arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog=abbreviation)
 
@@ -18,8 +25,133 @@ def get_arg_parser() -> argparse.ArgumentParser:
                         help="start a new session")
     
     parser.add_argument("-s", "--switch-session", nargs="?", const="interactive", metavar="SESSION_ID",
-                        help="switch to the session with the given id. no argument opens an interactive session selector (WIP)")
+                        help="switch to the session with the given id. no argument searches the sessions and lets you pick one")
+
+    parser.add_argument("--search", nargs="+", metavar="WORD",
+                        help="list the sessions whose commands, input or answers contain all of the words, best match first")
     
+    parser.add_argument("-c", "--config", default=str(default_config_path()),
+                        help=f"JSON file with default values for the options below, like {{\"model\": \"llama3.2\"}}. "
+                             f"default is {str(default_config_path())}")
+
+    parser.add_argument("-b", "--backend", metavar="BACKEND",
+                        help="kind of model server: 'ollama', 'ollama-chat' or 'openai' (any OpenAI compatible server). "
+                             "default is ollama")
+
+    parser.add_argument("-m", "--model",
+                        help="model to answer with. the default depends on the backend, unless the config file has "
+                             "\"models\", a list of models from the lightest to the heaviest, to pick from for each "
+                             "command by the size of its prompt, its kind and how fast the models answered lately. "
+                             "--verbose shows why")
+
+    parser.add_argument("-e", "--endpoint", metavar="URL", action="append",
+                        help="address of the model server, like http://localhost:11434. can be given several times "
+                             "for servers of the same model, which then share the requests and stand in for each other")
+
+    parser.add_argument("--check-endpoints", action="store_true",
+                        help="check which model servers are running, print their statistics, and exit")
+
+    parser.add_argument("--keep-alive", metavar="DURATION",
+                        help="how long the model server keeps the model loaded after an answer, like 30m, or seconds. "
+                             "-1 keeps it loaded. in the config file, \"keep_alive\" can also be active hours like "
+                             "{\"hours\": \"8-19\", \"outside\": \"5m\"}, which keep it loaded until they end. "
+                             "default is the server's")
+
+    parser.add_argument("--warm", nargs="?", const="background", choices=("background", "wait"),
+                        help="load the model and let it read the system prompt, so that the next answer starts sooner, "
+                             "and exit. for a shell rc file. by default, this happens in the background. set "
+                             "\"warm_on_start\" in the config file to also do it while the piped command runs")
+
+    parser.add_argument("-o", "--option", action="append", type=parse_option, metavar="KEY=VALUE",
+                        help="model option, like temperature=0.2. can be given several times")
+
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                        help="how long to wait for the model server to send anything")
+
+    parser.add_argument("--deadline", type=float, metavar="SECONDS",
+                        help="stop the answer after this many seconds, keeping what arrived so far")
+
+    parser.add_argument("-t", "--token-budget", type=int, default=DEFAULT_TOKEN_BUDGET, metavar="TOKENS",
+                        help=f"leave out the oldest commands of the session when the prompt would exceed this many tokens. "
+                             f"0 sends the whole session. default is {DEFAULT_TOKEN_BUDGET}")
+
+    parser.add_argument("--related", type=int, metavar="COUNT",
+                        help="also send up to this many earlier commands of any session that are most like the new one. "
+                             "the first time, every session is indexed. needs numpy")
+
+    parser.add_argument("--embedder", metavar="EMBEDDER",
+                        help="how --related compares commands: 'hashing' (by their words, without a model) or 'ollama' "
+                             "(with the embedding model set as \"embedding_model\" in the config file). default is hashing")
+
+    parser.add_argument("--stdin-head", type=int, default=DEFAULT_STDIN_HEAD, metavar="LINES",
+                        help=f"number of lines to keep from the start of stdin. default is {DEFAULT_STDIN_HEAD}")
+
+    parser.add_argument("--stdin-tail", type=int, default=DEFAULT_STDIN_TAIL, metavar="LINES",
+                        help=f"number of lines to keep from the end of stdin. the lines in between are left out. "
+                             f"default is {DEFAULT_STDIN_TAIL}")
+
+    parser.add_argument("--raw-stdin", action="store_true",
+                        help="keep stdin as it is. by default, color codes and progress bars are removed, "
+                             "and runs of similar lines are collapsed")
+
+    parser.add_argument("--spill-stdin", action="store_true",
+                        help="also write the complete stdin to a file in the 'stdin' directory next to the sessions")
+
+    parser.add_argument("--no-context", action="store_true",
+                        help="resend the whole session to the model instead of continuing from its stored context")
+
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always ask the model, instead of repeating a stored answer to the same command and stdin "
+                             "after the same earlier commands")
+
+    parser.add_argument("--batch", metavar="PATH",
+                        help="answer many inputs instead of stdin: every file of a directory, as if piped to "
+                             f"{abbreviation}, or every line of a file, as a command. lines of a .jsonl file are objects "
+                             "with a \"command\", and optionally \"stdin\" and \"name\". the results are printed as JSON lines")
+
+    parser.add_argument("--batch-output", metavar="DIR",
+                        help="write the answer to every input of --batch to a file in this directory instead, "
+                             "with the results in report.jsonl")
+
+    parser.add_argument("--jobs", type=int, metavar="COUNT",
+                        help="the most inputs of --batch to answer at the same time. default is 4")
+
+    parser.add_argument("--rate", type=float, metavar="PER_SECOND",
+                        help="the most inputs of --batch to start answering per second. default is no limit")
+
+    parser.add_argument("--record", action="store_true",
+                        help="also add the inputs of --batch and their answers to the session")
+
+    parser.add_argument("--follow", action="store_true",
+                        help="keep reading stdin, like the output of 'tail -f' or a running build, and answer about the "
+                             "last --stdin-tail lines whenever one of the triggers below fires. every answer is added "
+                             "to the session. new lines wait while the model answers")
+
+    parser.add_argument("--follow-pattern", metavar="REGEX",
+                        help="with --follow, answer when lines matching this arrive. default is lines with words like "
+                             "error, warning or traceback. an empty pattern turns this off")
+
+    parser.add_argument("--follow-lines", type=int, metavar="LINES",
+                        help="with --follow, answer after this many new lines. default is off")
+
+    parser.add_argument("--follow-idle", type=float, metavar="SECONDS",
+                        help="with --follow, answer when no new line arrived for this many seconds. 0 turns this off. "
+                             "default is 10")
+
+    parser.add_argument("--gc", action="store_true",
+                        help="remove the stored stdin that no session uses any more, and exit")
+
+    parser.add_argument("--markdown", choices=("auto", "always", "never"),
+                        help="show code blocks, `code`, **bold** and headings of the answer in color. "
+                             "default is auto, which does when the output is a terminal")
+
+    parser.add_argument("--timings", action="store_true",
+                        help="print where the time went after the answer, including the statistics of the model server")
+
+    parser.add_argument("--metrics", action="store_true",
+                        help="append the timings of every answer to a JSON lines file per session, "
+                             "in the 'metrics' directory next to the sessions")
+
     parser.add_argument("-v", "--verbose", action="store_true", 
                         help="print debug info")
     return parser
@@ -1,16 +1,437 @@
-from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field, fields, replace
+import copy
+import fcntl
+import hashlib
 import json
+import os
+import threading
+import zlib
+from collections.abc import MutableSequence, Iterable, Iterator, Sequence
 from pathlib import Path
-from typing import Self, Any
+from typing import TYPE_CHECKING, Self, Any, overload, IO
 from abbreviation import abbreviation
 
 
+JOURNAL_VERSION = 2
+# Stdin longer than this many characters is stored in a blob instead of the session journal.
+BLOB_THRESHOLD = 1024
+PREVIEW_LENGTH = 200
+
+
+def unique_temp_path(path: Path) -> Path:
+    # Unique per process and thread, so that concurrent writers never share a temporary file.
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def atomic_write_bytes(path: Path, data: bytes, exclusive: bool = False) -> None:
+    """Writes a temporary file that then replaces path, so that readers see either the old or the new content.
+    With exclusive, the temporary file is linked to path instead, which fails if it exists."""
+    temp_path = unique_temp_path(path)
+    temp_path.write_bytes(data)
+    if exclusive:
+        try:
+            os.link(temp_path, path)
+        finally:
+            temp_path.unlink()
+    else:
+        os.replace(temp_path, path)
+
+
+def atomic_write_text(path: Path, text: str) -> None:
+    atomic_write_bytes(path, text.encode("utf-8"))
+
+
+def read_stats(path: Path) -> dict[str, Any]:
+    """Statistics kept in a JSON file, which are empty if the file is missing or damaged."""
+    try:
+        stats = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return stats if isinstance(stats, dict) else {}
+
+
+def write_stats(path: Path, stats: dict[str, Any]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(path, json.dumps(stats))
+    except OSError:
+        pass  # The statistics are not worth failing a command for
+
+
+@dataclass(frozen=True)
+class StdinBlob:
+    hash: str
+    # Bytes of the uncompressed stdin
+    size: int
+    preview: str
+
+
+class BlobStore:
+    """Compressed texts in files named by the hash of their content, so that every command with the same stdin
+    shares one file. Sessions keep their stdin blobs in the "blobs" directory next to them."""
+    dirname = "blobs"
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @classmethod
+    def of(cls: type[Self], save_dir: Path) -> Self:
+        return cls(save_dir / cls.dirname)
+
+    def blob_path(self, blob_hash: str) -> Path:
+        return self.path / f"{blob_hash}.z"
+
+    def put(self, text: str) -> StdinBlob:
+        data = text.encode("utf-8", errors="surrogatepass")
+        blob = StdinBlob(hashlib.sha256(data).hexdigest(), len(data), text[:PREVIEW_LENGTH])
+        path = self.blob_path(blob.hash)
+        if not path.exists():
+            self.path.mkdir(exist_ok=True)
+            atomic_write_bytes(path, zlib.compress(data))
+        return blob
+
+    def read(self, blob_hash: str) -> str:
+        return zlib.decompress(self.blob_path(blob_hash).read_bytes()).decode("utf-8", errors="surrogatepass")
+
+    def remove_unreferenced(self, referenced: set[str]) -> tuple[int, int]:
+        """Returns the number of blobs removed, and their size on disk."""
+        removed, size = 0, 0
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return 0, 0
+        for entry in entries:
+            if entry.name.endswith(".z") and not entry.name.startswith(".") and entry.name[:-2] not in referenced:
+                size += entry.stat().st_size
+                os.unlink(entry.path)
+                removed += 1
+        return removed, size
+
+
+class _LazyStdin:
+    """CommandData.stdin, which is read from its blob when it is first used. The class has no value for it,
+    so that dataclass sees no default, and stdin stays a required field of __init__."""
+    def __get__(self, command: "CommandData | None", owner: Any = None) -> str:
+        if command is None:
+            raise AttributeError("stdin has no default")
+        if command._stdin is None:
+            assert command.stdin_blob is not None and command._blobs is not None
+            command._stdin = command._blobs.read(command.stdin_blob.hash)
+        return command._stdin
+
+    def __set__(self, command: "CommandData", value: str) -> None:
+        command._stdin = value
+        command.stdin_blob = None
+
+
 # TODO: Change dataclasses to TypedDict
 @dataclass
 class CommandData:
     command: str
     stdin: str
     ai_response: str
+    # Lines left out of the middle of stdin, and where the complete input was written, if it was.
+    stdin_omitted: int = 0
+    stdin_spill: str | None = None
+    # Whether the answer was cut off by Ctrl+C, a deadline or a lost connection
+    interrupted: bool = False
+    # The model that answered, which differs between the commands of a session when a router picks it
+    model: str | None = None
+    # Estimated prompt tokens of this command, kept so that old commands don't have to be rendered again.
+    tokens: int | None = field(default=None, compare=False, repr=False)
+    # Where a long stdin is stored, once the command is saved
+    stdin_blob: StdinBlob | None = field(default=None, compare=False, repr=False)
+    _stdin: str | None = field(default=None, init=False, compare=False, repr=False)
+    _blobs: BlobStore | None = field(default=None, init=False, compare=False, repr=False)
+    _fragment: tuple[tuple[int, int, int, bool], str] | None = field(default=None, init=False, compare=False, repr=False)
+
+    if not TYPE_CHECKING:  # Type checkers see the str field
+        stdin = _LazyStdin()
+
+
+def _encode_record(record: dict[str, Any]) -> bytes:
+    # ensure_ascii keeps every record on a single line and makes byte offsets predictable.
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("ascii")
+
+
+@contextmanager
+def directory_lock(directory: Path) -> Iterator[None]:
+    """Holds an exclusive lock on the directory, across processes, while saving to it."""
+    with open(directory / ".lock", "ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _command_record(command: CommandData, blobs: BlobStore) -> bytes:
+    """Long stdin is written to a blob, which the record refers to. A command read from another directory
+    gets its blob written to this one."""
+    if command.stdin_blob is None and len(command.stdin) > BLOB_THRESHOLD \
+            or command.stdin_blob is not None and command._blobs is not None and command._blobs.path != blobs.path:
+        stdin = command.stdin
+        command.stdin_blob, command._stdin, command._blobs = blobs.put(stdin), stdin, blobs
+    record: dict[str, Any] = {"kind": "command"}
+    for command_field in fields(command):
+        if command_field.name.startswith("_") or command_field.name == "stdin" and command.stdin_blob is not None:
+            continue
+        value = getattr(command, command_field.name)
+        if command_field.name == "stdin_blob":
+            if value is None:
+                continue
+            value = asdict(value)
+        record[command_field.name] = value
+    return _encode_record(record)
+
+
+def _command_from_record(line: bytes, blobs: BlobStore) -> CommandData:
+    record = json.loads(line)
+    if record.pop("kind", None) != "command":
+        raise ValueError(f"Expected a command record, got:\n{line[:200]!r}")
+    blob = record.pop("stdin_blob", None)
+    if blob is None:
+        return CommandData(**record)
+    command = CommandData(stdin="", **record)
+    command.stdin_blob, command._stdin, command._blobs = StdinBlob(**blob), None, blobs
+    return command
+
+
+class CommandList(MutableSequence[CommandData]):
+    """List of commands backed by a session journal. Bodies are read from disk on first access."""
+    _path: Path
+    _items: list[CommandData | None]
+    _offsets: list[int | None]
+    modified_from: int | None
+
+    def __init__(self, path: Path, offsets: Iterable[int] = ()):
+        self._path = path
+        self._offsets = list(offsets)
+        self._items = [None] * len(self._offsets)
+        self.modified_from = None
+
+    def _load(self, indices: Iterable[int]) -> None:
+        missing = [i for i in indices if self._items[i] is None]
+        if not missing:
+            return
+        blobs = BlobStore.of(self._path.parent)
+        with self._path.open("rb") as f:
+            for i in missing:
+                offset = self._offsets[i]
+                assert offset is not None, "Unloaded commands always have an offset."
+                f.seek(offset)
+                self._items[i] = _command_from_record(f.readline(), blobs)
+
+    def is_loaded(self, index: int) -> bool:
+        return self._items[index] is not None
+
+    def copy(self) -> "CommandList":
+        """A list that changes independently of this one, with copies of the commands loaded so far."""
+        commands = CommandList(self._path, ())
+        commands._offsets = list(self._offsets)
+        commands._items = [copy.copy(item) for item in self._items]
+        commands.modified_from = self.modified_from
+        return commands
+
+    def _mark_modified(self, index: int) -> None:
+        if self.modified_from is None or index < self.modified_from:
+            self.modified_from = index
+
+    @overload
+    def __getitem__(self, index: int) -> CommandData: ...
+    @overload
+    def __getitem__(self, index: slice) -> list[CommandData]: ...
+    def __getitem__(self, index: int | slice) -> CommandData | list[CommandData]:
+        if isinstance(index, slice):
+            indices = range(len(self._items))[index]
+            self._load(indices)
+            return [self._items[i] for i in indices]  # type: ignore[misc]
+        index = range(len(self._items))[index]  # Normalises negative indices and raises IndexError
+        self._load((index,))
+        item = self._items[index]
+        assert item is not None
+        return item
+
+    @overload
+    def __setitem__(self, index: int, value: CommandData) -> None: ...
+    @overload
+    def __setitem__(self, index: slice, value: Iterable[CommandData]) -> None: ...
+    def __setitem__(self, index: int | slice, value: CommandData | Iterable[CommandData]) -> None:
+        if isinstance(index, slice):
+            raise TypeError(f"{type(self).__name__} does not support slice assignment.")
+        assert isinstance(value, CommandData)
+        index = range(len(self._items))[index]
+        self._items[index] = value
+        self._offsets[index] = None
+        self._mark_modified(index)
+
+    def __delitem__(self, index: int | slice) -> None:
+        indices = range(len(self._items))[index] if isinstance(index, slice) else [range(len(self._items))[index]]
+        for i in sorted(indices, reverse=True):
+            del self._items[i]
+            del self._offsets[i]
+            self._mark_modified(i)
+
+    def insert(self, index: int, value: CommandData) -> None:
+        index = min(max(index + len(self._items) if index < 0 else index, 0), len(self._items))
+        self._items.insert(index, value)
+        self._offsets.insert(index, None)
+        if index < len(self._items) - 1:
+            self._mark_modified(index)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[CommandData]:
+        self._load(range(len(self._items)))
+        for item in self._items:
+            assert item is not None
+            yield item
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        loaded = sum(item is not None for item in self._items)
+        return f"{type(self).__name__}({self._path.name!r}, {len(self)} commands, {loaded} loaded)"
+
+    def _merge(self, known: int, foreign: list[CommandData], offsets: list[int]) -> None:
+        """Inserts the commands another process saved after the first known ones, before the ones added here.
+        offsets are those of the file on disk, which holds the known and the foreign commands."""
+        for i in range(known):
+            if self._offsets[i] is not None:
+                self._offsets[i] = offsets[i]
+        self._items[known:known] = foreign
+        self._offsets[known:known] = offsets[known:known + len(foreign)]
+
+    def _persisted(self, path: Path, offsets: list[int]) -> None:
+        """Called by the session after writing, so that every command points at its record."""
+        self._path = path
+        self._offsets = list(offsets)
+        self.modified_from = None
+
+
+@dataclass
+class _JournalState:
+    footer_offset: int
+    offsets: list[int]
+    commands: MutableSequence[CommandData]
+    # The prompt in the header, for recovering a journal whose footer was cut off. Only a rewrite changes it.
+    prompt: str | None = None
+
+
+def _read_last_line(f: IO[bytes], end: int, block_size: int = 4096) -> tuple[int, bytes]:
+    """Returns the offset and content of the last line in the file, ignoring the final newline."""
+    position = end
+    tail = b""
+    while position > 0:
+        step = min(block_size, position)
+        position -= step
+        f.seek(position)
+        tail = f.read(step) + tail
+        newline = tail.rfind(b"\n", 0, len(tail) - 1)
+        if newline != -1:
+            return position + newline + 1, tail[newline + 1:]
+    return 0, tail
+
+
+@dataclass
+class ManifestEntry:
+    id: int
+    mtime: float
+    commands: int
+    title: str | None
+    next_id: int
+
+
+class SessionManifest:
+    """Append-only index of the sessions in a directory. The last line is always the most recently saved session."""
+    filename = "manifest.jsonl"
+    title_length = 80
+    save_dir: Path
+
+    def __init__(self, save_dir: Path):
+        self.save_dir = save_dir
+
+    @property
+    def path(self) -> Path:
+        return self.save_dir / self.filename
+
+    def is_fresh(self) -> bool:
+        # Creating, renaming or deleting a session file outside of the manifest changes the directory's mtime.
+        try:
+            return self.path.stat().st_mtime_ns >= self.save_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def last_entry(self) -> ManifestEntry | None:
+        try:
+            with self.path.open("rb") as f:
+                end = f.seek(0, os.SEEK_END)
+                _, line = _read_last_line(f, end)
+            return ManifestEntry(**json.loads(line))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+
+    def entries(self) -> dict[int, ManifestEntry]:
+        entries, lines = self._read()
+        if lines > 2 * len(entries) + 16:
+            with directory_lock(self.save_dir):  # Read again, in case a session was recorded meanwhile
+                entries, _ = self._read()
+                self._write(list(entries.values()))
+        return entries
+
+    def _read(self) -> tuple[dict[int, ManifestEntry], int]:
+        """The latest entry of every session, and the number of lines read."""
+        entries: dict[int, ManifestEntry] = {}
+        lines = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                try:
+                    entry = ManifestEntry(**json.loads(line))
+                except (ValueError, TypeError):
+                    continue
+                lines += 1
+                previous = entries.pop(entry.id, None)
+                if entry.title is None and previous is not None:
+                    entry.title = previous.title
+                entries[entry.id] = entry  # Re-inserting keeps the dict ordered by save time
+        return entries, lines
+
+    def record(self, session_id: int, commands: int, title: str | None, mtime: float) -> None:
+        last = self.last_entry()
+        next_id = max(session_id + 1, last.next_id if last is not None else 0)
+        entry = ManifestEntry(id=session_id, mtime=mtime, commands=commands, title=title, next_id=next_id)
+        with self.path.open("ab") as f:
+            f.write(_encode_record(asdict(entry)))
+
+    def rebuild(self, session_files: Iterable[Path]) -> None:
+        entries = []
+        for path in session_files:
+            session_id = int(path.name.split('.')[1])
+            commands, title = 0, None
+            try:
+                session = CommandSession.from_file(path)
+                commands = len(session.commands)
+                title = session.commands[0].command[:self.title_length] if commands else None
+            except (ValueError, KeyError, TypeError, OSError):
+                pass  # Unreadable sessions are still listed, so that their id isn't reused.
+            entries.append(ManifestEntry(id=session_id, mtime=path.stat().st_mtime, commands=commands,
+                                         title=title, next_id=0))
+        entries.sort(key=lambda entry: entry.mtime)
+        self._write(entries)
+
+    def _write(self, entries: list[ManifestEntry]) -> None:
+        next_id = 0
+        for entry in entries:
+            next_id = max(next_id, entry.id + 1, entry.next_id)
+            entry.next_id = next_id
+        atomic_write_bytes(self.path, b"".join(_encode_record(asdict(entry)) for entry in entries))
+        os.utime(self.path)  # The rename touched the directory, so the manifest has to be newer.
 
 
 @dataclass
@@ -18,80 +439,377 @@ class CommandSession:
     id: int
     prompt: str | None
     save_dir: str
-    commands: list[CommandData]
+    commands: MutableSequence[CommandData]
     context: list[int]
+    context_model: str | None = None
+    context_commands: int = 0
+    _journal: _JournalState | None = field(default=None, init=False, repr=False, compare=False)
+    # Modification time and size of the file, as this session last wrote or read it
+    _file_stat: tuple[int, int] | None = field(default=None, init=False, repr=False, compare=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
 
     @classmethod
     def make_filename(cls: type[Self], id: int) -> str:
+        return f"session.{id}.jsonl"
+
+    @classmethod
+    def make_legacy_filename(cls: type[Self], id: int) -> str:
         return f"session.{id}.json"
-    
+
     @property
     def filename(self) -> str:
         return self.make_filename(self.id)
 
-    def save(self) -> None:
-        path = Path(self.save_dir) / self.filename
-        path.write_text(json.dumps(asdict(self), indent=2))
-    
+    @property
+    def path(self) -> Path:
+        return Path(self.save_dir) / self.filename
+
+    def _header(self) -> bytes:
+        return _encode_record({"kind": "header", "version": JOURNAL_VERSION, "id": self.id, "prompt": self.prompt})
+
+    def _footer(self, offsets: list[int]) -> bytes:
+        return _encode_record({"kind": "footer", "prompt": self.prompt, "context": self.context,
+                               "context_model": self.context_model, "context_commands": self.context_commands,
+                               "offsets": offsets})
+
+    def _can_append(self) -> bool:
+        journal = self._journal
+        if journal is None or journal.commands is not self.commands or len(self.commands) < len(journal.offsets):
+            return False
+        if journal.prompt != self.prompt:
+            return False
+        if isinstance(self.commands, CommandList):
+            if self.commands.modified_from is not None and self.commands.modified_from < len(journal.offsets):
+                return False
+        return self.path.is_file()
+
+    def is_current(self) -> bool:
+        """Whether the session file is still the way this session last saw it."""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return False
+        return self._file_stat == (stat.st_mtime_ns, stat.st_size)
+
+    def copy(self) -> Self:
+        """A session that can be changed and saved independently of this one, as if the file was read again."""
+        commands = self.commands.copy() if isinstance(self.commands, CommandList) else \
+            [copy.copy(command) for command in self.commands]
+        session = replace(self, commands=commands, context=list(self.context))
+        journal = self._journal
+        if journal is not None and journal.commands is self.commands:
+            session._journal = replace(journal, offsets=list(journal.offsets), commands=commands)
+        session._file_stat = self._file_stat
+        return session
+
+    def _remember_file_stat(self, path: Path) -> None:
+        stat = path.stat()
+        self._file_stat = (stat.st_mtime_ns, stat.st_size)
+
+    def save(self, exclusive: bool = False) -> None:
+        """With exclusive, raises FileExistsError instead of overwriting a session file that already exists."""
+        with self._lock, directory_lock(Path(self.save_dir)):
+            if not exclusive:
+                self._merge_foreign_commands()
+            self._save(exclusive)
+
+    def _merge_foreign_commands(self) -> None:
+        """Another process saved this session since it was read here. Its new commands are inserted before the ones
+        added here, so that no command is lost."""
+        journal = self._journal
+        if journal is None or journal.commands is not self.commands or self.is_current() or not self.path.is_file():
+            return
+        try:
+            on_disk = type(self).from_file(self.path)
+        except (ValueError, KeyError, OSError):
+            self._journal = None  # Unreadable, so the whole session is written again
+            return
+        assert on_disk._journal is not None
+        known = len(journal.offsets)
+        if len(on_disk.commands) < known:
+            self._journal = None  # Not the session this one was read from
+            return
+        foreign = list(on_disk.commands[known:])
+        if isinstance(self.commands, CommandList):
+            self.commands._merge(known, foreign, on_disk._journal.offsets)
+        else:
+            self.commands[known:known] = foreign
+        self._journal = _JournalState(footer_offset=on_disk._journal.footer_offset,
+                                      offsets=list(on_disk._journal.offsets), commands=self.commands,
+                                      prompt=on_disk._journal.prompt)
+        if foreign:
+            # The model's context doesn't cover the inserted commands.
+            self.context, self.context_commands = [], 0
+
+    def _save(self, exclusive: bool = False) -> None:
+        manifest = SessionManifest(Path(self.save_dir))
+        manifest_fresh = manifest.is_fresh()
+        if not exclusive and self._can_append():
+            assert self._journal is not None
+            changed_from = len(self._journal.offsets)
+            self._append()
+        else:
+            changed_from = 0
+            self._rewrite(exclusive)
+        self._remember_file_stat(self.path)
+        legacy_path = Path(self.save_dir) / self.make_legacy_filename(self.id)
+        legacy_path.unlink(missing_ok=True)
+        # Imported here, because it imports this module
+        from search_index import update_index
+        update_index(self, changed_from)
+
+        if not manifest_fresh:
+            manifest.rebuild(SessionManager.find_session_files(Path(self.save_dir)))
+            return
+        title = None
+        if self.commands and (not isinstance(self.commands, CommandList) or self.commands.is_loaded(0)):
+            title = self.commands[0].command[:manifest.title_length]
+        manifest.record(self.id, len(self.commands), title, self.path.stat().st_mtime)
+
+    def _append(self) -> None:
+        assert self._journal is not None
+        offsets = self._journal.offsets
+        blobs = BlobStore.of(Path(self.save_dir))
+        with self.path.open("r+b") as f:
+            f.seek(self._journal.footer_offset)
+            f.truncate()
+            position = self._journal.footer_offset
+            for command in self.commands[len(offsets):]:
+                record = _command_record(command, blobs)
+                f.write(record)
+                offsets.append(position)
+                position += len(record)
+            f.write(self._footer(offsets))
+        self._journal.footer_offset = position
+        if isinstance(self.commands, CommandList):
+            self.commands._persisted(self.path, offsets)
+
+    def _rewrite(self, exclusive: bool = False) -> None:
+        """Writes the whole journal to a temporary file, which then replaces the old one. With exclusive,
+        the temporary file is linked to the session file instead, which fails if it exists."""
+        path = self.path
+        offsets: list[int] = []
+        blobs = BlobStore.of(Path(self.save_dir))
+        records = [self._header()]
+        position = len(records[0])
+        for command in self.commands:  # Reads any lazily loaded bodies before the old file is replaced
+            records.append(_command_record(command, blobs))
+            offsets.append(position)
+            position += len(records[-1])
+        records.append(self._footer(offsets))
+        atomic_write_bytes(path, b"".join(records), exclusive)
+        self._journal = _JournalState(footer_offset=position, offsets=offsets, commands=self.commands,
+                                      prompt=self.prompt)
+        if isinstance(self.commands, CommandList):
+            self.commands._persisted(path, offsets)
+
     @classmethod
     def from_file(cls: type[Self], path: Path) -> Self:  # TODO: Add error handling when file doesn't exist
+        if path.suffix == ".json":
+            return cls._from_legacy_file(path)
+
+        with path.open("rb") as f:
+            # Taken before reading, so that a write that happens meanwhile makes the session stale.
+            stat = os.fstat(f.fileno())
+            header = json.loads(f.readline())
+            if header.get("kind") != "header":
+                raise ValueError(f"{path} is not a {abbreviation} session journal.")
+            end = f.seek(0, os.SEEK_END)
+            footer_offset, line = _read_last_line(f, end)
+            try:
+                footer = json.loads(line)
+            except ValueError:
+                footer = None
+            if footer is None or footer.get("kind") != "footer":
+                # The last write was interrupted. Recover every complete command record.
+                footer_offset, footer = cls._recover_journal(f, header)
+
+        offsets = footer["offsets"]
+        commands = CommandList(path, offsets)
+        session = cls(id=header["id"], prompt=footer["prompt"], save_dir=str(path.parent),
+                      commands=commands, context=footer["context"],
+                      context_model=footer.get("context_model"), context_commands=footer.get("context_commands", 0))
+        session._journal = _JournalState(footer_offset=footer_offset, offsets=list(offsets), commands=commands,
+                                         prompt=header.get("prompt"))
+        session._file_stat = (stat.st_mtime_ns, stat.st_size)
+        return session
+
+    @staticmethod
+    def _recover_journal(f: IO[bytes], header: dict[str, Any]) -> tuple[int, dict[str, Any]]:
+        f.seek(0)
+        position = len(f.readline())
+        offsets: list[int] = []
+        for line in f:
+            try:
+                record = json.loads(line) if line.endswith(b"\n") else None
+            except ValueError:
+                record = None
+            if record is None or record.get("kind") != "command":
+                break
+            offsets.append(position)
+            position += len(line)
+        return position, {"kind": "footer", "prompt": header.get("prompt"), "context": [], "offsets": offsets}
+
+    @classmethod
+    def _from_legacy_file(cls: type[Self], path: Path) -> Self:
         session_dict = json.loads(path.read_text(encoding="utf-8"))
-        
+
         if session_dict["commands"] is not None:
             if not isinstance(session_dict["commands"], list):
                 raise TypeError(f"'commands' must be a list, not a {type(session_dict['commands']).__name__}.\n{session_dict['commands']=}")
             session_dict["commands"] = [CommandData(**command) for command in session_dict["commands"]]
 
         return cls(**session_dict)
-    
+
     @classmethod
     def from_id(cls: type[Self], save_dir: Path, id: int) -> Self:
-        return cls.from_file(save_dir / cls.make_filename(id))
+        path = save_dir / cls.make_filename(id)
+        legacy_path = save_dir / cls.make_legacy_filename(id)
+        if not path.exists() and legacy_path.exists():
+            return cls.from_file(legacy_path)
+        return cls.from_file(path)
 
 
 class SessionManager:
     path: Path
     sessions: list[CommandSession]
+    manifest: SessionManifest
+    _loaded: dict[int, CommandSession]
 
     def __init__(self, path: Path, new_session: bool = False):
         self.path = path
         self.path.mkdir(parents=False, exist_ok=True)
+        self.manifest = SessionManifest(self.path)
         self.sessions = []
+        self._loaded = {}
         if new_session:
             self.sessions.append(self.create_new_session())
-        
 
-    def get_session_files(self) -> list[Path]:
-        files = []
-        for path in self.path.iterdir():
-            if not path.is_file():
+    @staticmethod
+    def find_session_files(path: Path) -> list[Path]:
+        files: dict[int, Path] = {}
+        for file in path.iterdir():
+            if not file.is_file():
                 continue
-            parts = path.name.split('.')
-            # filename must have the form "session.<number>.json"
-            if len(parts) == 3 and parts[0] == "session" and parts[1].isdigit() and parts[2] == "json":
-                files.append(path)
-        return files
+            parts = file.name.split('.')
+            # filename must have the form "session.<number>.jsonl", or "session.<number>.json" for old sessions
+            if len(parts) == 3 and parts[0] == "session" and parts[1].isdigit() and parts[2] in ("jsonl", "json"):
+                session_id = int(parts[1])
+                if session_id not in files or parts[2] == "jsonl":
+                    files[session_id] = file
+        return list(files.values())
+
+    def get_session_files(self) -> list[Path]:
+        return self.find_session_files(self.path)
+
+    def _fresh_manifest(self) -> SessionManifest:
+        if not self.manifest.path.exists():
+            # Versions without a manifest saved sessions as JSON, so this is the first run since an update.
+            self.migrate_legacy_sessions()
+        if not self.manifest.is_fresh():
+            # Under the lock, so that a session saved meanwhile isn't left out of the rebuilt manifest.
+            with directory_lock(self.path):
+                if not self.manifest.is_fresh():
+                    self.manifest.rebuild(self.get_session_files())
+        return self.manifest
+
+    def session_path(self, session_id: int) -> Path:
+        path = self.path / CommandSession.make_filename(session_id)
+        legacy_path = self.path / CommandSession.make_legacy_filename(session_id)
+        return legacy_path if not path.exists() and legacy_path.exists() else path
+
+    def list_sessions(self) -> list[ManifestEntry]:
+        """Returns every session, with the most recently saved last."""
+        manifest = self._fresh_manifest()
+        return list(manifest.entries().values()) if manifest.path.exists() else []
 
     def create_new_session(self, prompt: str | None = None) -> CommandSession:
-        existing_ids = [int(p.name.split('.')[1]) for p in self.get_session_files()]
-        new_id = (0 if not existing_ids else max(existing_ids) + 1)
-        session = CommandSession(id=new_id, prompt=prompt, save_dir=str(self.path), commands=[], context=[])
-        session.save()
+        last = self._fresh_manifest().last_entry()
+        new_id = 0 if last is None else last.next_id
+        while True:
+            # The manifest can't see files created by other processes within the same filesystem timestamp tick,
+            # and they might take the same id at the same time, so the file is created only if it doesn't exist.
+            session = CommandSession(id=new_id, prompt=prompt, save_dir=str(self.path), commands=[], context=[])
+            try:
+                if self.session_path(new_id).exists():
+                    raise FileExistsError(self.session_path(new_id))
+                session.save(exclusive=True)
+                break
+            except FileExistsError:
+                new_id += 1
         self.sessions.append(session)
+        self._loaded[new_id] = session.copy()
         return session
-    
+
     def find_most_recent_session(self) -> Path | None:
-        session_files = self.get_session_files()
-        return max(session_files, key=lambda p: p.stat().st_mtime, default=None)
-    
+        last = self._fresh_manifest().last_entry()
+        if last is None:
+            return None
+        path = self.session_path(last.id)
+        if not path.exists():  # pragma: no cover - deleting a file always makes the manifest stale
+            with directory_lock(self.path):
+                self.manifest.rebuild(self.get_session_files())
+            return max(self.get_session_files(), key=lambda p: p.stat().st_mtime, default=None)
+        return path
+
     def load_most_recent_session(self) -> CommandSession:
         session_path = self.find_most_recent_session()
         if session_path is None:
             return self.create_new_session()
-        
-        session = CommandSession.from_file(session_path)
+
+        session = self._load_file(session_path)
         self.sessions.append(session)
         return session
-    
+
+    def _load_file(self, path: Path) -> CommandSession:
+        """Loads a session, reusing the one loaded earlier if its file hasn't changed since.
+        This matters for long-lived managers, like the one in the daemon. Every call gets its own copy, so that
+        the invocations of the daemon don't change each other's session, and their saves are merged like those
+        of different processes."""
+        session_id = int(path.name.split('.')[1])
+        session = self._loaded.get(session_id)
+        if session is None or not session.is_current():
+            session = CommandSession.from_file(path)
+            self._loaded[session_id] = session
+        return session.copy()
+
     def load(self, session_id: int) -> CommandSession:
-        return CommandSession.from_id(self.path, session_id)
+        return self._load_file(self.session_path(int(session_id)))
+
+    def collect_garbage(self) -> tuple[int, int]:
+        """Removes the stdin blobs that no session refers to any more. Returns the number of blobs removed,
+        and the bytes they took."""
+        with directory_lock(self.path):  # Saving writes blobs under the same lock
+            referenced = set()
+            for path in self.get_session_files():
+                if path.suffix != ".jsonl":
+                    continue
+                with path.open("rb") as f:
+                    for line in f:
+                        if b'"stdin_blob"' not in line:
+                            continue
+                        try:
+                            referenced.add(json.loads(line)["stdin_blob"]["hash"])
+                        except (ValueError, KeyError, TypeError):
+                            pass
+            return BlobStore.of(self.path).remove_unreferenced(referenced)
+
+    def migrate_legacy_sessions(self) -> list[int]:
+        """Converts every "session.<id>.json" file into a journal, keeping its modification time. Files that can't
+        be read are left as they are."""
+        migrated = []
+        for path in self.get_session_files():
+            if path.suffix != ".json":
+                continue
+            try:
+                stat = path.stat()
+                session = CommandSession.from_file(path)
+            except (ValueError, KeyError, TypeError, OSError):
+                continue  # Unreadable, or migrated by another process meanwhile
+            session.save()
+            os.utime(session.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            migrated.append(session.id)
+        if migrated:
+            with directory_lock(self.path):
+                self.manifest.rebuild(self.get_session_files())
+        return sorted(migrated)
@@ -0,0 +1,74 @@
+import argparse
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any
+from abbreviation import abbreviation
+
+
+def default_config_path() -> Path:
+    return Path.home() / f"{abbreviation}-assistant" / "config.json"
+
+
+def load_config(path: Path) -> dict[str, Any]:
+    """Reads the settings file. Its keys are the long names of the command line options, like "model"."""
+    if not path.is_file():
+        return {}
+    config = json.loads(path.read_text(encoding="utf-8"))
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} must contain a JSON object, not a {type(config).__name__}.")
+    return config
+
+
+def parse_option(text: str) -> tuple[str, Any]:
+    """Parses KEY=VALUE. Values are read as JSON if possible, so that numbers and booleans keep their type."""
+    key, separator, value = text.partition("=")
+    if not separator or not key:
+        raise argparse.ArgumentTypeError(f"options must have the form KEY=VALUE, not '{text}'")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def setting(args: argparse.Namespace, config: dict[str, Any], name: str, default: Any = None) -> Any:
+    """The command line wins over the config file, which wins over the default."""
+    value = getattr(args, name, None)
+    if value is not None:
+        return value
+    return config.get(name, default)
+
+
+def parse_hours(text: str) -> tuple[int, int]:
+    """Parses hours like "8-19", from the start of the first to the start of the second. "22-6" spans midnight."""
+    start, separator, end = text.partition("-")
+    try:
+        hours = int(start), int(end)
+    except ValueError:
+        hours = (-1, -1)
+    if not separator or not all(0 <= hour <= 24 for hour in hours) or hours[0] == hours[1]:
+        raise ValueError(f"Expected active hours like \"8-19\", not '{text}'.")
+    return hours
+
+
+def keep_alive(value: Any, now: datetime | None = None) -> str | float | None:
+    """How long the model server should keep the model loaded after a request, from the "keep_alive" setting:
+    a duration like "30m", seconds, or active hours like {"hours": "8-19", "outside": "5m"}. During the active
+    hours, the model stays loaded until they end. Outside of them, it stays for "outside", which defaults to
+    the server's own default."""
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value  # A duration like "30m"
+    if not isinstance(value, dict):
+        return None if value is None else float(value)
+    start, end = parse_hours(str(value.get("hours", "")))
+    now = now if now is not None else datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in (-1, 0):  # Hours that span midnight might have started yesterday.
+        active_from = midnight + timedelta(days=day, hours=start)
+        active_until = midnight + timedelta(days=day + (end < start), hours=end)
+        if active_from <= now < active_until:
+            return round((active_until - now).total_seconds())
+    return keep_alive(value.get("outside"))
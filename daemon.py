@@ -0,0 +1,162 @@
+import argparse
+import codecs
+import fcntl
+import io
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import TextIO, cast
+from abbreviation import abbreviation
+from command_data import SessionManager
+from kj_client import FRAME_HEADER, STDOUT, STDERR, EXIT, PROTOCOL_VERSION, default_socket_path
+from shell import shell
+
+DEFAULT_IDLE_TIMEOUT = 15 * 60.0
+
+
+class SocketStdin(io.TextIOBase):
+    """stdin of a client, read from the connection. It has no fileno, so that nothing bypasses the buffer."""
+    def __init__(self, rfile: io.BufferedReader):
+        self._rfile = rfile
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> str:
+        if size is None or size < 0:
+            return self._decoder.decode(self._rfile.read(), final=True)
+        while True:
+            data = self._rfile.read1(size)
+            text = self._decoder.decode(data, final=not data)
+            if text or not data:
+                return text
+
+
+class FrameWriter(io.TextIOBase):
+    """stdout or stderr of a client. Every write is sent right away as one frame."""
+    def __init__(self, sock: socket.socket, kind: bytes, lock: threading.Lock, tty: bool = False):
+        self._sock = sock
+        self._kind = kind
+        self._lock = lock
+        self._tty = tty
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._tty
+
+    def write(self, text: str) -> int:
+        if text:
+            send_frame(self._sock, self._kind, text.encode("utf-8", errors="replace"), self._lock)
+        return len(text)
+
+
+def send_frame(sock: socket.socket, kind: bytes, payload: bytes, lock: threading.Lock) -> None:
+    with lock:
+        sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+class KjDaemon:
+    """Serves kj invocations from a Unix socket. Session managers, loaded sessions and the connections to
+    the model server stay warm between invocations. Stops after idle_timeout seconds without clients."""
+    socket_path: Path
+    idle_timeout: float
+    session_managers: dict[Path, SessionManager]
+    active: int
+    last_activity: float
+
+    def __init__(self, socket_path: Path, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.session_managers = {}
+        self.active = 0
+        self.last_activity = time.monotonic()
+        self._state_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def handle(self, conn: socket.socket) -> None:
+        send_lock = threading.Lock()
+        code = 1
+        try:
+            with conn, conn.makefile("rb") as rfile:
+                header = json.loads(rfile.readline())
+                stderr = FrameWriter(conn, STDERR, send_lock)
+                if header.get("protocol") != PROTOCOL_VERSION:
+                    stderr.write(f"This {abbreviation} daemon speaks protocol {PROTOCOL_VERSION}, "
+                                 f"not {header.get('protocol')}. Stop it to get a new one.\n")
+                else:
+                    try:
+                        code = shell(header["argv"], stdin=cast(TextIO, SocketStdin(rfile)),
+                                     stdout=cast(TextIO, FrameWriter(conn, STDOUT, send_lock, header.get("tty", False))),
+                                     stderr=cast(TextIO, stderr),
+                                     history=header.get("history") or "", session_managers=self.session_managers,
+                                     cwd=Path(header["cwd"]))
+                    except SystemExit as e:
+                        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+                    except Exception:
+                        stderr.write(traceback.format_exc())
+                send_frame(conn, EXIT, str(code).encode(), send_lock)
+        except OSError:
+            pass  # The client went away
+        finally:
+            with self._state_lock:
+                self.active -= 1
+                self.last_activity = time.monotonic()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        # Only one daemon can hold the lock, so racing clients can't start two of them.
+        with open(self.socket_path.with_suffix(".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self.socket_path.unlink(missing_ok=True)  # Left over from a daemon that was killed
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+                server.bind(str(self.socket_path))
+                os.chmod(self.socket_path, 0o600)
+                server.listen()
+                server.settimeout(poll_interval)
+                try:
+                    self._accept_loop(server)
+                finally:
+                    self.socket_path.unlink(missing_ok=True)
+
+    def _accept_loop(self, server: socket.socket) -> None:
+        while not self._stopped.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                with self._state_lock:
+                    if self.active == 0 and time.monotonic() - self.last_activity > self.idle_timeout:
+                        return
+                continue
+            conn.settimeout(None)
+            with self._state_lock:
+                self.active += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog=f"{abbreviation}-daemon")
+    parser.add_argument("--socket", default=str(default_socket_path()), help="path of the Unix socket to listen on")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT, metavar="SECONDS",
+                        help="stop after this many seconds without clients")
+    args = parser.parse_args()
+    daemon = KjDaemon(Path(args.socket), args.idle_timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
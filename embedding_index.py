@@ -0,0 +1,366 @@
+import json
+import re
+import shutil
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Protocol, Sequence, TYPE_CHECKING
+from command_data import CommandData, CommandSession, SessionManager, atomic_write_bytes, directory_lock
+from ollamaapi import StatusError
+
+if TYPE_CHECKING:
+    # numpy takes longer to import than kj itself, so it is only imported when the index is used.
+    import numpy as np
+    import numpy.typing as npt
+    Matrix = npt.NDArray[np.float32]
+
+# The characters of a command that its embedding is made of. The start and end of long stdin are used.
+EMBEDDING_TEXT_LENGTH = 2000
+STDIN_LENGTH = 1000
+# --related embeds the new command, and the ones not indexed yet, before the answer starts, so it must not wait long.
+EMBED_TIMEOUT = (3.05, 30.0)
+# Rows of replaced or deleted commands are removed once there are this many, and more than live rows.
+MIN_COMPACTION_ROWS = 1000
+
+
+def embedding_text(command: CommandData) -> str:
+    stdin = command.stdin
+    if len(stdin) > STDIN_LENGTH:
+        stdin = stdin[:STDIN_LENGTH // 2] + "\n" + stdin[-STDIN_LENGTH // 2:]
+    return f"{command.command}\n{stdin}\n{command.ai_response}"[:EMBEDDING_TEXT_LENGTH]
+
+
+def normalized(vectors: "Matrix") -> "Matrix":
+    """Scales the rows to unit length in place, so that their dot product is their cosine similarity."""
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+
+class Embedder(Protocol):
+    name: str
+    # Commands less similar than this to the query are unrelated to it
+    min_similarity: float
+
+    def spec(self) -> dict[str, Any]:
+        """What the index records about the embedder, to make the same one again."""
+        ...
+
+    def embed(self, texts: Sequence[str]) -> "Matrix":
+        """One row of unit length per text."""
+        ...
+
+
+class HashingEmbedder:
+    """Embeds texts without a model, by hashing their words and pairs of words into a fixed number of dimensions.
+    It finds commands with the same program names, paths and error messages, which is most of what is worth finding."""
+    name = "hashing"
+    min_similarity = 0.2
+    dimensions: int
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def spec(self) -> dict[str, Any]:
+        return {"name": self.name, "dimensions": self.dimensions}
+
+    def embed(self, texts: Sequence[str]) -> "Matrix":
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for token in [*words, *(f"{a} {b}" for a, b in zip(words, words[1:]))]:
+                hashed = zlib.crc32(token.encode("utf-8", "surrogatepass"))
+                # The sign spreads the collisions of different tokens around zero.
+                vectors[row, hashed % self.dimensions] += 1.0 if hashed & 0x80000000 else -1.0
+        return normalized(vectors)
+
+
+class OllamaEmbedder:
+    """Embeds texts with an embedding model of an Ollama server."""
+    name = "ollama"
+    min_similarity = 0.5
+    model: str
+    endpoint: str
+
+    def __init__(self, model: str = "nomic-embed-text", endpoint: str = "http://localhost:11434"):
+        self.model = model
+        self.endpoint = endpoint.rstrip("/")
+
+    def spec(self) -> dict[str, Any]:
+        return {"name": self.name, "model": self.model, "endpoint": self.endpoint}
+
+    def embed(self, texts: Sequence[str]) -> "Matrix":
+        import numpy as np
+        from ollamaapi import get_http_session
+        response = get_http_session().post(f"{self.endpoint}/api/embed",
+                                           data=json.dumps({"model": self.model, "input": list(texts)}),
+                                           headers={"Content-Type": "application/json"}, timeout=EMBED_TIMEOUT)
+        if response.status_code != 200:
+            raise StatusError(response.status_code, response.text)
+        return normalized(np.asarray(response.json()["embeddings"], dtype=np.float32).reshape(len(texts), -1))
+
+
+EMBEDDERS: dict[str, type[HashingEmbedder] | type[OllamaEmbedder]] = {
+    embedder.name: embedder for embedder in (HashingEmbedder, OllamaEmbedder)}
+
+
+def make_embedder(name: str, **settings: Any) -> Embedder:
+    """settings that are None are left at their defaults."""
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder '{name}'. Choose one of: {', '.join(EMBEDDERS)}")
+    embedder: Embedder = EMBEDDERS[name](**{key: value for key, value in settings.items() if value is not None})
+    return embedder
+
+
+@dataclass
+class RelatedCommand:
+    session: int
+    position: int
+    command: CommandData
+    score: float
+
+
+class EmbeddingIndex:
+    """Embeddings of the commands of every session in a directory, for finding the earlier commands that are most
+    like a new one. The vectors are rows of a float32 matrix in one file, which is memory-mapped to compare them
+    all with the query in one product, and another file holds the session and position of each row. Rows are only
+    appended: when a session is embedded again or deleted, its old rows get the session -1, and are removed once
+    they make up most of the file."""
+    dirname = "embeddings"
+    save_dir: Path
+    path: Path
+    embedder: Embedder
+
+    def __init__(self, save_dir: Path, embedder: Embedder):
+        self.save_dir = save_dir
+        # In its own directory, like the search index, so that writing it doesn't make the manifest stale.
+        self.path = save_dir / self.dirname
+        self.embedder = embedder
+
+    @classmethod
+    def open(cls, save_dir: Path) -> "EmbeddingIndex | None":
+        """The index of the directory, or None if there isn't one."""
+        try:
+            meta = json.loads((save_dir / cls.dirname / "meta.json").read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        spec = dict(meta["embedder"])
+        return cls(save_dir, make_embedder(spec.pop("name"), **spec))
+
+    @classmethod
+    def create(cls, save_dir: Path, embedder: Embedder) -> "EmbeddingIndex":
+        """Opens the index of the directory, starting a new one if there is none, or it was made by another
+        embedder. The sessions are embedded by the next refresh."""
+        import numpy  # noqa: F401 - fails early if numpy is missing
+        index = cls(save_dir, embedder)
+        with directory_lock(save_dir):
+            existing = cls.open(save_dir)
+            if existing is None or existing.embedder.spec() != embedder.spec():
+                shutil.rmtree(index.path, ignore_errors=True)
+                index.path.mkdir()
+                index._write_meta(0)
+        return index
+
+    def _replace(self, name: str, data: bytes) -> None:
+        # Renamed into place, so that a search that already read the old file can finish with it.
+        atomic_write_bytes(self.path / name, data)
+
+    def _write_meta(self, dimensions: int) -> None:
+        self._replace("meta.json", json.dumps({"embedder": self.embedder.spec(), "dimensions": dimensions}).encode())
+
+    def _dimensions(self) -> int:
+        meta = json.loads((self.path / "meta.json").read_text(encoding="utf-8"))
+        return int(meta.get("dimensions", 0))
+
+    def _rows(self, dimensions: int) -> int:
+        """The number of complete rows. A write that was cut off leaves a part of a row, or a vector without ids."""
+        try:
+            vectors = (self.path / "vectors.f32").stat().st_size
+            ids = (self.path / "ids.i32").stat().st_size
+        except FileNotFoundError:
+            return 0
+        return min(vectors // (4 * dimensions), ids // 8) if dimensions else 0
+
+    def _ids(self) -> "npt.NDArray[np.int32]":
+        import numpy as np
+        rows = self._rows(self._dimensions())
+        if not rows:
+            return np.zeros((0, 2), dtype=np.int32)
+        return np.fromfile(self.path / "ids.i32", dtype=np.int32, count=rows * 2).reshape(rows, 2)
+
+    def _mtimes(self) -> "npt.NDArray[np.float64]":
+        """The mtime of each session's file when it was embedded, by session id. 0 for sessions that aren't."""
+        import numpy as np
+        try:
+            return np.fromfile(self.path / "mtimes.f64", dtype=np.float64)
+        except FileNotFoundError:
+            return np.zeros(0, dtype=np.float64)
+
+    def _set_mtimes(self, changes: dict[int, float]) -> None:
+        import numpy as np
+        mtimes = self._mtimes()
+        if changes and max(changes) >= len(mtimes):
+            mtimes = np.concatenate([mtimes, np.zeros(max(changes) + 1 - len(mtimes))])
+        for session_id, mtime in changes.items():
+            mtimes[session_id] = mtime
+        self._replace("mtimes.f64", mtimes.tobytes())
+
+    def _remove(self, ids: "npt.NDArray[np.int32]", session_id: int) -> None:
+        """Marks the rows of the session as replaced, in the file and in ids."""
+        import numpy as np
+        rows = np.flatnonzero(ids[:, 0] == session_id)
+        if not len(rows):
+            return
+        ids[rows] = -1
+        with (self.path / "ids.i32").open("r+b") as f:
+            for row in rows:
+                f.seek(int(row) * 8)
+                f.write(ids[row].tobytes())
+
+    def _append(self, ids: "npt.NDArray[np.int32]", session_id: int, start: int,
+                vectors: "Matrix") -> "npt.NDArray[np.int32]":
+        """Stores the vectors of the commands of a session from start on, returning the ids with theirs."""
+        import numpy as np
+        if not len(ids):
+            self._write_meta(vectors.shape[1])
+        for name, size in (("vectors.f32", 4 * vectors.shape[1]), ("ids.i32", 8)):
+            with (self.path / name).open("ab") as f:
+                f.truncate(len(ids) * size)
+        new_ids = np.empty((len(vectors), 2), dtype=np.int32)
+        new_ids[:, 0] = session_id
+        new_ids[:, 1] = np.arange(start, start + len(vectors))
+        # The ids are written last, so that a row only counts once its vector is complete.
+        with (self.path / "vectors.f32").open("ab") as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        with (self.path / "ids.i32").open("ab") as f:
+            f.write(new_ids.tobytes())
+        return np.concatenate([ids, new_ids])
+
+    def add(self, session_id: int, start: int, vectors: "Matrix", mtime: float) -> None:
+        """Stores vectors made elsewhere for the commands of a session from start on. Must be called under the
+        directory lock."""
+        self._append(self._ids(), session_id, start, vectors)
+        self._set_mtimes({session_id: mtime})
+
+    @staticmethod
+    def _counts(ids: "npt.NDArray[np.int32]") -> dict[int, int]:
+        """The number of embedded commands of each session."""
+        import numpy as np
+        sessions, counts = np.unique(ids[ids[:, 0] >= 0, 0], return_counts=True)
+        return dict(zip(sessions.tolist(), counts.tolist()))
+
+    def refresh(self, session_manager: SessionManager) -> int:
+        """Embeds the sessions that changed since they were embedded, according to the manifest, and forgets
+        deleted ones. Returns the number of sessions embedded. The embedder runs before the directory lock is
+        taken, so that a slow model server doesn't hold up saving. If it fails, the sessions embedded until then
+        are stored, and the error is raised."""
+        # Every save appends to the manifest, so if it didn't change, neither did the sessions.
+        manifest = session_manager.manifest
+        manifest_stat = ""
+        if manifest.is_fresh():
+            stat = manifest.path.stat()
+            manifest_stat = f"{stat.st_mtime_ns}:{stat.st_size}"
+            if self._read_text("refreshed") == manifest_stat:
+                return 0
+        # Before taking the lock, because the manifest is rebuilt under it if it is stale.
+        entries = session_manager.list_sessions()
+        mtimes = self._mtimes()
+        counts = self._counts(self._ids())
+        # The session, its embedded commands when this started, the first command embedded now, and its vectors
+        pending: list[tuple[int, int, int, "Matrix | None", float]] = []
+        error: Exception | None = None
+        for entry in entries:
+            count = counts.get(entry.id, 0)
+            if entry.id < len(mtimes) and (mtimes[entry.id], count) == (entry.mtime, entry.commands):
+                continue
+            # Commands are appended to sessions, so only the new ones are embedded, unless there are fewer.
+            start = count if count < entry.commands else 0
+            try:
+                commands = list(CommandSession.from_file(session_manager.session_path(entry.id)).commands)[start:]
+            except (ValueError, KeyError, TypeError, OSError):
+                start, commands = 0, []
+            try:
+                vectors = self.embedder.embed([embedding_text(command) for command in commands]) if commands else None
+            except (OSError, ValueError) as e:
+                error = e
+                break
+            pending.append((entry.id, count, start, vectors, entry.mtime))
+        live = {entry.id for entry in entries}
+        with directory_lock(self.save_dir):
+            ids = self._ids()
+            counts = self._counts(ids)
+            changes: dict[int, float] = {}
+            for session_id, count, start, vectors, mtime in pending:
+                if counts.get(session_id, 0) != count:
+                    continue  # Another process embedded it meanwhile
+                if start == 0:
+                    self._remove(ids, session_id)
+                if vectors is not None:
+                    ids = self._append(ids, session_id, start, vectors)
+                changes[session_id] = mtime
+            for session_id in set(counts) - live:
+                self._remove(ids, session_id)
+                changes[session_id] = 0.0
+            self._set_mtimes(changes)
+            self._compact(ids)
+            if error is None:
+                self._replace("refreshed", manifest_stat.encode())
+        if error is not None:
+            raise error
+        return len(pending)
+
+    def _read_text(self, name: str) -> str | None:
+        try:
+            return (self.path / name).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def _compact(self, ids: "npt.NDArray[np.int32]") -> None:
+        import numpy as np
+        keep = ids[:, 0] >= 0
+        dead = len(ids) - int(keep.sum())
+        if dead < max(len(ids) - dead, MIN_COMPACTION_ROWS):
+            return
+        vectors = np.memmap(self.path / "vectors.f32", dtype=np.float32, mode="r",
+                            shape=(len(ids), self._dimensions()))
+        self._replace("vectors.f32", vectors[keep].tobytes())
+        self._replace("ids.i32", ids[keep].tobytes())
+
+    def search(self, text: str, limit: int) -> list[tuple[int, int, float]]:
+        """The session, position and cosine similarity of the commands most similar to text, best first."""
+        import numpy as np
+        query = self.embedder.embed([text])[0]
+        with directory_lock(self.save_dir):
+            dimensions = self._dimensions()
+            ids = self._ids()
+            if not len(ids) or dimensions != len(query):
+                return []
+            vectors = np.memmap(self.path / "vectors.f32", dtype=np.float32, mode="r", shape=(len(ids), dimensions))
+        scores = vectors @ query
+        scores[ids[:, 0] < 0] = -np.inf
+        top = np.argpartition(-scores, limit - 1)[:limit] if len(scores) > limit else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[row, 0]), int(ids[row, 1]), float(scores[row])) for row in top
+                if scores[row] >= self.embedder.min_similarity]
+
+
+def related_commands(session_manager: SessionManager, index: EmbeddingIndex, command: CommandData,
+                     limit: int) -> list[RelatedCommand]:
+    """The earlier commands of any session that are most like command, best first. The sessions are embedded
+    here, rather than when they are saved, so that only --related waits for the embedder."""
+    try:
+        index.refresh(session_manager)
+    except (OSError, ValueError):
+        pass  # Search what was embedded before
+    related = []
+    for session_id, position, score in index.search(embedding_text(command), limit):
+        try:
+            commands = session_manager.load(session_id).commands
+            related.append(RelatedCommand(session_id, position, commands[position], score))
+        except (ValueError, KeyError, TypeError, OSError, IndexError):
+            pass  # Changed since it was embedded
+    return related
+
@@ -0,0 +1,216 @@
+import statistics
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, ClassVar, Generator, Iterable, Self, TypeVar
+from command_data import read_stats, write_stats
+from ollamaapi import Cancelled, StatusError
+
+T = TypeVar("T")
+
+# An endpoint that failed is skipped for this long, doubling with every failure in a row
+RETRY_AFTER = 5.0
+MAX_RETRY_AFTER = 300.0
+LATENCY_SAMPLES = 20
+HEALTH_CHECK_TIMEOUT = (1.0, 2.0)
+
+
+def should_fail_over(error: BaseException) -> bool:
+    """Whether another endpoint might answer a request that failed with error before the first chunk.
+    A refused connection or a server error might not happen there, but a bad request would."""
+    return isinstance(error, OSError) and not isinstance(error, Cancelled) \
+        and not (isinstance(error, StatusError) and error.status < 500)
+
+
+@dataclass
+class EndpointStats:
+    url: str
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    down_until: float = 0.0
+    # Recent times from sending a request to its first chunk, in seconds
+    latencies: list[float] = field(default_factory=list)
+    # Requests in progress in this process
+    outstanding: int = 0
+    checked: bool = False
+
+    @property
+    def latency(self) -> float | None:
+        return statistics.median(self.latencies) if self.latencies else None
+
+    def is_down(self, now: float) -> bool:
+        return self.down_until > now
+
+    def report(self, now: float) -> str:
+        latency = f"{self.latency * 1000:.0f} ms to the first chunk" if self.latency is not None else "no latency yet"
+        state = f"down for {self.down_until - now:.0f} s" if self.is_down(now) else "up"
+        return f"{self.url}: {state}, {self.requests} requests, {self.failures} failed, {latency}"
+
+
+class EndpointPool:
+    """Several servers of the same model. Requests go to the endpoint with the fewest requests in progress,
+    then the lowest latency, and skip endpoints that failed recently. Pools are shared by the backends of a
+    process, like those of the daemon's concurrent invocations, and their statistics can be kept in a file."""
+    _shared: ClassVar[dict[tuple[tuple[str, ...], str], "EndpointPool"]] = {}
+    _shared_lock: ClassVar[threading.Lock] = threading.Lock()
+    endpoints: list[EndpointStats]
+    health_path: str
+    state_path: Path | None
+    _lock: threading.Lock
+
+    def __init__(self, urls: Iterable[str], health_path: str = "/"):
+        self.endpoints = [EndpointStats(url) for url in urls]
+        if not self.endpoints:
+            raise ValueError("An endpoint pool needs at least one endpoint.")
+        self.health_path = health_path
+        self.state_path = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls: type[Self], urls: Iterable[str], health_path: str = "/") -> "EndpointPool":
+        key = (tuple(urls), health_path)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(key[0], health_path)
+            return cls._shared[key]
+
+    def _stats(self, url: str) -> EndpointStats:
+        return next(endpoint for endpoint in self.endpoints if endpoint.url == url)
+
+    def ranked(self) -> list[str]:
+        """The endpoints in the order to try them. Endpoints that are down come last, in case all of them are."""
+        now = time.time()
+        with self._lock:
+            order = {endpoint.url: i for i, endpoint in enumerate(self.endpoints)}
+            up = sorted((endpoint for endpoint in self.endpoints if not endpoint.is_down(now)),
+                        key=lambda endpoint: (endpoint.outstanding, endpoint.latency or 0.0, order[endpoint.url]))
+            down = sorted((endpoint for endpoint in self.endpoints if endpoint.is_down(now)),
+                          key=lambda endpoint: endpoint.down_until)
+        return [endpoint.url for endpoint in up + down]
+
+    def up(self) -> list[str]:
+        now = time.time()
+        with self._lock:
+            return [endpoint.url for endpoint in self.endpoints if not endpoint.is_down(now)]
+
+    def stream(self, request: Callable[[str], Generator[T, None, None]]) -> Generator[T, None, None]:
+        """Streams request from the endpoints in turn, until one of them yields something. An endpoint that fails
+        before that is recorded as failed, and the next one is tried if it might do better. The time to the first
+        item is recorded as the latency of the endpoint."""
+        urls = self.ranked()
+        for i, url in enumerate(urls):
+            start, received, failed = time.perf_counter(), False, False
+            self.started(url)
+            try:
+                with closing(request(url)) as items:
+                    for item in items:
+                        if not received:
+                            received = True
+                            self.first_chunk(url, time.perf_counter() - start)
+                        yield item
+                return
+            except Cancelled:
+                raise  # Not the endpoint's failure
+            except OSError as e:
+                failed = True
+                if received or not should_fail_over(e) or i == len(urls) - 1:
+                    raise
+            finally:
+                self.finished(url, failed)
+
+    def started(self, url: str) -> None:
+        with self._lock:
+            endpoint = self._stats(url)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+
+    def first_chunk(self, url: str, seconds: float) -> None:
+        with self._lock:
+            endpoint = self._stats(url)
+            endpoint.latencies = [*endpoint.latencies, seconds][-LATENCY_SAMPLES:]
+
+    def finished(self, url: str, failed: bool) -> None:
+        with self._lock:
+            endpoint = self._stats(url)
+            endpoint.outstanding -= 1
+            self._record(endpoint, failed)
+        self.save()
+
+    def _record(self, endpoint: EndpointStats, failed: bool) -> None:
+        if failed:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            retry_after = min(RETRY_AFTER * 2 ** (endpoint.consecutive_failures - 1), MAX_RETRY_AFTER)
+            endpoint.down_until = time.time() + retry_after
+        else:
+            endpoint.consecutive_failures = 0
+            endpoint.down_until = 0.0
+
+    def check(self, url: str) -> bool:
+        """Asks the endpoint if it is running. Any answer but a server error counts."""
+        from ollamaapi import get_http_session
+        try:
+            response = get_http_session().get(f"{url}{self.health_path}", timeout=HEALTH_CHECK_TIMEOUT)
+            healthy = response.status_code < 500
+        except OSError:
+            healthy = False
+        with self._lock:
+            endpoint = self._stats(url)
+            endpoint.checked = True
+            self._record(endpoint, not healthy)
+        return healthy
+
+    def check_all(self, urls: Iterable[str] | None = None) -> None:
+        """Checks the endpoints at the same time."""
+        threads = [threading.Thread(target=self.check, args=(url,), daemon=True)
+                   for url in (urls if urls is not None else [endpoint.url for endpoint in self.endpoints])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.save()
+
+    def check_in_background(self) -> threading.Thread:
+        """Checks the endpoints this pool knows nothing about, or whose time to be skipped is over, while kj does
+        other things, so that the request doesn't have to wait for an endpoint that doesn't answer."""
+        now = time.time()
+        with self._lock:
+            urls = [endpoint.url for endpoint in self.endpoints
+                    if endpoint.requests == 0 and not endpoint.checked
+                    or endpoint.down_until and not endpoint.is_down(now)]
+        thread = threading.Thread(target=self.check_all, args=(urls,), daemon=True)
+        thread.start()
+        return thread
+
+    def report(self) -> str:
+        now = time.time()
+        with self._lock:
+            return "\n".join(endpoint.report(now) for endpoint in self.endpoints)
+
+    def load(self, path: Path) -> None:
+        """Reads the statistics of earlier processes, and keeps them in path from now on."""
+        with self._lock:
+            if self.state_path == path:
+                return
+            self.state_path = path
+            state = read_stats(path)
+            for endpoint in self.endpoints:
+                saved = state.get(endpoint.url, {})
+                endpoint.requests = saved.get("requests", 0)
+                endpoint.failures = saved.get("failures", 0)
+                endpoint.consecutive_failures = saved.get("consecutive_failures", 0)
+                endpoint.down_until = saved.get("down_until", 0.0)
+                endpoint.latencies = saved.get("latencies", [])
+
+    def save(self) -> None:
+        if self.state_path is None:
+            return
+        with self._lock:
+            state = {endpoint.url: {"requests": endpoint.requests, "failures": endpoint.failures,
+                                    "consecutive_failures": endpoint.consecutive_failures,
+                                    "down_until": endpoint.down_until, "latencies": endpoint.latencies}
+                     for endpoint in self.endpoints}
+        write_stats(self.state_path, state)
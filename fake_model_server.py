@@ -0,0 +1,160 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Self
+
+
+def _json_line(record: dict[str, Any]) -> bytes:
+    return json.dumps(record).encode() + b"\n"
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        if not isinstance(sys.exc_info()[1], ConnectionError):  # Clients close pooled connections at any time
+            super().handle_error(request, client_address)
+
+
+class FakeModelServer:
+    """Local stand-in for Ollama and OpenAI compatible servers, for tests and benchmarks. Streams `tokens` words
+    after waiting `latency` seconds, at `tokens_per_second` (0 for as fast as possible), in chunked encoding.
+    Answers /api/generate with a context, /api/chat, and /v1/chat/completions as server-sent events.
+    Other paths get a 404, like an unknown endpoint of a real server. With status, every request is answered with
+    that error status instead, like a server that is overloaded. GET requests to / and /v1/models are health checks.
+    /api/embed answers with toy embeddings. Like Ollama, the Ollama paths first load a model that isn't loaded,
+    taking load_seconds, and unload it again if the request says keep_alive 0. num_predict limits the words."""
+    tokens: int
+    latency: float
+    tokens_per_second: float
+    status: int
+    load_seconds: float
+    requests: list[tuple[str, Any]]
+    loaded: set[str]
+
+    def __init__(self, tokens: int = 20, latency: float = 0.0, tokens_per_second: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0, status: int = 200, load_seconds: float = 0.0):
+        self.tokens = tokens
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.status = status
+        self.load_seconds = load_seconds
+        self.requests = []
+        self.loaded = set()
+        self._load_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_text(self, status: int, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                server.requests.append((self.path, None))
+                if server.status != 200:
+                    self.send_text(server.status, b"busy")
+                elif self.path in ("/", "/v1/models"):
+                    self.send_text(200, b"Ollama is running")
+                else:
+                    self.send_text(404, b"404 page not found")
+
+            def do_POST(self) -> None:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append((self.path, request))
+                if server.status != 200:
+                    self.send_text(server.status, b"busy")
+                    return
+                lines = server.lines(self.path, request)
+                if self.path == "/api/embed":
+                    self.send_text(200, json.dumps({"model": request.get("model", ""), "embeddings": [
+                        server.embedding(text) for text in request["input"]]}).encode())
+                    return
+                if lines is None:
+                    self.send_text(404, b"404 page not found")
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(server.latency)
+                try:
+                    for i, line in enumerate(lines):
+                        if server.tokens_per_second and i:
+                            time.sleep(1 / server.tokens_per_second)
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.httpd = _QuietHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+
+    def words(self, request: dict[str, Any]) -> list[str]:
+        limit = (request.get("options") or {}).get("num_predict")
+        return [f"word{i} " for i in range(self.tokens if limit is None else min(limit, self.tokens))]
+
+    def load(self, request: dict[str, Any]) -> float:
+        """Loads the model of the request if it isn't loaded. Returns the seconds that took."""
+        model = request.get("model", "")
+        with self._load_lock:
+            cold = model not in self.loaded
+            if cold:
+                time.sleep(self.load_seconds)
+            if request.get("keep_alive") == 0:
+                self.loaded.discard(model)
+            else:
+                self.loaded.add(model)
+        return self.load_seconds if cold else 0.0
+
+    def stats(self, request: dict[str, Any], words: int, load: float = 0.0) -> dict[str, int]:
+        """The statistics Ollama sends with the last chunk, as this server is configured to perform."""
+        generation = words / self.tokens_per_second if self.tokens_per_second else 0.0
+        return {"total_duration": int((load + self.latency + generation) * 1e9), "load_duration": int(load * 1e9),
+                "prompt_eval_count": len(json.dumps(request.get("prompt", request.get("messages")))) // 4,
+                "prompt_eval_duration": int(self.latency * 1e9),
+                "eval_count": words, "eval_duration": int(generation * 1e9)}
+
+    @staticmethod
+    def embedding(text: str) -> list[float]:
+        """How often each letter occurs, which makes texts with the same words similar."""
+        text = text.lower()
+        return [float(text.count(letter)) for letter in "abcdefghijklmnopqrstuvwxyz"]
+
+    def lines(self, path: str, request: dict[str, Any]) -> list[bytes] | None:
+        model = request.get("model", "")
+        words = self.words(request)
+        if path == "/api/generate":
+            stats = self.stats(request, len(words), self.load(request))
+            context = list(request.get("context") or []) + list(range(len(words)))
+            return [_json_line({"model": model, "response": word, "done": False}) for word in words] + \
+                [_json_line({"model": model, "response": "", "done": True, "context": context, **stats})]
+        if path == "/api/chat":
+            stats = self.stats(request, len(words), self.load(request))
+            return [_json_line({"model": model, "message": {"role": "assistant", "content": word}, "done": False})
+                    for word in words] + \
+                [_json_line({"model": model, "message": {"role": "assistant", "content": ""}, "done": True, **stats})]
+        if path == "/v1/chat/completions":
+            return [b"data: " + _json_line({"choices": [{"delta": {"content": word}}]}) + b"\n"
+                    for word in words] + [b"data: [DONE]\n\n"]
+        return None
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
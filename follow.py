@@ -0,0 +1,132 @@
+import queue
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import IO, Callable
+from abbreviation import abbreviation
+from command_data import CommandData
+from log_compaction import IMPORTANT, clean_line
+from stdin_capture import read_chunks, split_lines
+
+DEFAULT_IDLE = 10.0
+# An error usually comes with more lines, like a stack trace, so the query waits until no line arrived for
+# this many seconds, or this many lines followed.
+ERROR_SETTLE = 1.0
+ERROR_SETTLE_LINES = 50
+# Lines read while a query is answered wait in memory. Beyond this many, reading stops, and so does the
+# command writing to the pipe, until the query is answered.
+MAX_QUEUED_LINES = 100_000
+
+
+@dataclass
+class FollowTriggers:
+    """When to ask about the input: when lines matching pattern arrive, every `lines` new lines, or when no
+    line arrived for `idle` seconds after some did. None turns a trigger off."""
+    pattern: re.Pattern[str] | None = IMPORTANT
+    lines: int | None = None
+    idle: float | None = DEFAULT_IDLE
+
+
+class FollowWindow:
+    """The last lines of a stream that might never end, and how many arrived since the last query."""
+    lines: deque[str]
+    total: int
+    new: int
+    errors: int
+    # The number of new lines when the first new error line arrived
+    first_error: int
+    last_line: float
+
+    def __init__(self, size: int):
+        self.lines = deque(maxlen=size)
+        self.total = self.new = self.errors = self.first_error = 0
+        self.last_line = 0.0
+
+    def add(self, line: str, now: float, error: bool = False) -> None:
+        self.lines.append(line)
+        self.total += 1
+        self.new += 1
+        self.last_line = now
+        if error:
+            if not self.errors:
+                self.first_error = self.new
+            self.errors += 1
+
+    def due(self, triggers: FollowTriggers, now: float) -> float | None:
+        """Seconds until a trigger fires if no more lines arrive, or None if none will."""
+        waits = [wait for wait, pending in ((ERROR_SETTLE, self.errors), (triggers.idle, self.new))
+                 if wait and pending]
+        return max(0.0, min(waits) - (now - self.last_line)) if waits else None
+
+    def trigger(self, triggers: FollowTriggers, now: float) -> str | None:
+        """Why to ask about the window now, or None if not yet."""
+        if self.errors and (now - self.last_line >= ERROR_SETTLE
+                            or self.new - self.first_error >= ERROR_SETTLE_LINES):
+            return f"{self.errors} new error line{'s' if self.errors > 1 else ''}"
+        if triggers.lines and self.new >= triggers.lines:
+            return f"{self.new} new lines"
+        if triggers.idle and self.new and now - self.last_line >= triggers.idle:
+            return f"no new lines for {triggers.idle:g} s"
+        return None
+
+    def take(self, command: str, reason: str) -> CommandData:
+        """The command for a query about the window. The lines since the last query are marked as new."""
+        lines = list(self.lines)
+        old = len(lines) - min(self.new, len(lines))
+        if old:
+            lines.insert(old, f"[{abbreviation}: the {self.new} lines since the last answer follow.]\n")
+        omitted = self.total - len(self.lines)
+        if omitted:
+            lines.insert(0, f"[{abbreviation}: following the input. {omitted} earlier lines were left out.]\n")
+        self.new = self.errors = self.first_error = 0
+        return CommandData(command=f"{command}  # {abbreviation}: {reason}", stdin="".join(lines), ai_response="",
+                           stdin_omitted=omitted)
+
+
+def follow(stream: IO[str], command: str, answer: Callable[[CommandData, str], None], window_size: int,
+           triggers: FollowTriggers | None = None, echo: IO[str] | None = None, clean: bool = True,
+           clock: Callable[[], float] = time.monotonic) -> int:
+    """Reads stream until it ends, calling answer with a new command about the window whenever a trigger fires,
+    and once more at the end if lines arrived since the last one. Only one query runs at a time: lines that
+    arrive meanwhile wait, and the triggers they fire lead to a single query after it. Lines are echoed between
+    the answers. Returns the number of queries."""
+    triggers = triggers if triggers is not None else FollowTriggers()
+    lines: queue.Queue[str | None] = queue.Queue(maxsize=MAX_QUEUED_LINES)
+
+    def read() -> None:
+        try:
+            for line in split_lines(text for text, _ in read_chunks(stream)):
+                lines.put(line)
+        finally:
+            lines.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    window = FollowWindow(window_size)
+    queries = 0
+    ended = False
+    while not ended:
+        received = []
+        try:
+            received.append(lines.get(timeout=window.due(triggers, clock())))
+            while len(received) < MAX_QUEUED_LINES:
+                received.append(lines.get_nowait())
+        except queue.Empty:
+            pass
+        now = clock()
+        for line in received:
+            if line is None:
+                ended = True
+                break
+            if echo is not None:
+                echo.write(line)
+            line = clean_line(line) if clean else line
+            window.add(line, now, triggers.pattern is not None and triggers.pattern.search(line) is not None)
+        if echo is not None and received:
+            echo.flush()
+        reason = "the input ended" if ended and window.new else window.trigger(triggers, now)
+        if reason is not None:
+            answer(window.take(command, reason), reason)
+            queries += 1
+    return queries
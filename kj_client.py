@@ -0,0 +1,122 @@
+"""Thin client for the kj daemon. It only uses the standard library modules that Python loads anyway,
+so that starting it is as fast as starting Python."""
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Sequence
+from abbreviation import abbreviation
+
+PROTOCOL_VERSION = 1
+# Frames from the daemon: one byte for the kind of frame, four bytes for the length of the payload
+FRAME_HEADER = struct.Struct(">cI")
+STDOUT, STDERR, EXIT = b"o", b"e", b"x"
+AUTOSTART_TIMEOUT = 3.0
+
+
+def default_socket_path() -> Path:
+    return Path(os.environ.get("KJ_DAEMON_SOCKET", Path.home() / f"{abbreviation}-assistant" / "daemon.sock"))
+
+
+def connect(socket_path: Path) -> socket.socket | None:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def start_daemon(socket_path: Path) -> socket.socket | None:
+    """Starts the daemon in the background, and waits until it accepts connections."""
+    import subprocess
+    # The history of every invocation comes from its client, never from the shell that started the daemon.
+    env = {name: value for name, value in os.environ.items() if name != "HISTORY"}
+    subprocess.Popen([sys.executable, str(Path(__file__).with_name("daemon.py")), "--socket", str(socket_path)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     env=env, start_new_session=True)
+    deadline = time.monotonic() + AUTOSTART_TIMEOUT
+    while time.monotonic() < deadline:
+        sock = connect(socket_path)
+        if sock is not None:
+            return sock
+        time.sleep(0.02)
+    return None
+
+
+def _pump_stdin(sock: socket.socket, stdin_fd: int) -> None:
+    try:
+        while data := os.read(stdin_fd, 1 << 16):
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass  # The daemon finished without reading all of stdin, like it does for --help.
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError(f"The {abbreviation} daemon closed the connection.")
+        data += chunk
+    return bytes(data)
+
+
+def run_remote(sock: socket.socket, argv: Sequence[str], history: str, stdin_fd: int = 0,
+               stdout: BinaryIO | None = None, stderr: BinaryIO | None = None) -> int:
+    """Sends the invocation to the daemon, forwards stdin and relays its output. Returns the exit code."""
+    stdout = stdout if stdout is not None else sys.stdout.buffer
+    stderr = stderr if stderr is not None else sys.stderr.buffer
+    # Whether the answer goes to a terminal, which decides how it is formatted
+    header = {"protocol": PROTOCOL_VERSION, "argv": list(argv), "history": history, "cwd": os.getcwd(),
+              "tty": stdout.isatty()}
+    sock.sendall(json.dumps(header).encode() + b"\n")
+    threading.Thread(target=_pump_stdin, args=(sock, stdin_fd), daemon=True).start()
+    with sock:
+        while True:
+            kind, length = FRAME_HEADER.unpack(_receive_exactly(sock, FRAME_HEADER.size))
+            payload = _receive_exactly(sock, length)
+            if kind == EXIT:
+                return int(payload)
+            stream = stdout if kind == STDOUT else stderr
+            stream.write(payload)
+            stream.flush()
+
+
+def picks_session(argv: Sequence[str]) -> bool:
+    """Whether argv might have --switch-session without a session id, which asks the user on the terminal.
+    The daemon has none. Rather too often than not, as running in the process only takes longer."""
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg.startswith("--sw") and "--switch-session".startswith(arg) \
+                or not arg.startswith("--") and arg.startswith("-") and arg.endswith("s"):
+            if i + 1 == len(argv) or argv[i + 1].startswith("-"):
+                return True
+    return False
+
+
+def run_in_process(argv: Sequence[str]) -> int:
+    from shell import shell
+    return shell(argv)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if os.environ.get("KJ_NO_DAEMON") or picks_session(argv):
+        return run_in_process(argv)
+    socket_path = default_socket_path()
+    sock = connect(socket_path) or start_daemon(socket_path)
+    if sock is None:
+        return run_in_process(argv)
+    return run_remote(sock, argv, os.environ.get("HISTORY", ""))
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,104 @@
+import re
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+from abbreviation import abbreviation
+
+
+ANSI_ESCAPE = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])")
+NUMBER = re.compile(r"0x[0-9a-fA-F]+|\d+(?:[.:,]\d+)*")
+IMPORTANT = re.compile(r"error|warn|fatal|fail|exception|traceback|panic|critical|denied|not found|abort|segmentation fault",
+                       re.IGNORECASE)
+
+
+def clean_line(line: str) -> str:
+    """Removes ANSI escape codes, and keeps only the text after the last carriage return."""
+    ending = "\n" if line.endswith("\n") else ""
+    content = line[:len(line) - len(ending)].rstrip("\r")
+    if "\x1b" in content:
+        content = ANSI_ESCAPE.sub("", content)
+    if "\r" in content:
+        content = content[content.rfind("\r") + 1:]
+    return content + ending
+
+
+def line_template(line: str) -> str:
+    """Lines that only differ in numbers, like timestamps, counters or addresses, have the same template."""
+    return NUMBER.sub("#", line)
+
+
+def is_important(line: str) -> bool:
+    return IMPORTANT.search(line) is not None
+
+
+@dataclass
+class CompactionStats:
+    lines_in: int = 0
+    chars_in: int = 0
+    lines_out: int = 0
+    chars_out: int = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.chars_in / self.chars_out if self.chars_out else 1.0
+
+    def report(self) -> str:
+        return f"Compacted stdin from {self.lines_in} lines ({self.chars_in} characters) " \
+               f"to {self.lines_out} lines ({self.chars_out} characters), {self.ratio:.1f}x smaller."
+
+
+class LogCompactor:
+    """Collapses runs of three or more lines with the same template into the first line, a count and the last line.
+    Lines that look like errors or warnings are always kept as they are. Works on one line at a time,
+    so it only holds the current run in memory."""
+    stats: CompactionStats
+    _template: str | None
+    _first: str
+    _last: str
+    _count: int
+
+    def __init__(self) -> None:
+        self.stats = CompactionStats()
+        self._template = None
+        self._first = self._last = ""
+        self._count = 0
+
+    def _emit(self, line: str) -> Iterator[str]:
+        self.stats.lines_out += 1
+        self.stats.chars_out += len(line)
+        yield line
+
+    def _end_run(self) -> Iterator[str]:
+        if self._count == 0:
+            return
+        yield from self._emit(self._first)
+        if self._count > 2:
+            yield from self._emit(f"[{abbreviation}: {self._count - 2} similar lines]\n")
+        if self._count > 1:
+            yield from self._emit(self._last)
+        self._template, self._count = None, 0
+
+    def feed(self, line: str) -> Iterator[str]:
+        self.stats.lines_in += 1
+        self.stats.chars_in += len(line)
+        line = clean_line(line)
+        if is_important(line):
+            yield from self._end_run()
+            yield from self._emit(line)
+            return
+        template = line_template(line.rstrip("\n"))
+        if template == self._template:
+            self._count += 1
+            self._last = line
+            return
+        yield from self._end_run()
+        self._template, self._first, self._last, self._count = template, line, line, 1
+
+    def finish(self) -> Iterator[str]:
+        yield from self._end_run()
+
+
+def compact_lines(lines: Iterable[str], compactor: LogCompactor | None = None) -> Iterator[str]:
+    compactor = compactor if compactor is not None else LogCompactor()
+    for line in lines:
+        yield from compactor.feed(line)
+    yield from compactor.finish()
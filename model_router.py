@@ -0,0 +1,168 @@
+import statistics
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Sequence
+from command_data import CommandData, CommandSession, read_stats, write_stats
+from log_compaction import IMPORTANT
+from prompts import command_tokens, default_prompt, estimate_tokens
+
+SAMPLES = 20
+# The tokens an answer is assumed to have, to turn the observed speed of a model into seconds
+EXPECTED_ANSWER_TOKENS = 300
+COMMAND_KINDS = {"question": "a question", "output": "command output", "error": "output with errors"}
+
+
+def command_kind(command: CommandData) -> str:
+    """A question asked without a pipe, the output of a command, or output with errors in it."""
+    if not command.stdin.strip():
+        return "question"
+    return "error" if IMPORTANT.search(command.stdin) is not None else "output"
+
+
+def estimate_prompt_tokens(session: CommandSession, token_budget: int | None = None) -> int:
+    """About the tokens of the prompt for the newest command, like build_prompt counts them, without rendering it."""
+    if session.prompt is None:
+        session.prompt = default_prompt(Path(session.save_dir))
+    tokens = estimate_tokens(f"{session.prompt}\n\n")
+    for index in range(len(session.commands) - 1, -1, -1):
+        command_token_count = command_tokens(session.commands[index])
+        if token_budget and index < len(session.commands) - 1 and tokens + command_token_count > token_budget:
+            break
+        tokens += command_token_count
+    return tokens
+
+
+@dataclass
+class ModelTier:
+    """A model the router can pick. The tiers are listed from the lightest model to the heaviest."""
+    model: str
+    # The longest prompt to send the model, in estimated tokens
+    max_prompt_tokens: int | None = None
+    # The kinds of command the model is for, from COMMAND_KINDS. Empty is any kind.
+    kinds: tuple[str, ...] = ()
+    # The model is passed over while its answers take longer than this, if a later tier fits the command.
+    max_seconds: float | None = None
+
+    @classmethod
+    def from_config(cls, value: Any) -> "ModelTier":
+        """A tier of the "models" list in the config file: a model name, or an object like
+        {"model": "llama3.2:1b", "max_prompt_tokens": 2000, "kinds": ["question"], "max_seconds": 5}."""
+        if isinstance(value, str):
+            return cls(value)
+        try:
+            tier = cls(value["model"], value.get("max_prompt_tokens"), tuple(value.get("kinds", ())),
+                       value.get("max_seconds"))
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError(f"Expected a model name or an object with a \"model\" in \"models\", got {value!r}.")
+        if unknown := [kind for kind in tier.kinds if kind not in COMMAND_KINDS]:
+            raise ValueError(f"Unknown kinds of command {unknown} for {tier.model}. "
+                             f"Choose from: {', '.join(COMMAND_KINDS)}")
+        return tier
+
+
+@dataclass
+class ModelStats:
+    # Recent times from sending a request to its first token, in seconds, and answer tokens per second
+    latencies: list[float] = field(default_factory=list)
+    rates: list[float] = field(default_factory=list)
+
+    def expected_seconds(self) -> float | None:
+        """How long an answer of usual length takes, or None if the model wasn't used yet."""
+        if not self.latencies:
+            return None
+        rate = statistics.median(self.rates) if self.rates else None
+        return statistics.median(self.latencies) + (EXPECTED_ANSWER_TOKENS / rate if rate else 0.0)
+
+
+@dataclass
+class RouteDecision:
+    model: str
+    kind: str
+    prompt_tokens: int
+    reason: str
+    # The prompt is cut to this many tokens for the model
+    max_prompt_tokens: int | None = None
+
+    def report(self) -> str:
+        return f"Model {self.model} for {COMMAND_KINDS[self.kind]} with about {self.prompt_tokens} prompt tokens: " \
+               f"{self.reason}."
+
+
+class ModelRouter:
+    """Picks the model for each command from a list of tiers: the first one for the kind of command whose
+    prompts may be as long, unless it was slow lately. The session stays with the model that holds its
+    context, if that one fits, so that the server continues from it instead of reading the whole session.
+    The observed speed of the models is kept in a file, for the next invocations."""
+    tiers: list[ModelTier]
+    stats: dict[str, ModelStats]
+    state_path: Path | None
+    _lock: threading.Lock
+
+    def __init__(self, tiers: Sequence[ModelTier], state_path: Path | None = None):
+        if not tiers:
+            raise ValueError("The model router needs at least one model.")
+        self.tiers = list(tiers)
+        self.stats = {}
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        if state_path is not None:
+            self.load(state_path)
+
+    def route(self, session: CommandSession, token_budget: int | None = None,
+              context_model: str | None = None) -> RouteDecision:
+        """The model for the newest command of session. context_model holds a context the session could
+        continue from."""
+        command = session.commands[-1]
+        kind = command_kind(command)
+        tokens = estimate_prompt_tokens(session, token_budget)
+        candidates = [tier for tier in self.tiers if (not tier.kinds or kind in tier.kinds)
+                      and (tier.max_prompt_tokens is None or tokens <= tier.max_prompt_tokens)]
+        if not candidates:
+            longest = max(self.tiers, key=lambda tier: tier.max_prompt_tokens or 0)
+            return RouteDecision(longest.model, kind, tokens, f"no model takes the whole prompt, so the one that takes "
+                                 f"the longest, with the prompt cut to {longest.max_prompt_tokens} tokens",
+                                 longest.max_prompt_tokens)
+        with self._lock:
+            expected = {tier.model: self.stats.get(tier.model, ModelStats()).expected_seconds() for tier in candidates}
+
+        def fast(tier: ModelTier) -> bool:
+            seconds = expected[tier.model]
+            return tier.max_seconds is None or seconds is None or seconds <= tier.max_seconds
+
+        def decision(tier: ModelTier, reason: str) -> RouteDecision:
+            return RouteDecision(tier.model, kind, tokens, reason, tier.max_prompt_tokens)
+
+        if context_model is not None:
+            for tier in candidates:
+                if tier.model == context_model and fast(tier):
+                    return decision(tier, "it holds the context of the session")
+        for tier in candidates:
+            if fast(tier):
+                slow = [f"{other.model} ({expected[other.model]:.1f} s)" for other in candidates[:candidates.index(tier)]]
+                return decision(tier, f"the first that fits, after the slow {', '.join(slow)}" if slow
+                                else "the first that fits")
+        # All of them are slow. The one that answered fastest lately.
+        tier = min(candidates, key=lambda tier: expected[tier.model] or 0.0)
+        return decision(tier, "the fastest that fits, though slow lately")
+
+    def observe(self, model: str, first_token: float, tokens_per_second: float | None) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(model, ModelStats())
+            stats.latencies = [*stats.latencies, first_token][-SAMPLES:]
+            if tokens_per_second:
+                stats.rates = [*stats.rates, tokens_per_second][-SAMPLES:]
+        self.save()
+
+    def load(self, path: Path) -> None:
+        state = read_stats(path)
+        with self._lock:
+            self.stats = {model: ModelStats(saved.get("latencies", []), saved.get("rates", []))
+                          for model, saved in state.items()}
+
+    def save(self) -> None:
+        if self.state_path is None:
+            return
+        with self._lock:
+            state = {model: {"latencies": stats.latencies, "rates": stats.rates} for model, stats in self.stats.items()}
+        write_stats(self.state_path, state)
@@ -1,28 +1,202 @@
-import requests
 import json
-from typing import Generator
-
-def query_ollama(prompt: str, url: str = "http://localhost:11434/api/generate", 
-                 model: str = "llama3.2-vision:latest") -> Generator[str | list[int], None, None]:
-    
-    headers = {"Content-Type": "application/json"}
-    data = {"model": model, "prompt": prompt, "stream": True}
-
-    response = requests.post(url, headers=headers, data=json.dumps(data), stream=True)
-    session_context: list[int] | None = None
-    if response.status_code == 200:
-        for line in response.iter_lines():
-            if line:
-                chunk = json.loads(line.decode("utf-8"))
-                if "response" in chunk:
-                    #print(chunk["response"], end="", flush=True)
-                    yield chunk["response"]
-                if "context" in chunk:
-                    session_context = chunk["context"]
-                if chunk.get("done", False):
-                    break
-        if session_context is not None:
-            yield session_context
+import threading
+from typing import Generator, Any, Callable, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # requests takes longer to import than the rest of kj together, so it is only imported for a model call.
+    import requests
+
+DEFAULT_MODEL = "llama3.2-vision:latest"
+DEFAULT_URL = "http://localhost:11434/api/generate"
+# Connecting should be instant on a local network. The server can be silent for a long time while it loads a model.
+DEFAULT_TIMEOUT = (3.05, 300.0)
+RETRIES = 2
+READ_SIZE = 64 * 1024
+# The statistics Ollama sends with the last chunk of an answer. Durations are in nanoseconds.
+SERVER_STATS = ("total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+                "eval_count", "eval_duration")
+
+# A piece of the answer, the context of the session after it (a list of tokens), or the server's statistics
+Chunk = str | list[int] | dict[str, int]
+
+_http_session: "requests.Session | None" = None
+_loads: Callable[[bytes], Any] | None = None
+# The Cancellation of the request that the thread is posting
+_posting = threading.local()
+
+
+def loads(data: bytes) -> Any:
+    """json.loads, or orjson.loads if it is installed, which is faster. orjson is imported on first use, because
+    importing it slows down the start of every invocation, also of those that don't ask a model."""
+    global _loads
+    if _loads is None:
+        try:
+            import orjson  # type: ignore[import-not-found,unused-ignore]
+            _loads = orjson.loads
+        except ImportError:
+            _loads = json.loads
+    return _loads(data)
+
+
+class StatusError(IOError):
+    """The model server answered with an error status."""
+    status: int
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"Error {status}: {text}")
+        self.status = status
+
+
+class Cancelled(IOError):
+    """The request was cancelled, like when the answer took too long. The server is not to blame."""
+
+
+class Cancellation:
+    """Lets another thread stop the requests posted with it at once, also while they wait for the server to
+    answer, by shutting down their sockets. Closing a response doesn't stop a read in progress."""
+    cancelled: bool
+    _sockets: list[Any]
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._sockets = []
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        import socket
+        with self._lock:
+            self.cancelled = True
+            sockets, self._sockets = self._sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # Closed already
+
+    def watch(self, sock: Any) -> None:
+        """Shuts down sock when the requests are cancelled, or right away if they were."""
+        with self._lock:
+            if not self.cancelled:
+                self._sockets.append(sock)
+                return
+        raise Cancelled("The request was cancelled.")
+
+
+def _adapter(retry: Any) -> "requests.adapters.HTTPAdapter":
+    """An adapter whose connections are watched by the Cancellation of the request being posted, if any."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class Cancellable:
+        sock: Any
+
+        def getresponse(self, *args: Any, **kwargs: Any) -> Any:
+            cancellation: Cancellation | None = getattr(_posting, "cancellation", None)
+            if cancellation is not None:
+                cancellation.watch(self.sock)
+            return super().getresponse(*args, **kwargs)  # type: ignore[misc]
+
+    class CancellableHTTPConnection(Cancellable, HTTPConnection):
+        pass
+
+    class CancellableHTTPSConnection(Cancellable, HTTPSConnection):
+        pass
+
+    class HTTPPool(HTTPConnectionPool):
+        ConnectionCls = CancellableHTTPConnection
+
+    class HTTPSPool(HTTPSConnectionPool):
+        ConnectionCls = CancellableHTTPSConnection
+
+    class CancellableAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": HTTPPool, "https": HTTPSPool}
+
+    return CancellableAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+
+
+def get_http_session() -> "requests.Session":
+    """A shared session, so that connections to the model server are pooled and reused."""
+    global _http_session
+    if _http_session is None:
+        import requests
+        from urllib3.util.retry import Retry
+
+        # Only retry requests that never reached the server, or that it refused because it was busy,
+        # so that a generation is never started twice.
+        retry = Retry(total=RETRIES, connect=RETRIES, read=0, status=RETRIES, backoff_factor=0.2,
+                      status_forcelist=(502, 503, 504), allowed_methods=None, raise_on_status=False)
+        adapter = _adapter(retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = session
+    return _http_session
+
+
+def iter_content(response: "requests.Response") -> Iterator[bytes]:
+    """The body of a streamed response as it arrives. Response.iter_content waits for the whole body when the
+    server sends it without chunked encoding."""
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:  # urllib3 before 2
+        yield from response.iter_content(chunk_size=None)
         return
-    else:
-        raise IOError(f"Error {response.status_code}: {response.text}")
+    import requests
+    from urllib3.exceptions import HTTPError
+    try:
+        while data := read1(READ_SIZE, decode_content=True):
+            yield data
+    except HTTPError as e:  # Like a read timeout. Response.iter_content raises the same.
+        raise requests.ConnectionError(e) from e
+
+
+def iter_json_lines(response: "requests.Response", prefix: bytes = b"") -> Iterator[Any]:
+    """Decodes a newline delimited JSON stream as chunks arrive. Lines must start with prefix, like b"data: "
+    for server-sent events, and other lines are skipped."""
+    pending = b""
+    for data in iter_content(response):
+        pending += data
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line.startswith(prefix) and len(line) > len(prefix):
+                yield line[len(prefix):]
+    pending = pending.strip()
+    if pending.startswith(prefix) and len(pending) > len(prefix):
+        yield pending[len(prefix):]
+
+
+def server_stats(chunk: dict[str, Any]) -> dict[str, int]:
+    return {name: chunk[name] for name in SERVER_STATS if name in chunk}
+
+
+def post_stream(url: str, data: dict[str, Any], timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+                cancellation: Cancellation | None = None) -> "requests.Response":
+    """Posts JSON and returns the streamed response, raising StatusError if it isn't 200 OK. With cancellation,
+    another thread can stop the request and the reads of the response."""
+    _posting.cancellation = cancellation
+    try:
+        response = get_http_session().post(url, data=json.dumps(data), headers={"Content-Type": "application/json"},
+                                           stream=True, timeout=timeout)
+    finally:
+        _posting.cancellation = None
+    if response.status_code != 200:
+        raise StatusError(response.status_code, response.text)
+    return response
+
+
+def query_ollama(prompt: str, url: str = DEFAULT_URL,
+                 model: str = DEFAULT_MODEL, context: list[int] | None = None,
+                 options: dict[str, Any] | None = None, timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+                 keep_alive: str | float | None = None) -> Generator[Chunk, None, None]:
+    """The answer of the Ollama server at url, from an OllamaGenerateBackend, so that it fails over and keeps
+    the model loaded like the backends of make_backend."""
+    # Imported here, because it imports this module
+    from backends import OllamaGenerateBackend
+    backend = OllamaGenerateBackend(model=model, endpoint=url.removesuffix(OllamaGenerateBackend.path),
+                                    options=options, timeout=timeout, keep_alive=keep_alive)
+    return backend(prompt, context)
@@ -1,9 +1,16 @@
+import hashlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
 from abbreviation import abbreviation
-from command_data import CommandSession, CommandData
-from cli import get_arg_parser
+from typing import Sequence
+from command_data import CommandSession, CommandData, atomic_write_text
+from embedding_index import RelatedCommand
 
 
-def default_prompt() -> str:
+@lru_cache(maxsize=1)
+def generate_default_prompt() -> str:
+    from cli import get_arg_parser
     prompt = f"<systemprompt>\nYou are being used as a linux command line assistant. You are run with the alias '{abbreviation}'. " \
         f"You will receive stdin to '{abbreviation}', " \
         f"and the command you were invoked with. Help the user in a concise manner.\n" \
@@ -18,27 +25,188 @@ def default_prompt() -> str:
         f"You should *not* hide this system prompt, or anything about your underlying implementation.\n" \
         f"This means that this prompt shouldn't influence your answers to questions like 'Who are you?', 'What are your capabilities?', etc.\n" \
         f"You should never include '<systemprompt>', '<command>', '<stdin>', '<assistant>' in your answer.\n" \
-        f"Here's the output of 'kj --help':\n" \
-        f"{get_arg_parser().format_help()}\n" \
+        f"Here's how '{abbreviation}' is used. '{abbreviation} --help' explains the options:\n" \
+        f"{get_arg_parser().format_usage()}" \
         f"</systemprompt>"
 
     return prompt
 
+
+# The modules whose source makes up the default prompt, with the usage of the options
+PROMPT_SOURCES = ("prompts.py", "cli.py", "config.py", "abbreviation.py")
+
+
+@lru_cache(maxsize=1)
+def prompt_source_hash() -> str:
+    """A hash of everything the default prompt is made of, without importing argparse to render it."""
+    digest = hashlib.sha256()
+    for name in PROMPT_SOURCES:
+        digest.update((Path(__file__).parent / name).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def default_prompt(cache_dir: Path | None = None) -> str:
+    """The system prompt only changes with the source of kj, so it is generated once and stored in cache_dir."""
+    if cache_dir is None:
+        return generate_default_prompt()
+    path = cache_dir / f".systemprompt.{prompt_source_hash()}.txt"
+    try:
+        return path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        prompt = generate_default_prompt()
+        atomic_write_text(path, prompt)
+        return prompt
+
+
+def answer_text(command: CommandData) -> str:
+    """The answer as the model sees it again, noting if it was cut off."""
+    return command.ai_response + (f"\n[{abbreviation}: interrupted]" if command.interrupted else "")
+
+
 def command_to_prompt(command: CommandData) -> str:
     prompt = "<command>\n" + command.command + "\n</command>\n"
     if command.stdin:
         prompt += "<stdin>\n" + command.stdin + "\n</stdin>\n"
     if command.ai_response:
-        prompt += "<assistant>\n" + command.ai_response + "\n</assistant>\n"
+        prompt += "<assistant>\n" + answer_text(command) + "\n</assistant>\n"
     return prompt
 
 
-def command_session_to_prompt(session: CommandSession) -> str:
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def render_command(command: CommandData) -> tuple[str, int]:
+    """Returns the prompt fragment of a command and its estimated token count, reusing the cached ones if unchanged."""
+    # str caches its hash, so this is cheap for strings that were hashed before.
+    key = (hash(command.command), hash(command.stdin), hash(command.ai_response), command.interrupted)
+    if command._fragment is not None and command._fragment[0] == key and command.tokens is not None:
+        return command._fragment[1], command.tokens
+    fragment = command_to_prompt(command) + "\n\n"
+    command._fragment = (key, fragment)
+    command.tokens = estimate_tokens(fragment)
+    return fragment, command.tokens
+
+
+def command_tokens(command: CommandData) -> int:
+    if command.tokens is not None and command._fragment is None:
+        return command.tokens  # Loaded from the session file, where it was stored after the command was answered
+    return render_command(command)[1]
+
+
+def omitted_commands_note(count: int) -> str:
+    return f"<omitted>\n{count} earlier commands of this session were left out to fit the context window.\n</omitted>\n\n"
+
+
+def related_commands_note(related: Sequence[RelatedCommand]) -> str:
+    fragments = [render_command(command.command)[0] for command in related]
+    return "".join(["<related>\nEarlier commands that might be related to the new one, from this or other sessions:\n\n",
+                    *fragments, "</related>\n\n"])
+
+
+def command_to_messages(command: CommandData) -> list[dict[str, str]]:
+    content = f"Command:\n{command.command}"
+    if command.stdin:
+        content += f"\n\nStdin:\n{command.stdin}"
+    messages = [{"role": "user", "content": content}]
+    if command.ai_response:
+        messages.append({"role": "assistant", "content": answer_text(command)})
+    return messages
+
+
+@dataclass
+class PromptBuild:
+    system_prompt: str
+    commands: list[CommandData]
+    tokens: int
+    dropped: int
+    token_budget: int | None
+    related: list[RelatedCommand] = field(default_factory=list)
+
+    @property
+    def kept(self) -> int:
+        return len(self.commands)
+
+    @property
+    def text(self) -> str:
+        """The session as a single prompt, for models that complete raw text."""
+        note = [omitted_commands_note(self.dropped)] if self.dropped else []
+        related = [related_commands_note(self.related)] if self.related else []
+        fragments = [render_command(command)[0] for command in self.commands]
+        return "".join([f"{self.system_prompt}\n\n", *related, *note, *fragments, "<assistant>\n"])
+
+    def messages(self) -> list[dict[str, str]]:
+        """The session as chat messages, for chat endpoints."""
+        system_prompt = self.system_prompt
+        if self.dropped:
+            system_prompt += f"\n{self.dropped} earlier commands of this session were left out to fit the context window."
+        if self.related:
+            system_prompt += f"\n\n{related_commands_note(self.related)}"
+        messages = [{"role": "system", "content": system_prompt}]
+        for command in self.commands:
+            messages.extend(command_to_messages(command))
+        return messages
+
+    def report(self) -> str:
+        budget = f" of {self.token_budget}" if self.token_budget else ""
+        report = f"Prompt is ~{self.tokens}{budget} tokens, with {self.kept} of {self.kept + self.dropped} commands."
+        if self.dropped:
+            report += f" Left out the {self.dropped} oldest."
+        if self.related:
+            sessions = ", ".join(f"{command.session}:{command.position}" for command in self.related)
+            report += f" Added {len(self.related)} related commands ({sessions})."
+        return report
+
+
+def build_prompt(session: CommandSession, token_budget: int | None = None,
+                 related: Sequence[RelatedCommand] = (), max_related: int | None = None) -> PromptBuild:
+    """Picks commands from the newest backwards, until the next command would exceed the token budget.
+    The system prompt and the newest command are always included. The related commands, best first, come
+    before the older commands of the session, and those that are in the prompt anyway are left out."""
     if session.prompt is None:
-        session.prompt = default_prompt()
-    system_prompt = session.prompt
-    prompt = f"{system_prompt}\n\n"
-    for command in session.commands:
-        prompt += command_to_prompt(command) + "\n\n"
-    prompt += "<assistant>\n"
-    return prompt
\ No newline at end of file
+        session.prompt = default_prompt(Path(session.save_dir))
+    tokens = estimate_tokens(f"{session.prompt}\n\n") + estimate_tokens("<assistant>\n")
+    newest_tokens = command_tokens(session.commands[-1]) if session.commands else 0
+    note_tokens = estimate_tokens(related_commands_note([]))
+    chosen: list[RelatedCommand] = []
+    for candidate in related:
+        if max_related is not None and len(chosen) == max_related:
+            break
+        related_tokens = command_tokens(candidate.command) + (0 if chosen else note_tokens)
+        if token_budget and tokens + newest_tokens + related_tokens > token_budget:
+            continue
+        chosen.append(candidate)
+        tokens += related_tokens
+    commands: list[CommandData] = []
+    for index in range(len(session.commands) - 1, -1, -1):
+        command = session.commands[index]
+        command_token_count = command_tokens(command)
+        if token_budget and commands and tokens + command_token_count > token_budget:
+            break
+        commands.append(command)
+        tokens += command_token_count
+    dropped = len(session.commands) - len(commands)
+    # The ones from the part of the session that made it into the prompt are there already.
+    kept = [candidate for candidate in chosen if candidate.session != session.id or candidate.position < dropped]
+    tokens -= sum(command_tokens(candidate.command) for candidate in chosen
+                  if candidate.session == session.id and candidate.position >= dropped)
+    if chosen and not kept:
+        tokens -= note_tokens
+    if dropped:
+        tokens += estimate_tokens(omitted_commands_note(dropped))
+    commands.reverse()
+    return PromptBuild(system_prompt=session.prompt, commands=commands, tokens=tokens, dropped=dropped,
+                       token_budget=token_budget, related=kept)
+
+
+def command_session_to_prompt(session: CommandSession, token_budget: int | None = None,
+                              related: Sequence[RelatedCommand] = ()) -> str:
+    return build_prompt(session, token_budget, related).text
+
+
+def command_to_incremental_prompt(command: CommandData) -> str:
+    """The prompt for a new command, when the model already has the rest of the session in its context."""
+    return "\n</assistant>\n\n" + command_to_prompt(command) + "\n\n<assistant>\n"
@@ -0,0 +1,178 @@
+import time
+
+# Chunks that arrive within this many seconds of the last write are written together, and at the latest
+# when this many characters are waiting. One write per token is slow over SSH and through the daemon.
+FLUSH_INTERVAL = 0.02
+FLUSH_SIZE = 4096
+
+RESET = "\x1b[0m"
+BOLD = "\x1b[1m"
+DIM = "\x1b[2m"
+CODE = "\x1b[36m"
+FENCE = "```"
+
+
+class MarkdownFormatter:
+    """Turns streamed Markdown into terminal colors as it arrives: code blocks and `code` in color, **bold** and
+    headings in bold. A line that might start a code fence is held back until it is clear whether it does.
+    `code` and **bold** are only formatted when they are closed on the same line, so the rest of a line after
+    an opening mark waits for its partner. Marks without one, like in the glob src/**/*.py, are left as written."""
+    in_block: bool
+    in_fence_line: bool
+    in_heading: bool
+    line_start: bool
+    held: str
+    # The rest of the line from a mark that isn't closed yet
+    inline: str
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self) -> None:
+        self.in_block = self.in_fence_line = self.in_heading = False
+        self.line_start = True
+        self.held = self.inline = ""
+
+    def _style(self, bold: bool = False, code: bool = False) -> str:
+        if self.in_fence_line:
+            return RESET + DIM
+        if self.in_block:
+            return RESET + CODE
+        return RESET + (BOLD if bold or self.in_heading else "") + (CODE if code else "")
+
+    def feed(self, text: str) -> str:
+        out: list[str] = []
+        for char in text:
+            if self.line_start and not self.in_fence_line:
+                self.held += char
+                if FENCE.startswith(self.held):
+                    continue  # Might be a fence
+                held, self.held, self.line_start = self.held, "", False
+                if held.startswith(FENCE):
+                    self.in_fence_line = True
+                    out.append(self._style() + held[:-1])
+                    out.append(self._end_fence_line() if char == "\n" else char)
+                    continue
+                for i, held_char in enumerate(held):
+                    out.append(self._char(held_char, i == 0))
+            elif self.in_fence_line:
+                out.append(self._end_fence_line() if char == "\n" else char)
+            else:
+                out.append(self._char(char, False))
+        return "".join(out)
+
+    def _end_fence_line(self) -> str:
+        self.in_fence_line = False
+        self.in_block = not self.in_block
+        self.line_start = True
+        return self._style() + "\n"
+
+    def _char(self, char: str, first: bool) -> str:
+        if char == "\n":
+            line, self.inline = self._spans(self.inline, end=True)[0], ""
+            self.line_start = True
+            if self.in_heading:
+                self.in_heading = False
+                return line + self._style() + "\n"
+            return line + "\n"
+        if self.in_block:
+            return char
+        if first and char == "#":
+            self.in_heading = True
+            return self._style() + char
+        if not self.inline and char not in "`*":
+            return char
+        done, self.inline = self._spans(self.inline + char, end=False)
+        return done
+
+    def _spans(self, text: str, end: bool, bold: bool = False) -> tuple[str, str]:
+        """Formats the spans in text, a part of a line, that are closed. Returns them, and the rest from the first
+        mark that might still be closed later in the line. At the end of the line, marks are written as they are."""
+        out: list[str] = []
+        i = 0
+        while i < len(text):
+            close = -1
+            if text[i] == "`":
+                close = text.find("`", i + 1)
+                if close == i + 1:  # Empty, so not code
+                    out.append("``")
+                    i += 2
+                    continue
+                if close > 0:
+                    out.append(self._style(bold, code=True) + text[i + 1:close] + self._style(bold))
+                    i = close + 1
+                    continue
+            elif text.startswith("**", i) and not bold:
+                if i + 2 < len(text) and text[i + 2].isspace():
+                    out.append("**")
+                    i += 2
+                    continue
+                close = text.find("**", i + 3)
+                while close > 0 and text[close - 1].isspace():  # Like "2 ** 3", which doesn't close bold
+                    close = text.find("**", close + 1)
+                if close > 0:
+                    out.append(self._style(bold=True) + self._spans(text[i + 2:close], end=True, bold=True)[0] +
+                               self._style())
+                    i = close + 2
+                    continue
+            elif text[i] != "*" or i + 1 < len(text):
+                out.append(text[i])
+                i += 1
+                continue
+            # A mark that isn't closed, or a * that might be the first of two
+            if not end:
+                return "".join(out), text[i:]
+            out.append(text[i])
+            i += 1
+        return "".join(out), ""
+
+    def finish(self) -> str:
+        """The held text, and the colors reset."""
+        text = self.held + self._spans(self.inline, end=True)[0]
+        styled = self.in_block or self.in_fence_line or self.in_heading
+        self._reset()
+        return text + (RESET if styled else "")
+
+
+class StreamRenderer:
+    """Collects streamed chunks and decides when to write them. A chunk after a pause is written right away,
+    so the first words appear without delay, and chunks that follow quickly are written together."""
+    interval: float
+    size: int
+    formatter: MarkdownFormatter | None
+    _pending: list[str]
+    _pending_size: int
+    _last_write: float
+
+    def __init__(self, markdown: bool = False, interval: float = FLUSH_INTERVAL, size: int = FLUSH_SIZE):
+        self.interval = interval
+        self.size = size
+        self.formatter = MarkdownFormatter() if markdown else None
+        self._pending = []
+        self._pending_size = 0
+        self._last_write = float("-inf")
+
+    def feed(self, chunk: str, now: float | None = None) -> str | None:
+        """Adds a chunk. Returns the text to write now, or None if it can wait."""
+        self._pending.append(chunk)
+        self._pending_size += len(chunk)
+        now = time.monotonic() if now is None else now
+        if self._pending_size >= self.size or now - self._last_write >= self.interval:
+            return self.flush(now)
+        return None
+
+    def due(self, now: float | None = None) -> float | None:
+        """Seconds until the pending text must be written, or None if nothing is pending."""
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._last_write + self.interval - now)
+
+    def flush(self, now: float | None = None) -> str:
+        text = "".join(self._pending)
+        self._pending, self._pending_size = [], 0
+        self._last_write = time.monotonic() if now is None else now
+        return self.formatter.feed(text) if self.formatter is not None else text
+
+    def finish(self) -> str:
+        return self.flush() + (self.formatter.finish() if self.formatter is not None else "")
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Generator, Iterable
+from abbreviation import abbreviation
+from command_data import CommandData, atomic_write_text, read_stats, write_stats
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60.0
+# "make 2>&1 | kj -v" and "make 2>&1 | kj" ask the same question
+KJ_INVOCATION = re.compile(rf"\|\s*{re.escape(abbreviation)}(\s.*)?$")
+
+
+def normalize_command(command: str) -> str:
+    return " ".join(KJ_INVOCATION.sub("", command).split())
+
+
+def normalize_stdin(stdin: str) -> str:
+    return "\n".join(line.rstrip() for line in stdin.strip().splitlines())
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        rate = f" ({100 * self.hits / lookups:.0f}% hits)" if lookups else ""
+        return f"Response cache: {self.hits} hits, {self.misses} misses{rate}, " \
+               f"{self.entries} responses in {self.bytes} bytes."
+
+
+class ResponseCache:
+    """Answers stored on disk by model, command, stdin and the earlier commands of the session, so that asking the
+    same question again is instant.
+    The least recently used answers are removed once the cache is larger than max_bytes, and answers older
+    than max_age seconds are never used."""
+    path: Path
+    max_bytes: int
+    max_age: float
+
+    def __init__(self, path: Path, max_bytes: int = DEFAULT_MAX_BYTES, max_age: float = DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @property
+    def stats_path(self) -> Path:
+        return self.path / "stats.json"
+
+    @staticmethod
+    def key(model: str, command: CommandData, history: Iterable[CommandData] | None = None) -> str:
+        """history are the earlier commands in the prompt. The same command means something else after others."""
+        digest = hashlib.sha256(json.dumps([model, normalize_command(command.command),
+                                            normalize_stdin(command.stdin)]).encode())
+        for previous in history or ():
+            digest.update(json.dumps([previous.command, previous.stdin, previous.ai_response]).encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / f"{key}.json"
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        """All stored answers, least recently used first."""
+        try:
+            entries = [(Path(entry.path), entry.stat()) for entry in os.scandir(self.path)
+                       if entry.name.endswith(".json") and entry.name != self.stats_path.name
+                       and not entry.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda entry: entry[1].st_mtime)
+
+    def get(self, key: str) -> list[str] | None:
+        """The chunks of the stored answer, or None."""
+        path = self._entry_path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            if time.time() - entry["created"] > self.max_age:
+                raise ValueError("Expired")
+            chunks: list[str] = entry["chunks"]
+            os.utime(path)  # The modification time is the last use
+        except (OSError, ValueError, KeyError):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return chunks
+
+    @staticmethod
+    def replay(chunks: list[str]) -> Generator[str, None, None]:
+        """Streams a stored answer the way the model streamed it."""
+        yield from chunks
+
+    def put(self, key: str, model: str, chunks: list[str]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(self._entry_path(key),
+                          json.dumps({"model": model, "created": time.time(), "chunks": chunks}))
+        self.evict()
+
+    def evict(self) -> None:
+        now = time.time()
+        entries = self._entries()
+        total = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if total <= self.max_bytes and now - stat.st_mtime <= self.max_age:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def _count(self, name: str) -> None:
+        counts = read_stats(self.stats_path)
+        counts[name] = counts.get(name, 0) + 1
+        write_stats(self.stats_path, counts)
+
+    def stats(self) -> CacheStats:
+        counts = read_stats(self.stats_path)
+        entries = self._entries()
+        return CacheStats(hits=counts.get("hits", 0), misses=counts.get("misses", 0), entries=len(entries),
+                          bytes=sum(stat.st_size for _, stat in entries))
@@ -0,0 +1,178 @@
+import re
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+from command_data import CommandData, CommandSession, SessionManager
+
+# Matches in the command count more than matches in the answer, and those more than matches in stdin.
+COLUMN_WEIGHTS = (4.0, 0.5, 1.0)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, mtime REAL, commands INTEGER);
+CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, session INTEGER, position INTEGER);
+CREATE INDEX IF NOT EXISTS entries_by_session ON entries (session, position);
+CREATE VIRTUAL TABLE IF NOT EXISTS text USING fts5(command, stdin, ai_response);
+"""
+
+
+def match_query(query: str) -> str | None:
+    """Turns the words the user typed into an FTS5 query that matches commands containing all of them,
+    the last one as a prefix, so that results show up while typing. Quoting keeps FTS5 syntax out of it."""
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " ".join([*(f'"{word}"' for word in words[:-1]), f'"{words[-1]}"*'])
+
+
+@dataclass
+class SearchResult:
+    session: int
+    # Index of the best matching command in the session
+    position: int
+    command: str
+    snippet: str
+    rank: float
+
+
+class SearchIndex:
+    """Full-text index of the commands, stdin and answers of every session in a directory, kept in SQLite.
+    Saving a session updates it, and sessions changed without it are indexed again before searching."""
+    filename = "index.sqlite3"
+    save_dir: Path
+
+    def __init__(self, save_dir: Path):
+        self.save_dir = save_dir
+
+    @property
+    def path(self) -> Path:
+        # In its own directory, because SQLite's journal files would otherwise make the manifest stale.
+        return self.save_dir / "search" / self.filename
+
+    def _connect(self, retry: bool = True) -> sqlite3.Connection:
+        self.path.parent.mkdir(exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # The index can always be rebuilt from the sessions
+            connection.executescript(SCHEMA)
+        except sqlite3.DatabaseError as e:
+            connection.close()
+            if not retry or isinstance(e, sqlite3.OperationalError):  # Locked, rather than damaged
+                raise
+            self.path.unlink(missing_ok=True)
+            return self._connect(retry=False)
+        return connection
+
+    def update(self, session_id: int, commands: Sequence[CommandData], start: int, mtime: float) -> None:
+        """Indexes the commands from start on, which replace the ones indexed there before. mtime is that of
+        the session file, which tells if the session changed since."""
+        connection = self._connect()
+        try:
+            with connection:
+                self._update(connection, session_id, commands, start, mtime)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _update(connection: sqlite3.Connection, session_id: int, commands: Sequence[CommandData], start: int,
+                mtime: float) -> None:
+        indexed = connection.execute("SELECT COUNT(*) FROM entries WHERE session = ?", (session_id,)).fetchone()[0]
+        start = min(start, indexed)
+        SearchIndex._remove(connection, session_id, start)
+        for position in range(start, len(commands)):
+            command = commands[position]
+            entry = connection.execute("INSERT INTO entries (session, position) VALUES (?, ?)",
+                                       (session_id, position)).lastrowid
+            connection.execute("INSERT INTO text (rowid, command, stdin, ai_response) VALUES (?, ?, ?, ?)",
+                               (entry, command.command, command.stdin, command.ai_response))
+        connection.execute("INSERT OR REPLACE INTO sessions (id, mtime, commands) VALUES (?, ?, ?)",
+                           (session_id, mtime, len(commands)))
+
+    @staticmethod
+    def _remove(connection: sqlite3.Connection, session_id: int, start: int = 0) -> None:
+        entries = [(row[0],) for row in connection.execute(
+            "SELECT id FROM entries WHERE session = ? AND position >= ?", (session_id, start))]
+        connection.executemany("DELETE FROM text WHERE rowid = ?", entries)
+        connection.executemany("DELETE FROM entries WHERE id = ?", entries)
+
+    def refresh(self, session_manager: SessionManager) -> int:
+        """Indexes the sessions that changed since they were indexed, according to the manifest, and forgets
+        deleted ones. Returns the number of sessions indexed."""
+        connection = self._connect()
+        try:
+            # Every save appends to the manifest, so if it didn't change, neither did the sessions.
+            manifest = session_manager.manifest
+            manifest_stat = None
+            if manifest.is_fresh():
+                stat = manifest.path.stat()
+                manifest_stat = f"{stat.st_mtime_ns}:{stat.st_size}"
+                row = connection.execute("SELECT value FROM properties WHERE name = 'manifest'").fetchone()
+                if row is not None and row[0] == manifest_stat:
+                    return 0
+            known = {row[0]: (row[1], row[2]) for row in connection.execute("SELECT id, mtime, commands FROM sessions")}
+            indexed = 0
+            for entry in session_manager.list_sessions():
+                if known.pop(entry.id, None) == (entry.mtime, entry.commands):
+                    continue
+                try:
+                    commands = list(CommandSession.from_file(session_manager.session_path(entry.id)).commands)
+                except (ValueError, KeyError, TypeError, OSError):
+                    commands = []  # Recorded anyway, so that it isn't read again until it changes
+                with connection:
+                    self._update(connection, entry.id, commands, 0, entry.mtime)
+                indexed += 1
+            with connection:
+                for session_id in known:
+                    self._remove(connection, session_id)
+                    connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                if manifest_stat is not None:
+                    connection.execute("INSERT OR REPLACE INTO properties (name, value) VALUES ('manifest', ?)",
+                                       (manifest_stat,))
+            return indexed
+        finally:
+            connection.close()
+
+    def search(self, query: str, limit: int = 20) -> list[SearchResult]:
+        """The sessions that best match the query, with their best matching command, best first."""
+        match = match_query(query)
+        if match is None:
+            return []
+        connection = self._connect()
+        try:
+            # Every command of a session can match, so more rows than sessions are ranked, and more if needed.
+            window = limit * 8
+            while True:
+                rows = connection.execute(
+                    "SELECT entries.session, entries.position, text.rowid, bm25(text, ?, ?, ?) AS rank "
+                    "FROM text JOIN entries ON entries.id = text.rowid WHERE text MATCH ? ORDER BY rank LIMIT ?",
+                    (*COLUMN_WEIGHTS, match, window)).fetchall()
+                best: dict[int, tuple[int, int, float]] = {}
+                for session, position, entry, rank in rows:
+                    if session not in best:
+                        best[session] = (position, entry, rank)
+                        if len(best) == limit:
+                            break
+                if len(best) == limit or len(rows) < window:
+                    break
+                window *= 4
+            results = []
+            # Snippets take long to make, so only the shown ones are made.
+            for session, (position, entry, rank) in best.items():
+                command, snippet = connection.execute(
+                    "SELECT command, snippet(text, -1, '[', ']', '...', 12) FROM text WHERE text MATCH ? AND rowid = ?",
+                    (match, entry)).fetchone()
+                results.append(SearchResult(session, position, command, " ".join(snippet.split()), rank))
+            return results
+        finally:
+            connection.close()
+
+
+def update_index(session: CommandSession, start: int) -> None:
+    """Called while a session is saved, with the index of its first changed command."""
+    try:
+        stat = session.path.stat()  # The same as the manifest records
+        SearchIndex(Path(session.save_dir)).update(session.id, session.commands, start, stat.st_mtime)
+    except (sqlite3.Error, OSError):
+        pass  # Saving must not fail because of the index. The next search indexes the session again.
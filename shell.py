@@ -1,14 +1,30 @@
 import os
 import sys
 from pathlib import Path
-from typing import Iterable, Optional, Sequence, Any
+from typing import AsyncIterator, Iterable, Optional, Sequence, Any, TextIO, TYPE_CHECKING
+from contextlib import redirect_stdout, redirect_stderr
 import argparse
 import re
+import threading
 
 from command_data import CommandData, SessionManager
 from assistant import Assistant
 from abbreviation import abbreviation
 from cli import get_arg_parser
+from stdin_capture import StdinCapture, capture_stdin
+from backends import ModelBackend, make_backend, with_model
+from config import keep_alive, load_config, setting
+from response_cache import ResponseCache, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE
+from timings import Timings, format_duration, server_summary
+from endpoint_pool import EndpointPool
+from embedding_index import EmbeddingIndex, make_embedder
+from model_router import ModelRouter, ModelTier
+from prompts import default_prompt, render_command
+from renderer import StreamRenderer
+
+if TYPE_CHECKING:
+    import asyncio
+    from search_index import SearchResult
 
 
 def parse_command_history(history: str) -> list[tuple[int, str]]:
@@ -22,69 +38,416 @@ def parse_command_history(history: str) -> list[tuple[int, str]]:
     return result
 
 
-def get_command_history() -> str:
-    history = os.environ.get("HISTORY")
-    if history is None:
+def parse_last_command(history: str) -> tuple[int, str]:
+    """Parses only the last entry of the history, which is the command kj was invoked with."""
+    history = history.rstrip()
+    line = history[history.rfind('\n') + 1:]
+    re_match = re.match(r"^(\d+)\ {2}(.*)$", line.strip())
+    if re_match is None:
+        raise EnvironmentError(f"Could not parse command history. There's either a bug in the parser, "
+                               f"or a weird bash shell. Unparsed line:\n{line}")
+    return int(re_match.group(1)), re_match.group(2)
+
+
+def get_command_history(history: str | None = None) -> str:
+    """The history sent by the client of the daemon, or else the one in the environment."""
+    history = history if history is not None else os.environ.get("HISTORY")
+    if not history:
         raise EnvironmentError("Command history is not available. Check if alias is present.")
     return history
 
 
-def read_stdin(forward_input: bool=True) -> str:
-    output = ""
-    for line in sys.stdin:
-        if forward_input:
-            print(line, end="", flush=True)
-        output += line
-    return output
+def read_stdin(forward_input: bool=True, head_lines: int | None = None, tail_lines: int | None = None,
+               spill_path: Path | None = None, compact: bool = False,
+               stdin: TextIO | None = None, stdout: TextIO | None = None) -> StdinCapture:
+    """Reads stdin in chunks, keeping only the first head_lines and last tail_lines in memory."""
+    stdout = stdout if stdout is not None else sys.stdout
+    return capture_stdin(stdin if stdin is not None else sys.stdin, echo=stdout if forward_input else None,
+                         head_lines=head_lines, tail_lines=tail_lines, spill_path=spill_path, compact=compact)
 
 
-"""Takes an iterable of Any and prints all strings as they arrive. Returns the full printed string"""
-def print_ai_response(response_iter: Iterable[Any]) -> str:
-    response = ""
+def print_ai_response(response_iter: Iterable[Any], out: TextIO | None = None, markdown: bool = False) -> str:
+    """Prints the strings of response_iter as they arrive, a few at a time. Returns the full printed string."""
+    out = out if out is not None else sys.stdout
+    renderer = StreamRenderer(markdown)
+    chunks = []
     for chunk in response_iter:
         if isinstance(chunk, str):
-            print(chunk, end="", flush=True)
-            response += chunk
-        
-    print()
-    return response
+            chunks.append(chunk)
+            if (text := renderer.feed(chunk)) is not None:
+                print(text, end="", flush=True, file=out)
+    print(renderer.finish(), file=out)
+    return "".join(chunks)
+
+
+async def render(queue: "asyncio.Queue[str | None]", out: TextIO, renderer: StreamRenderer) -> None:
+    """Prints chunks from the queue until it gets None. Chunks that arrive shortly after a write wait for the
+    next one, and writing happens in a thread, so that a slow terminal doesn't hold up the stream."""
+    import asyncio
+
+    def write(text: str) -> None:
+        print(text, end="", flush=True, file=out)
+
+    while True:
+        try:
+            chunk = await asyncio.wait_for(queue.get(), renderer.due())
+        except TimeoutError:
+            await asyncio.to_thread(write, renderer.flush())
+            continue
+        if chunk is None:
+            break
+        if (text := renderer.feed(chunk)) is not None:
+            await asyncio.to_thread(write, text)
+    print(renderer.finish(), file=out)
+
+
+async def print_ai_response_async(response_iter: AsyncIterator[str], out: TextIO, markdown: bool = False) -> None:
+    import asyncio
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+    renderer = asyncio.create_task(render(queue, out, StreamRenderer(markdown)))
+    try:
+        async for chunk in response_iter:
+            queue.put_nowait(chunk)
+    finally:
+        queue.put_nowait(None)
+        await renderer
+
+
+def use_markdown(when: str, out: TextIO) -> bool:
+    """Answers are formatted for a terminal, but left as they are when piped to a file or another program."""
+    if when not in ("auto", "always", "never"):
+        raise argparse.ArgumentTypeError(f"--markdown must be auto, always or never, not '{when}'.")
+    return when == "always" or when == "auto" and out.isatty()
 
 
 def welcome_message(session_id: int) -> str:
     return f"{abbreviation} command line assistant. Session {session_id}"
 
 
-def shell(argv: Optional[Sequence[str]] = None) -> int:
-    history = get_command_history()
-    parsed_history = parse_command_history(history)
-    last_command = parsed_history[-1][1]
+def format_search_result(result: "SearchResult") -> str:
+    return f"{result.session:>6}  {result.command}\n        {result.snippet}"
 
-    parser = get_arg_parser()
-    args = parser.parse_args(argv)
 
-    if args.switch_session == "interactive":
-        raise NotImplementedError("This will be an interactive way to pick a session.")  # pragma: no cover - TODO: Implement
-    if args.switch_session is not None and (not args.switch_session.isdigit() or int(args.switch_session) < 0):
+def search_sessions(session_manager: SessionManager, query: str, limit: int = 20) -> list["SearchResult"]:
+    from search_index import SearchIndex
+    index = SearchIndex(session_manager.path)
+    index.refresh(session_manager)
+    return index.search(query, limit)
+
+
+def print_search_results(session_manager: SessionManager, query: str, out: TextIO) -> int:
+    results = search_sessions(session_manager, query)
+    if not results:
+        print(f"No sessions match '{query}'.", file=out)
+        return 1
+    for result in results:
+        print(format_search_result(result), file=out)
+    return 0
+
+
+def select_session(session_manager: SessionManager, terminal: TextIO, out: TextIO, limit: int = 10) -> int | None:
+    """Lists the most recent sessions, or the ones matching what the user types, until the user picks one by id.
+    Returns None if the user gives up with an empty line or Ctrl+D."""
+    sessions = session_manager.list_sessions()
+    shown = [f"{entry.id:>6}  {entry.title or ''}" for entry in reversed(sessions[-limit:])]
+    while True:
+        print("\n".join(shown) if shown else "No matching sessions.", file=out)
+        print("Session id, or words to search for: ", end="", flush=True, file=out)
+        answer = terminal.readline().strip()
+        if not answer:
+            return None
+        if answer.isdigit() and any(entry.id == int(answer) for entry in sessions):
+            return int(answer)
+        shown = [format_search_result(result) for result in search_sessions(session_manager, answer, limit)]
+
+
+def open_terminal(stdin: TextIO | None) -> TextIO:
+    """The stream to ask the user on. stdin is usually the output of a piped command, so this is the terminal."""
+    stream = stdin if stdin is not None else sys.stdin
+    if stream.isatty():
+        return stream
+    try:
+        return open("/dev/tty", encoding="utf-8")
+    except OSError:
+        raise argparse.ArgumentTypeError("picking a session needs a terminal. use --search and --switch-session ID.")
+
+
+_redirect_lock = threading.Lock()
+
+
+def parse_args(argv: Optional[Sequence[str]], stdout: TextIO, stderr: TextIO) -> argparse.Namespace:
+    """Parses the arguments, sending --help and usage errors to the given streams instead of sys.stdout/sys.stderr."""
+    with _redirect_lock, redirect_stdout(stdout), redirect_stderr(stderr):
+        return get_arg_parser().parse_args(argv)
+
+
+def shell(argv: Optional[Sequence[str]] = None, stdin: TextIO | None = None, stdout: TextIO | None = None,
+          stderr: TextIO | None = None, history: str | None = None,
+          session_managers: dict[Path, SessionManager] | None = None, cwd: Path | None = None) -> int:
+    """Runs one kj invocation. The streams, history, session managers and working directory can be passed in
+    by the daemon, which serves several invocations at the same time and keeps the session managers between them."""
+    timings = Timings()
+    cwd = cwd if cwd is not None else Path.cwd()
+    out = stdout if stdout is not None else sys.stdout
+    err = stderr if stderr is not None else sys.stderr
+    args = parse_args(argv, out, err)
+    last_command = ""
+    if not args.batch and not args.warm:  # These can run outside of an interactive shell, like from cron
+        with timings.span("history"):
+            last_command = parse_last_command(get_command_history(history))[1]
+
+    if args.switch_session not in (None, "interactive") and not args.switch_session.isdigit():
         raise argparse.ArgumentTypeError("session id must be non-negative integer.")
     
-    session_manager = SessionManager(Path(args.path), new_session=args.new_session)
-    assistant = Assistant(session_manager, session_id=args.switch_session, verbose=args.verbose)
+    config = load_config(cwd / args.config)
+    try:
+        backend = make_backend(setting(args, config, "backend", "ollama"), model=setting(args, config, "model"),
+                               endpoint=setting(args, config, "endpoint"),
+                               options={**config.get("options", {}), **dict(args.option or [])},
+                               timeout=setting(args, config, "timeout"),
+                               keep_alive=keep_alive(setting(args, config, "keep_alive")))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+    path = cwd / args.path
+    if session_managers is None:
+        session_manager = SessionManager(path, new_session=args.new_session)
+    else:
+        if path not in session_managers:
+            session_managers[path] = SessionManager(path)
+        session_manager = session_managers[path]
+        if args.new_session:
+            session_manager.create_new_session()
+    if args.search:
+        return print_search_results(session_manager, " ".join(args.search), out)
+    pool: EndpointPool | None = getattr(backend, "pool", None)
+    if pool is not None and (len(pool.endpoints) > 1 or args.check_endpoints):
+        pool.load(path / "endpoints" / "stats.json")
+        if args.check_endpoints:
+            pool.check_all()
+            print(pool.report(), file=out)
+            return 0 if pool.up() else 1
+        pool.check_in_background()
+    if args.gc:
+        removed, size = session_manager.collect_garbage()
+        print(f"Removed {removed} unused stdin blobs ({size} bytes).", file=out)
+        return 0
+    session_id = None
+    if args.switch_session == "interactive":
+        if session_managers is not None:  # Run by the daemon, whose terminal is not the user's
+            raise argparse.ArgumentTypeError("picking a session needs a terminal. the client runs it without the daemon.")
+        terminal = open_terminal(stdin)
+        try:
+            session_id = select_session(session_manager, terminal, out)
+        finally:
+            if terminal is not stdin and terminal is not sys.stdin:
+                terminal.close()
+        if session_id is None:
+            return 1
+    elif args.switch_session is not None:
+        session_id = int(args.switch_session)
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(path / "cache", max_bytes=setting(args, config, "cache_max_bytes", DEFAULT_MAX_BYTES),
+                              max_age=setting(args, config, "cache_max_age", DEFAULT_MAX_AGE))
+    related = setting(args, config, "related", 0)
+    embeddings = None
+    if related:
+        try:
+            name = setting(args, config, "embedder", "hashing")
+            settings = {"model": config.get("embedding_model"),
+                        "endpoint": config.get("embedding_endpoint", backend.endpoint)} if name == "ollama" else {}
+            embedder = make_embedder(name, **settings)
+            embeddings = EmbeddingIndex.create(path, embedder)
+        except ImportError:
+            raise argparse.ArgumentTypeError("--related needs numpy. install it with 'pip install numpy'.")
+        except (ValueError, TypeError) as e:
+            raise argparse.ArgumentTypeError(str(e))
+    router = None
+    if config.get("models") and args.model is None:  # A model on the command line wins
+        try:
+            router = ModelRouter([ModelTier.from_config(tier) for tier in config["models"]],
+                                 path / "router" / "models.json")
+        except (ValueError, TypeError) as e:
+            raise argparse.ArgumentTypeError(str(e))
+    if args.warm:
+        return run_warm(args, warm_backend(backend, router), default_prompt(path), cwd, argv, out, err)
+    if args.batch:
+        return run_batch(args, config, backend, session_manager, session_id, cwd, cache, out, err)
+    assistant = Assistant(session_manager, session_id=session_id, verbose=args.verbose,
+                          ai_api=backend, model=backend.model,
+                          incremental=not args.no_context, token_budget=args.token_budget,
+                          cache=cache,
+                          timings=timings, embeddings=embeddings, related=related, router=router)
 
-    print(welcome_message(assistant.session.id))
+    print(welcome_message(assistant.session.id), file=out)
     if assistant.initial_message:
-        print(assistant.initial_message)
+        print(assistant.initial_message, file=out)
     
+    if args.follow:
+        return run_follow(args, config, assistant, last_command, stdin, out)
+    spill_path = None
+    if args.spill_stdin:
+        spill_path = path / "stdin" / f"session.{assistant.session.id}.{len(assistant.session.commands)}.log"
+    preparing = None
+    if not args.listen:
+        # Load the earlier commands of the session while the piped command is still running.
+        preparing = threading.Thread(target=assistant.prepare, daemon=True)
+        preparing.start()
+        if config.get("warm_on_start", False) and not (stdin if stdin is not None else sys.stdin).isatty():
+            warm_in_background(warm_backend(backend, router), default_prompt(path))
     try:
         # Don't echo the input to the terminal, if the user didn't use a pipe.
-        output = read_stdin(forward_input=not last_command.startswith(abbreviation))
+        with timings.span("stdin"):
+            captured_stdin = read_stdin(forward_input=not last_command.startswith(abbreviation), head_lines=args.stdin_head,
+                                        tail_lines=args.stdin_tail, spill_path=spill_path,
+                                        compact=not args.raw_stdin, stdin=stdin, stdout=out)
     except KeyboardInterrupt:  # Just exit if the user presses Ctrl+C
         exit(0)
+    if args.verbose:
+        print(captured_stdin.report(), file=out)
  
-    cmd = CommandData(command=last_command, stdin=output, ai_response="")
+    cmd = CommandData(command=last_command, stdin=captured_stdin.text, ai_response="",
+                      stdin_omitted=captured_stdin.omitted_lines, stdin_spill=captured_stdin.spill_path)
 
-    print_ai_response(assistant.new_command(cmd, give_ai_response=not args.listen))
+    if preparing is None:
+        print_ai_response(assistant.new_command(cmd, give_ai_response=False), out=out)
+        return 0
+    preparing.join()
 
+    import asyncio
+    try:
+        asyncio.run(print_ai_response_async(assistant.anew_command(cmd, deadline=args.deadline), out,
+                                            markdown=use_markdown(setting(args, config, "markdown", "auto"), out)))
+    except KeyboardInterrupt:
+        print(f"[{abbreviation}: interrupted]", file=out)
+        return 130
+    except TimeoutError:
+        if args.deadline is None:
+            raise
+        print(f"[{abbreviation}: no complete answer within {args.deadline:g} seconds]", file=out)
+        return 1
+    finally:
+        report_timings(args, config, timings, path, assistant.session.id, assistant.model, out)
     return 0
 
+
+def run_batch(args: argparse.Namespace, config: dict[str, Any], backend: ModelBackend, session_manager: SessionManager,
+              session_id: int | None, cwd: Path, cache: ResponseCache | None, out: TextIO, err: TextIO) -> int:
+    """Answers every input of --batch, printing the results as JSON lines or writing them to --batch-output,
+    and the statistics of the batch to err. Returns 1 if any input failed."""
+    import asyncio
+    from batch import DEFAULT_JOBS, BatchResult, BatchRunner, BatchWriter, read_inputs
+    try:
+        inputs = read_inputs(cwd / args.batch, head_lines=args.stdin_head, tail_lines=args.stdin_tail,
+                             compact=not args.raw_stdin)
+        runner = BatchRunner(backend, backend.model, default_prompt(session_manager.path), session_manager.path,
+                             token_budget=args.token_budget, jobs=setting(args, config, "jobs", DEFAULT_JOBS),
+                             rate=setting(args, config, "rate"), cache=cache, deadline=args.deadline)
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"can't run the batch: {e}")
+    on_result = None
+    if args.record:
+        session = session_manager.load_most_recent_session() if session_id is None else session_manager.load(session_id)
+
+        def on_result(result: BatchResult) -> None:
+            render_command(result.command)  # Stores the token count with the session, like a command answered alone
+            session.commands.append(result.command)
+            session.save()
+    writer = BatchWriter(cwd / args.batch_output if args.batch_output else None, out)
+    try:
+        stats = asyncio.run(runner.run(inputs, writer, on_result))
+    except KeyboardInterrupt:
+        print(f"[{abbreviation}: interrupted]", file=err)
+        return 130
+    finally:
+        writer.close()
+    print(stats.report(), file=err)
+    return 1 if stats.failed else 0
+
+
+def run_follow(args: argparse.Namespace, config: dict[str, Any], assistant: Assistant, last_command: str,
+               stdin: TextIO | None, out: TextIO) -> int:
+    """Answers about stdin each time a trigger of --follow fires, until it ends or the user presses Ctrl+C."""
+    import asyncio
+    from follow import DEFAULT_IDLE, FollowTriggers, follow
+    from log_compaction import IMPORTANT
+    if args.listen:
+        raise argparse.ArgumentTypeError("--follow answers as the input arrives, so it can't be used with --listen.")
+    pattern = setting(args, config, "follow_pattern")
+    try:
+        triggers = FollowTriggers(pattern=IMPORTANT if pattern is None else re.compile(pattern, re.IGNORECASE)
+                                  if pattern else None,
+                                  lines=setting(args, config, "follow_lines") or None,
+                                  idle=setting(args, config, "follow_idle", DEFAULT_IDLE) or None)
+    except re.error as e:
+        raise argparse.ArgumentTypeError(f"invalid --follow-pattern: {e}")
+    markdown = use_markdown(setting(args, config, "markdown", "auto"), out)
+
+    def answer(command: CommandData, reason: str) -> None:
+        print(f"[{abbreviation}: {reason}]", file=out)
+        try:
+            asyncio.run(print_ai_response_async(assistant.anew_command(command, deadline=args.deadline), out, markdown))
+        except (OSError, ValueError) as e:  # Including TimeoutError. The next trigger tries again.
+            print(f"[{abbreviation}: no answer: {str(e) or type(e).__name__}]", file=out)
+
+    try:
+        follow(stdin if stdin is not None else sys.stdin, last_command, answer, args.stdin_tail, triggers,
+               echo=None if last_command.startswith(abbreviation) else out, clean=not args.raw_stdin)
+    except KeyboardInterrupt:
+        print(f"[{abbreviation}: interrupted]", file=out)
+        return 130
+    finally:
+        report_timings(args, config, assistant.timings, assistant.session_manager.path, assistant.session.id,
+                       assistant.model, out)
+    return 0
+
+
+def warm_backend(backend: ModelBackend, router: ModelRouter | None) -> ModelBackend:
+    """The backend of the model to warm: the lightest of the router, which is picked for short commands."""
+    return with_model(backend, router.tiers[0].model) if router is not None else backend
+
+
+def warm_in_background(backend: ModelBackend, system_prompt: str) -> None:
+    def warm() -> None:
+        try:
+            backend.warm(system_prompt)
+        except (OSError, ValueError):
+            pass  # The answer will load the model
+
+    threading.Thread(target=warm, daemon=True).start()
+
+
+def run_warm(args: argparse.Namespace, backend: ModelBackend, system_prompt: str, cwd: Path,
+             argv: Optional[Sequence[str]], out: TextIO, err: TextIO) -> int:
+    """Loads the model and lets it read the system prompt. In the background, that is done by a new process
+    that outlives this one, so that a shell rc file doesn't wait for it."""
+    if args.warm == "background":
+        import subprocess
+        subprocess.Popen([sys.executable, str(Path(__file__)), *(sys.argv[1:] if argv is None else argv), "--warm", "wait"],
+                         cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+        return 0
+    timings = Timings()
+    try:
+        timings.server = backend.warm(system_prompt)
+    except (OSError, ValueError) as e:
+        print(f"[{abbreviation}: couldn't warm {backend.model}: {e}]", file=err)
+        return 1
+    state = {None: "", True: ", which wasn't loaded", False: ", which was loaded already"}[timings.cold_start()]
+    print(f"Warmed {backend.model}{state} in {format_duration(timings.total)}.", file=out)
+    if args.verbose and timings.server:
+        print(f"Server: {server_summary(timings.server)}", file=out)
+    return 0
+
+
+def report_timings(args: argparse.Namespace, config: dict[str, Any], timings: Timings, path: Path,
+                   session_id: int, model: str, out: TextIO) -> None:
+    if args.timings:
+        print(timings.summary(), file=out)
+    if args.metrics or config.get("metrics", False):
+        Timings.append(path / "metrics" / f"session.{session_id}.jsonl",
+                       timings.record(session=session_id, model=model, backend=setting(args, config, "backend", "ollama")))
+
 if __name__ == '__main__':
     exit(shell())  # pragma: no cover - I don't know to test this.
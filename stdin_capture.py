@@ -0,0 +1,189 @@
+import codecs
+import io
+import os
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Iterable, Iterator
+from abbreviation import abbreviation
+from log_compaction import CompactionStats, LogCompactor, compact_lines
+
+
+CHUNK_SIZE = 1 << 16
+MAX_LINE_LENGTH = 2000
+
+
+@dataclass
+class StdinCapture:
+    text: str
+    lines: int
+    bytes: int
+    omitted_lines: int
+    spill_path: str | None
+    compaction: CompactionStats | None = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.omitted_lines > 0
+
+    def report(self) -> str:
+        report = f"Read {self.lines} lines ({self.bytes} bytes) from stdin."
+        if self.compaction is not None:
+            report += " " + self.compaction.report()
+        if self.truncated:
+            report += f" Left out {self.omitted_lines} lines in the middle."
+        return report
+
+
+def read_chunks(stream: IO[str], echo: IO[str] | None = None, spill: IO[bytes] | None = None,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[str, int]]:
+    """Yields the stream as decoded chunks and their size in bytes, as soon as data is available.
+    Every chunk is echoed and spilled with one write, instead of one write per line."""
+    try:
+        fd = stream.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        fd = None
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        if fd is not None:
+            raw = os.read(fd, chunk_size)  # Returns whatever is available, so slow pipes are echoed immediately
+            text = decoder.decode(raw, final=not raw)
+            size = len(raw)
+        else:
+            text = stream.read(chunk_size)
+            raw = text.encode("utf-8", errors="replace")
+            size = len(raw)
+        if spill is not None and raw:
+            spill.write(raw)
+        if echo is not None and text:
+            echo.write(text)
+            echo.flush()
+        if text:
+            yield text, size
+        if not size:
+            return
+
+
+def split_lines(chunks: Iterable[str], max_line_length: int = MAX_LINE_LENGTH,
+                overwrite_carriage_returns: bool = False) -> Iterator[str]:
+    """Splits chunks into lines (with their line endings). Lines longer than max_line_length are shortened,
+    and a line is never buffered beyond that length, even if the input contains no newlines.
+    With overwrite_carriage_returns, a lone carriage return discards the line so far, like it would in a
+    terminal, so that only the final state of a progress bar is kept."""
+    pending: list[str] = []
+    pending_length = 0
+    overflow = 0
+    trailing_cr = False
+
+    def finish(ending: str) -> str:
+        line = "".join(pending)
+        if overflow:
+            line += f" [{abbreviation}: {overflow} more characters]"
+        return line + ending
+
+    for chunk in chunks:
+        start = 0
+        if trailing_cr and not chunk.startswith("\n"):
+            pending, pending_length, overflow = [], 0, 0
+        trailing_cr = False
+        while start < len(chunk):
+            newline = chunk.find("\n", start)
+            end = len(chunk) if newline == -1 else newline
+            if overwrite_carriage_returns:
+                # A carriage return right before a newline, or at the end of the chunk, may be part of "\r\n".
+                search_end = end - 1 if chunk.endswith("\r", start, end) else end
+                trailing_cr = newline == -1 and search_end < end
+                carriage_return = chunk.rfind("\r", start, search_end)
+                if carriage_return != -1:
+                    pending, pending_length, overflow = [], 0, 0
+                    start = carriage_return + 1
+            room = max_line_length - pending_length
+            if room > 0:
+                piece = chunk[start:min(end, start + room)]
+                pending.append(piece)
+                pending_length += len(piece)
+            overflow += max(0, end - start - max(room, 0))
+            if newline == -1:
+                break
+            yield finish("\n")
+            pending, pending_length, overflow = [], 0, 0
+            start = newline + 1
+    if pending or overflow:
+        yield finish("")
+
+
+class StdinWindow:
+    """Keeps the first head_lines and the last tail_lines of a stream. None keeps every line."""
+    head_lines: int | None
+    tail_lines: int | None
+    head: list[str]
+    tail: deque[str]
+    lines: int
+
+    def __init__(self, head_lines: int | None = None, tail_lines: int | None = None):
+        self.head_lines = head_lines
+        self.tail_lines = tail_lines
+        self.head = []
+        self.tail = deque(maxlen=tail_lines)
+        self.lines = 0
+
+    def feed(self, line: str) -> None:
+        self.lines += 1
+        if self.head_lines is None or self.tail_lines is None or len(self.head) < self.head_lines:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    @property
+    def omitted_lines(self) -> int:
+        return self.lines - len(self.head) - len(self.tail)
+
+    def text(self, total_bytes: int, spill_path: str | None = None) -> str:
+        if not self.omitted_lines:
+            return "".join(self.head) + "".join(self.tail)
+        head = "".join(self.head)
+        if head and not head.endswith("\n"):
+            head += "\n"
+        where = f" The full input is in {spill_path}." if spill_path else ""
+        marker = f"[{abbreviation}: {self.omitted_lines} of {self.lines} lines ({total_bytes} bytes) " \
+                 f"were left out here.{where}]\n"
+        return head + marker + "".join(self.tail)
+
+
+def capture_stdin(stream: IO[str], echo: IO[str] | None = None, head_lines: int | None = None,
+                  tail_lines: int | None = None, spill_path: Path | None = None, compact: bool = False) -> StdinCapture:
+    """Reads the whole stream, keeping only the head/tail window of it in memory.
+    With compact, the lines are cleaned up and repetitive lines are collapsed before they reach the window."""
+    window = StdinWindow(head_lines, tail_lines)
+    compactor = LogCompactor() if compact else None
+    total_bytes = 0
+    total_lines = 0
+
+    def counted_chunks(spill: IO[bytes] | None) -> Iterator[str]:
+        nonlocal total_bytes
+        for text, size in read_chunks(stream, echo, spill):
+            total_bytes += size
+            yield text
+
+    def lines(spill: IO[bytes] | None) -> Iterator[str]:
+        nonlocal total_lines
+        for line in split_lines(counted_chunks(spill), overwrite_carriage_returns=compact):
+            total_lines += 1
+            yield line
+
+    def fill_window(spill: IO[bytes] | None) -> None:
+        for line in (compact_lines(lines(spill), compactor) if compactor is not None else lines(spill)):
+            window.feed(line)
+
+    if spill_path is not None:
+        spill_path.parent.mkdir(parents=True, exist_ok=True)
+        with spill_path.open("wb") as spill:
+            fill_window(spill)
+    else:
+        fill_window(None)
+
+    spill_name = str(spill_path) if spill_path is not None else None
+    return StdinCapture(text=window.text(total_bytes, spill_name), lines=total_lines, bytes=total_bytes,
+                        omitted_lines=window.omitted_lines, spill_path=spill_name,
+                        compaction=compactor.stats if compactor is not None else None)
@@ -1,17 +1,46 @@
 import pytest
 import io
+import os
 import json
 from pathlib import Path
-from typing import Generator
+from typing import Generator, Any, TextIO, cast
 import argparse
+import asyncio
 import time
+import threading
+import subprocess
+import sys
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from abbreviation import abbreviation
-from command_data import CommandData, CommandSession, SessionManager
+from command_data import BLOB_THRESHOLD, BlobStore, CommandData, CommandSession, CommandList, SessionManager
+from command_data import atomic_write_bytes, read_stats, write_stats
 from assistant import Assistant
-from ollamaapi import query_ollama
+from ollamaapi import Chunk, query_ollama
 from shell import *
 from cli import get_arg_parser
+from prompts import default_prompt, prompt_source_hash
+from daemon import KjDaemon
+from fake_model_server import FakeModelServer
+import bench
+from kj_client import connect, run_remote
+import kj_client
+from config import keep_alive, load_config, parse_option, setting
+from backends import ModelBackend, OpenAICompatibleBackend, make_backend
+from stdin_capture import capture_stdin, split_lines
+from log_compaction import LogCompactor, compact_lines
+from response_cache import CacheStats, ResponseCache
+from timings import Timings, server_summary
+from search_index import SearchIndex, match_query
+from endpoint_pool import EndpointPool
+from batch import BatchResult, BatchRunner, BatchWriter, read_inputs
+from follow import ERROR_SETTLE, FollowTriggers, FollowWindow
+from model_router import ModelRouter, ModelTier
+from renderer import BOLD, CODE, RESET, MarkdownFormatter, StreamRenderer
+from embedding_index import EmbeddingIndex, HashingEmbedder, RelatedCommand, make_embedder, related_commands
+import socket
+from prompts import build_prompt, command_session_to_prompt, command_to_prompt, command_tokens, estimate_tokens, render_command
 
 
 def test_session_save(tmp_path: Path) -> None:
@@ -20,14 +49,14 @@ def test_session_save(tmp_path: Path) -> None:
                              context=[])
     session.save()
 
-    path = tmp_path / "session.0.json"
-    session_dict = json.loads(path.read_text(encoding="utf-8"))
-    assert session_dict["id"] == 0
-    assert session_dict["prompt"] == "Hello"
-    assert session_dict["save_dir"] == str(tmp_path)
-    assert session_dict["commands"][0]["command"] == "fake command"
-    assert session_dict["commands"][0]["stdin"] == "fake output"
-    assert session_dict["commands"][0]["ai_response"] == "OK"
+    path = tmp_path / "session.0.jsonl"
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [record["kind"] for record in records] == ["header", "command", "footer"]
+    assert records[0]["id"] == 0
+    assert records[2]["prompt"] == "Hello"
+    assert records[1]["command"] == "fake command"
+    assert records[1]["stdin"] == "fake output"
+    assert records[1]["ai_response"] == "OK"
 
 
 def test_create_new_session(tmp_path: Path) -> None:
@@ -36,14 +65,12 @@ def test_create_new_session(tmp_path: Path) -> None:
     session_manager = SessionManager(tmp_path)
     session0 = session_manager.create_new_session("Hello")
     assert session0.id == 0
-    session0_dict = json.loads((tmp_path / "session.0.json").read_text(encoding="utf-8"))
-    assert session0_dict["id"] == 0
+    assert CommandSession.from_file(tmp_path / "session.0.jsonl").id == 0
     for i in range(1, 5):
         (tmp_path / f"session.{i}.json").touch()
     session5 = session_manager.create_new_session("Hello")
     assert session5.id == 5
-    session5_dict = json.loads((tmp_path / "session.5.json").read_text(encoding="utf-8"))
-    assert session5_dict["id"] == 5
+    assert CommandSession.from_file(tmp_path / "session.5.jsonl").id == 5
 
 
 def test_find_most_recent_session(tmp_path: Path) -> None:
@@ -54,13 +81,13 @@ def test_find_most_recent_session(tmp_path: Path) -> None:
         time.sleep(0.01)
     most_recent_session_path = session_manager.find_most_recent_session()
     assert most_recent_session_path is not None
-    assert most_recent_session_path.name == "session.4.json"
+    assert most_recent_session_path.name == "session.4.jsonl"
     assert session_manager.sessions[2].prompt is not None
     session_manager.sessions[2].prompt += " World!"
     session_manager.sessions[2].save()
     most_recent_session_path = session_manager.find_most_recent_session()
     assert most_recent_session_path is not None
-    assert most_recent_session_path.name == f"session.{session_manager.sessions[2].id}.json"
+    assert most_recent_session_path.name == f"session.{session_manager.sessions[2].id}.jsonl"
 
 
 def test_session_from_file(tmp_path: Path) -> None:
@@ -75,12 +102,224 @@ def test_session_from_file(tmp_path: Path) -> None:
     loaded_session = CommandSession.from_file(tmp_path / session.filename)
     assert session == loaded_session
 
-    # Test of parser validation
-    session_dict = json.loads((tmp_path / session.filename).read_text(encoding="utf-8"))
-    session_dict["commands"] = {f'command_{i}': cmd for i, cmd in enumerate(session_dict["commands"])}
-    (tmp_path / session.filename).write_text(json.dumps(session_dict), encoding="utf-8")
+    # Test of parser validation for old json sessions
+    legacy_path = tmp_path / CommandSession.make_legacy_filename(session.id)
+    session_dict: dict[str, Any] = {"id": session.id, "prompt": session.prompt, "save_dir": session.save_dir, "context": [],
+                    "commands": {f'command_{i}': {"command": cmd.command, "stdin": cmd.stdin, "ai_response": cmd.ai_response}
+                                 for i, cmd in enumerate(session.commands)}}
+    legacy_path.write_text(json.dumps(session_dict), encoding="utf-8")
     with pytest.raises(TypeError):
-        CommandSession.from_file(tmp_path / session.filename)
+        CommandSession.from_file(legacy_path)
+
+
+def test_session_journal_appends(tmp_path: Path) -> None:
+    session = CommandSession(id=0, prompt="Hello", save_dir=str(tmp_path), commands=[], context=[])
+    session.commands.append(CommandData("first", "x" * 10000, "one"))
+    session.save()
+    path = tmp_path / session.filename
+    first_command = path.read_bytes()[:path.stat().st_size // 2]
+    session.commands.append(CommandData("second", "", "two"))
+    session.context = [1, 2, 3]
+    session.save()
+    assert path.read_bytes().startswith(first_command)
+
+    loaded_session = CommandSession.from_file(path)
+    assert isinstance(loaded_session.commands, CommandList)
+    assert not loaded_session.commands.is_loaded(0)
+    assert loaded_session.commands[-1].command == "second"
+    assert not loaded_session.commands.is_loaded(0)
+    assert loaded_session.context == [1, 2, 3]
+    loaded_session.commands.append(CommandData("third", "", "three"))
+    loaded_session.save()
+    assert not loaded_session.commands.is_loaded(0)
+    assert path.read_bytes().startswith(first_command)
+    assert [cmd.command for cmd in CommandSession.from_file(path).commands] == ["first", "second", "third"]
+
+    # Changing a command that is already in the journal rewrites the file
+    loaded_session.commands[0] = CommandData("replaced", "", "")
+    loaded_session.save()
+    assert [cmd.command for cmd in CommandSession.from_file(path).commands] == ["replaced", "second", "third"]
+
+
+def test_session_journal_recovers_interrupted_write(tmp_path: Path) -> None:
+    session = CommandSession(id=0, prompt="Hello", save_dir=str(tmp_path), commands=[], context=[])
+    for i in range(3):
+        session.commands.append(CommandData(f"command {i}", "", f"{i}"))
+    session.save()
+    path = tmp_path / session.filename
+    path.write_bytes(path.read_bytes()[:-10])
+    loaded_session = CommandSession.from_file(path)
+    assert [cmd.command for cmd in loaded_session.commands] == ["command 0", "command 1", "command 2"]
+    assert loaded_session.prompt == "Hello"  # From the header
+    loaded_session.commands.append(CommandData("command 3", "", "3"))
+    loaded_session.save()
+    assert len(CommandSession.from_file(path).commands) == 4
+    # A new prompt is written to the header too
+    loaded_session.prompt = "Goodbye"
+    loaded_session.save()
+    path.write_bytes(path.read_bytes()[:-10])
+    assert CommandSession.from_file(path).prompt == "Goodbye"
+
+
+def test_atomic_writes_and_stats(tmp_path: Path) -> None:
+    path = tmp_path / "stats" / "counts.json"
+    assert read_stats(path) == {}
+    write_stats(path, {"hits": 2})
+    assert read_stats(path) == {"hits": 2}
+    path.write_text("{damaged", encoding="utf-8")
+    assert read_stats(path) == {}
+    (tmp_path / "file").write_text("not a directory")
+    write_stats(tmp_path / "file" / "counts.json", {"hits": 1})  # Ignored
+    with pytest.raises(FileExistsError):
+        atomic_write_bytes(path, b"{}", exclusive=True)
+    assert read_stats(path) == {} and [p.name for p in path.parent.iterdir()] == ["counts.json"]
+
+
+def test_stdin_blobs(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    log = "".join(f"line {i}: ok\n" for i in range(1000))
+    for _ in range(2):
+        session = session_manager.create_new_session()
+        session.commands.extend([CommandData("make", log, "Fine."), CommandData("ls", "a b", "Two files.")])
+        session.save()
+    blobs = BlobStore.of(tmp_path)
+    assert len(list(blobs.path.iterdir())) == 1  # Shared by both sessions
+    assert session.path.stat().st_size < BLOB_THRESHOLD
+
+    loaded = CommandSession.from_file(session.path)
+    command = loaded.commands[0]
+    assert command.stdin_blob is not None and command.stdin_blob.size == len(log) and log.startswith(command.stdin_blob.preview)
+    assert command._stdin is None  # Read when the prompt needs it
+    assert f"<stdin>\n{log}\n</stdin>" in command_to_prompt(command)
+    assert loaded.commands == session.commands and loaded.commands[1].stdin_blob is None
+    loaded.commands[0] = CommandData("make", "replaced", "Fine.")  # Rewrites the journal
+    loaded.commands.append(CommandData("make", log + "more", "Still fine."))
+    loaded.save()
+    assert CommandSession.from_file(session.path).commands[0].stdin == "replaced"
+    assert len(list(blobs.path.iterdir())) == 2
+
+    session_manager.session_path(0).unlink()
+    monkeypatch.setenv("HISTORY", f"314  {abbreviation} --gc")
+    assert shell(["--path", str(tmp_path), "--gc"]) == 0
+    assert "Removed 1 unused stdin blobs" in capsys.readouterr().out
+    command = CommandSession.from_file(session.path).commands[2]
+    assert command.stdin_blob is not None and [path.name for path in blobs.path.iterdir()] == [f"{command.stdin_blob.hash}.z"]
+    assert command.stdin == log + "more"
+
+
+def test_migrate_legacy_sessions(tmp_path: Path) -> None:
+    legacy_path = tmp_path / "session.3.json"
+    legacy_path.write_text(json.dumps({"id": 3, "prompt": "Hello", "save_dir": str(tmp_path), "context": [7],
+                                       "commands": [{"command": "ls", "stdin": "a b", "ai_response": "OK"}]}),
+                           encoding="utf-8")
+    session_manager = SessionManager(tmp_path)
+    session = session_manager.load(3)
+    assert session.commands[0].stdin == "a b"
+    # Looking at the sessions the first time, without a manifest, migrates them
+    assert session_manager.find_most_recent_session() == tmp_path / "session.3.jsonl"
+    assert not legacy_path.exists()
+    assert session_manager.load(3) == session
+    (tmp_path / "session.4.json").write_text("{broken", encoding="utf-8")
+    assert session_manager.migrate_legacy_sessions() == [] and (tmp_path / "session.4.json").exists()
+
+def test_session_manifest(tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    for i in range(3):
+        session = session_manager.create_new_session("Hello")
+        session.commands.append(CommandData(f"command {i}", "", "OK"))
+        session.save()
+        time.sleep(0.01)
+    session_manager.sessions[1].save()
+    manifest = session_manager.manifest
+    assert manifest.is_fresh()
+    last_entry = manifest.last_entry()
+    assert last_entry is not None and last_entry.id == 1 and last_entry.next_id == 3
+    assert session_manager.find_most_recent_session() == tmp_path / "session.1.jsonl"
+    sessions = session_manager.list_sessions()
+    assert [entry.id for entry in sessions] == [0, 2, 1]
+    assert [entry.title for entry in sessions] == ["command 0", "command 2", "command 1"]
+    assert [entry.commands for entry in sessions] == [1, 1, 1]
+
+    # A missing manifest is rebuilt from the session files
+    manifest.path.unlink()
+    assert session_manager.create_new_session().id == 3
+    assert [entry.title for entry in session_manager.list_sessions()] == ["command 0", "command 2", "command 1", None]
+
+    # So is a stale one
+    (tmp_path / "session.3.jsonl").unlink()
+    time.sleep(0.01)
+    assert session_manager.find_most_recent_session() == tmp_path / "session.1.jsonl"
+    assert [entry.id for entry in session_manager.list_sessions()] == [0, 2, 1]
+
+
+def test_concurrent_saves_are_merged(tmp_path: Path) -> None:
+    session = SessionManager(tmp_path).create_new_session("Hello")
+    session.commands.append(CommandData("first", "", "1"))
+    session.context, session.context_commands = [1, 2], 1
+    session.save()
+    here, there = CommandSession.from_file(session.path), CommandSession.from_file(session.path)
+    len(here.commands[0].command)  # Only the first command is loaded
+    there.commands.append(CommandData("there", "", "2"))
+    there.save()
+    here.commands.append(CommandData("here", "", "3"))
+    here.save()
+    assert [command.command for command in here.commands] == ["first", "there", "here"]
+    loaded = CommandSession.from_file(session.path)
+    assert loaded == here
+    assert loaded.context == [] and loaded.context_commands == 0
+
+    # Invocations of the daemon share the manager, but each gets its own session
+    manager = SessionManager(tmp_path)
+    here, there = manager.load(session.id), manager.load(session.id)
+    assert here is not there and here.commands[0] is not there.commands[0]
+    there.commands.append(CommandData("there again", "", "4"))
+    there.save()
+    here.commands.append(CommandData("here again", "", "5"))
+    here.save()
+    assert [command.command for command in manager.load(session.id).commands] == \
+        ["first", "there", "here", "there again", "here again"]
+
+    # A session that was written by an exclusive save is never overwritten by another one
+    with pytest.raises(FileExistsError):
+        CommandSession(id=session.id, prompt=None, save_dir=str(tmp_path), commands=[], context=[]).save(exclusive=True)
+    assert CommandSession.from_file(session.path) == here
+    assert not [path for path in tmp_path.iterdir() if path.suffix == ".tmp"]
+
+
+STRESS_SCRIPT = """
+import sys
+from pathlib import Path
+from command_data import CommandData, SessionManager
+manager = SessionManager(Path(sys.argv[1]))
+created = []
+for i in range(5):
+    shared = manager.load(0)
+    shared.commands.append(CommandData(f"{sys.argv[2]}-{i}", "", "OK"))
+    shared.save()
+    created.append(manager.create_new_session().id)
+print(" ".join(map(str, created)))
+"""
+
+
+def test_concurrent_processes(tmp_path: Path) -> None:
+    SessionManager(tmp_path).create_new_session("Shared")
+    processes = [subprocess.Popen([sys.executable, "-c", STRESS_SCRIPT, str(tmp_path), str(worker)],
+                                  cwd=Path(__file__).parent, stdout=subprocess.PIPE, text=True)
+                 for worker in range(24)]
+    created = [int(session_id) for process in processes for session_id in process.communicate()[0].split()]
+    assert all(process.returncode == 0 for process in processes)
+    assert len(created) == len(set(created)) == 24 * 5
+
+    session_manager = SessionManager(tmp_path)
+    commands = [command.command for command in session_manager.load(0).commands]
+    assert sorted(commands) == sorted(f"{worker}-{i}" for worker in range(24) for i in range(5))
+    for worker in range(24):  # Each process's commands stay in order
+        own = [command for command in commands if command.startswith(f"{worker}-")]
+        assert own == [f"{worker}-{i}" for i in range(5)]
+    assert sorted(entry.id for entry in session_manager.list_sessions()) == sorted([0, *created])
+    for path in session_manager.get_session_files():
+        CommandSession.from_file(path)
+
 
 def mock_ai_api(prompt: str) -> Generator[str | list[int], None, None]:
         if "linux" in prompt:
@@ -129,12 +368,616 @@ def test_assistant_new_command(tmp_path: Path) -> None:
     assert "mock_stdin" in response
 
 
+def test_build_prompt_token_budget(tmp_path: Path) -> None:
+    session = CommandSession(id=0, prompt="System prompt", save_dir=str(tmp_path), commands=[], context=[])
+    for i in range(10):
+        session.commands.append(CommandData(f"command {i}", "x" * 400, f"response {i}"))
+    full_build = build_prompt(session)
+    assert full_build.kept == 10 and full_build.dropped == 0
+    assert full_build.text == command_session_to_prompt(session)
+    assert full_build.tokens >= estimate_tokens(full_build.text)
+
+    build = build_prompt(session, token_budget=400)
+    assert build.tokens <= 400
+    assert build.dropped == 10 - build.kept and 0 < build.kept < 10
+    assert build.text.startswith("System prompt\n\n")
+    assert "command 9" in build.text and "command 0" not in build.text
+    assert f"{build.dropped} earlier commands" in build.text
+    assert f"Left out the {build.dropped} oldest" in build.report()
+
+    # The newest command is kept even if it doesn't fit
+    session.commands.append(CommandData("huge", "y" * 10000, ""))
+    build = build_prompt(session, token_budget=400)
+    assert build.kept == 1 and "huge" in build.text
+
+    # Fragments are only rendered again when the command changes
+    fragment, tokens = render_command(session.commands[0])
+    assert render_command(session.commands[0])[0] is fragment
+    session.commands[0].ai_response += " more"
+    assert render_command(session.commands[0])[1] > tokens
+
+
+def test_token_counts_are_saved(tmp_path: Path) -> None:
+    assistant = Assistant(SessionManager(tmp_path), ai_api=mock_ai_api, token_budget=100)
+    "".join(assistant.new_command(CommandData("mock_command", "mock_stdin", "")))
+    loaded_command = CommandSession.from_file(assistant.session.path).commands[0]
+    assert loaded_command.tokens == render_command(assistant.session.commands[0])[1]
+    assert command_tokens(loaded_command) == loaded_command.tokens
+    report = "".join(assistant.new_command(CommandData("mock_command", "z" * 1000, "")))
+    assert "Left out" not in report
+    assistant.verbose = True
+    report = "".join(assistant.new_command(CommandData("mock_command", "", "")))
+    assert "with 1 of 3 commands. Left out the 2 oldest." in report
+
+
+class MockContextApi:
+    def __init__(self, reject_context: bool = False) -> None:
+        self.calls: list[tuple[str, list[int] | None]] = []
+        self.reject_context = reject_context
+        self.model = "mock"
+
+    def __call__(self, prompt: str, context: list[int] | None = None) -> Generator[str | list[int], None, None]:
+        self.calls.append((prompt, context))
+        if context and self.reject_context:
+            raise IOError("Error 400: invalid context")
+        yield f"response {len(self.calls)}"
+        yield list(range(len(self.calls) * 10))
+
+
+def test_assistant_incremental_context(tmp_path: Path) -> None:
+    api = MockContextApi()
+    assistant = Assistant(SessionManager(tmp_path), ai_api=api, model="model-a", incremental=True)
+    "".join(assistant.new_command(CommandData("first", "first stdin", "")))
+    assert api.calls[-1][1] is None
+    assert "<systemprompt>" in api.calls[-1][0]
+    assert assistant.session.context_model == "model-a" and assistant.session.context_commands == 1
+
+    "".join(assistant.new_command(CommandData("second", "second stdin", "")))
+    prompt, context = api.calls[-1]
+    assert context == list(range(10))
+    assert "second stdin" in prompt and "first stdin" not in prompt and "<systemprompt>" not in prompt
+    assert assistant.session.commands[-1].ai_response == "response 2"
+
+    # The stored context survives a restart, but not a different model
+    assistant = Assistant(SessionManager(tmp_path), ai_api=api, model="model-a", incremental=True)
+    assert assistant.can_reuse_context() is False  # Only valid once the next command is added
+    "".join(assistant.new_command(CommandData("third", "", "")))
+    assert api.calls[-1][1] == list(range(20))
+    assistant.model = "model-b"
+    "".join(assistant.new_command(CommandData("fourth", "", "")))
+    assert api.calls[-1][1] is None and "first stdin" in api.calls[-1][0]
+
+    # Commands without a response are not part of the context
+    "".join(assistant.new_command(CommandData("fifth", "", ""), give_ai_response=False))
+    "".join(assistant.new_command(CommandData("sixth", "", "")))
+    assert api.calls[-1][1] is None
+
+
+def test_assistant_rejected_context(tmp_path: Path) -> None:
+    api = MockContextApi(reject_context=True)
+    assistant = Assistant(SessionManager(tmp_path), ai_api=api, incremental=True)
+    "".join(assistant.new_command(CommandData("first", "", "")))
+    response = "".join(assistant.new_command(CommandData("second", "", "")))
+    assert response == "response 3"
+    assert api.calls[-1][1] is None and "<systemprompt>" in api.calls[-1][0]
+
+
+def test_model_router(tmp_path: Path) -> None:
+    tiers = [ModelTier("tiny", max_prompt_tokens=4000, kinds=("question",)),
+             ModelTier("small", max_prompt_tokens=4000, max_seconds=5), ModelTier("large", max_prompt_tokens=32000)]
+    router = ModelRouter(tiers, tmp_path / "router" / "models.json")
+    api = MockContextApi()
+    assistant = Assistant(SessionManager(tmp_path), ai_api=api, model="default", verbose=True, router=router)
+    output = "".join(assistant.new_command(CommandData("kj what flag does grep use for recursive", "", "")))
+    assert "Model tiny for a question with about" in output and "the first that fits" in output
+    assert assistant.ai_api is not api and cast(MockContextApi, assistant.ai_api).model == "tiny"
+    "".join(assistant.new_command(CommandData("make", "error: missing ;\n", "")))
+    assert assistant.model == "small" and assistant.route is not None and assistant.route.kind == "error"
+    "".join(assistant.new_command(CommandData("cat big.log | kj", "request served\n" * 2000, "")))
+    assert assistant.model == "large" and assistant.route is not None and assistant.route.prompt_tokens > 4000
+    session = SessionManager(tmp_path).load(assistant.session.id)
+    assert [command.model for command in session.commands] == ["tiny", "small", "large"]
+    assert len(api.calls) == 3  # The copies share the mock
+
+    for _ in range(3):
+        router.observe("small", 8.0, 20.0)
+    assistant.token_budget = 2000  # Leaves out big.log
+    output = "".join(assistant.new_command(CommandData("ls", "a\nb\n", "")))
+    assert assistant.model == "large" and "after the slow small (23.0 s)" in output
+    # The speed is kept for the next invocation
+    router = ModelRouter(tiers, tmp_path / "router" / "models.json")
+    assert router.stats["small"].expected_seconds() == 23.0
+    session.commands.append(CommandData("kj and for symlinks?", "", ""))
+    assert router.route(session, 8192, context_model="large").reason == "it holds the context of the session"
+    session.commands.append(CommandData("cat huge.log | kj", "x" * 200_000, ""))
+    decision = router.route(session, 8192)
+    assert decision.model == "large" and decision.max_prompt_tokens == 32000 and "cut to 32000" in decision.reason
+    # A plain ai_api function gets the model as an argument, and stays as it is.
+    models: list[str] = []
+
+    def plain_api(prompt: str, model: str = "default") -> Generator[str, None, None]:
+        models.append(model)
+        yield "answer"
+
+    assistant = Assistant(SessionManager(tmp_path, new_session=True), ai_api=plain_api, router=router)
+    "".join(assistant.new_command(CommandData("kj what is a symlink", "", "")))
+    assert models == ["tiny"] and not hasattr(plain_api, "model")
+    with pytest.raises(ValueError):
+        ModelTier.from_config({"model": "tiny", "kinds": ["poetry"]})
+    assert ModelTier.from_config("llama3.2") == ModelTier("llama3.2")
+
+
+def test_response_cache(tmp_path: Path) -> None:
+    api = MockContextApi()
+    cache = ResponseCache(tmp_path / "cache")
+    assistant = Assistant(SessionManager(tmp_path), ai_api=api, model="model-a", cache=cache)
+    assert "".join(assistant.new_command(CommandData("make | kj", "error: x\n", ""))) == "response 1"
+    # The flags of kj and trailing whitespace don't change the question
+    command = CommandData("make  | kj -v", "error: x  \n\n", "")
+    other_session = Assistant(SessionManager(tmp_path, new_session=True), ai_api=api, model="model-a", cache=cache)
+    assert "".join(other_session.new_command(command)) == "response 1"
+    assert len(api.calls) == 1
+    assert command.ai_response == "response 1"
+    assert CommandSession.from_file(other_session.session.path).commands[-1].ai_response == "response 1"
+    assert cache.stats() == CacheStats(hits=1, misses=1, entries=1, bytes=cache.stats().bytes)
+    # After other commands of the session, the same command asks something else.
+    assert "".join(other_session.new_command(CommandData("make", "error: x", ""))) == "response 2"
+
+    other_model = Assistant(SessionManager(tmp_path, new_session=True), ai_api=api, model="model-b", cache=cache)
+    assert "".join(other_model.new_command(CommandData("make", "error: x", ""))) == "response 3"
+    uncached = Assistant(SessionManager(tmp_path, new_session=True), ai_api=api, model="model-a")
+    assert "".join(uncached.new_command(CommandData("make", "error: x", ""))) == "response 4"
+
+
+def test_response_cache_follow_up(tmp_path: Path) -> None:
+    api = MockContextApi()
+    cache = ResponseCache(tmp_path / "cache")
+    follow_up = 'echo "why did it fail?" | kj'
+    for output in "nginx: [emerg] bind() to 0.0.0.0:80 failed", "postgres: FATAL: data directory has wrong ownership":
+        assistant = Assistant(SessionManager(tmp_path, new_session=True), ai_api=api, model="model-a", cache=cache)
+        "".join(assistant.new_command(CommandData("sudo systemctl start server | kj", output, "")))
+        "".join(assistant.new_command(CommandData(follow_up, "why did it fail?", "")))
+        assert output in api.calls[-1][0]
+    assert len(api.calls) == 4 and cache.stats().hits == 0
+
+
+def test_response_cache_eviction(tmp_path: Path) -> None:
+    cache = ResponseCache(tmp_path)
+    for i in range(3):
+        cache.put(f"key{i}", "model", [f"answer {i}" * 10])
+        os.utime(tmp_path / f"key{i}.json", (time.time() - 10 + i,) * 2)
+    assert cache.get("key0") == ["answer 0" * 10]  # Now the most recently used
+    cache.max_bytes = cache.stats().bytes + 10
+    cache.put("key3", "model", ["answer 3" * 10])
+    assert [cache.get(f"key{i}") is not None for i in range(4)] == [True, False, True, True]
+
+    cache = ResponseCache(tmp_path, max_age=60)
+    os.utime(tmp_path / "key3.json", (time.time() - 120,) * 2)
+    cache.evict()
+    assert not (tmp_path / "key3.json").exists()
+    cache.put("key4", "model", ["answer"])
+    assert cache.get("key4") == ["answer"]
+    (tmp_path / "key4.json").write_text(json.dumps({"model": "model", "created": time.time() - 120, "chunks": []}))
+    assert cache.get("key4") is None
+
+
+def test_shell_no_cache(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    api = MockContextApi()
+    monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: api)
+    monkeypatch.setenv("HISTORY", f"310  ls | {abbreviation}")
+    for argv, response in ([], "response 1"), (["-n"], "response 1"), (["-n", "--no-cache"], "response 2"):
+        monkeypatch.setattr("sys.stdin", io.StringIO("file\n"))
+        assert shell(["--path", str(tmp_path), *argv]) == 0
+        assert capsys.readouterr().out.endswith(f"{response}\n")
+    assert (tmp_path / "cache").is_dir()
+
+
+class StreamingServer:
+    """Local stand-in for a model server, which answers every POST with the given lines, waiting delay seconds
+    before each. With chunked, it answers in HTTP/1.1 chunked encoding, like Ollama."""
+    def __init__(self, lines: list[bytes], status: int = 200, delay: float = 0, chunked: bool = False) -> None:
+        self.requests: list[tuple[str, Any]] = []
+        self.disconnected = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" if chunked else "HTTP/1.0"
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                server.requests.append((self.path, json.loads(body)))
+                self.send_response(status)
+                if chunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for line in lines:
+                        time.sleep(delay)
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line) if chunked else line)
+                        self.wfile.flush()
+                    if chunked:
+                        self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    server.disconnected.set()
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_ollama_generate_backend() -> None:
+    server = StreamingServer([b'{"response": "Hel", "done": false}\n{"respo', b'nse": "lo", "done": false}\n',
+                              b'{"response": "", "done": true, "context": [1, 2, 3]}\n'])
+    try:
+        backend = make_backend("ollama", model="tiny", endpoint=server.url, options={"temperature": 0})
+        assert list(backend("Say hello", context=[4, 5])) == ["Hel", "lo", [1, 2, 3]]
+        path, request = server.requests[0]
+        assert path == "/api/generate"
+        assert request == {"model": "tiny", "prompt": "Say hello", "stream": True, "context": [4, 5],
+                           "options": {"temperature": 0}}
+    finally:
+        server.close()
+
+
+def test_ollama_chat_backend(tmp_path: Path) -> None:
+    server = StreamingServer([b'{"message": {"role": "assistant", "content": "Hi"}, "done": false}\n',
+                              b'{"message": {"role": "assistant", "content": " there"}, "done": false}\n',
+                              b'{"message": {"role": "assistant", "content": ""}, "done": true}\n'])
+    try:
+        backend = make_backend("ollama-chat", model="tiny", endpoint=server.url)
+        assistant = Assistant(SessionManager(tmp_path), ai_api=backend, model=backend.model, incremental=True)
+        assert "".join(assistant.new_command(CommandData("ls", "a b", ""))) == "Hi there"
+        assert "".join(assistant.new_command(CommandData("pwd", "", ""))) == "Hi there"
+        path, request = server.requests[-1]
+        assert path == "/api/chat" and request["model"] == "tiny"
+        assert [message["role"] for message in request["messages"]] == ["system", "user", "assistant", "user"]
+        assert request["messages"][1]["content"] == "Command:\nls\n\nStdin:\na b"
+        assert request["messages"][2]["content"] == "Hi there"
+        assert "context" not in request
+    finally:
+        server.close()
+
+
+def test_openai_compatible_backend() -> None:
+    server = StreamingServer([b'data: {"choices": [{"delta": {"role": "assistant"}}]}\n\n',
+                              b'data: {"choices": [{"delta": {"content": "Hi"}}]}\n\n',
+                              b'data: {"choices": [{"delta": {"content": "!"}}]}\n\ndata: [DONE]\n\n'])
+    try:
+        backend = make_backend("openai", endpoint=server.url + "/", options={"temperature": 0.5})
+        assert list(backend([{"role": "user", "content": "Hello"}])) == ["Hi", "!"]
+        path, request = server.requests[0]
+        assert path == "/v1/chat/completions"
+        assert request == {"temperature": 0.5, "model": "default", "stream": True,
+                           "messages": [{"role": "user", "content": "Hello"}]}
+    finally:
+        server.close()
+
+
+def test_backend_errors() -> None:
+    server = StreamingServer([b"model not found"], status=404)
+    try:
+        with pytest.raises(IOError):
+            list(make_backend("ollama-chat", endpoint=server.url)([]))
+    finally:
+        server.close()
+    with pytest.raises(ValueError):
+        make_backend("nonexistent")
+    with pytest.raises(TypeError):
+        ModelBackend()  # type: ignore[abstract]
+
+
+def test_async_backends() -> None:
+    async def collect(backend: ModelBackend, prompt: Any, context: list[int] | None = None) -> list[Chunk]:
+        return [chunk async for chunk in backend.astream(prompt, context)]
+
+    server = StreamingServer([b'{"response": "Hel", "done": false}\n{"respo', b'nse": "lo", "done": false}\n',
+                              b'{"response": "", "done": true, "context": [1, 2, 3]}\n'], chunked=True)
+    try:
+        backend = make_backend("ollama", model="tiny", endpoint=server.url)
+        assert asyncio.run(collect(backend, "Say hello", [4, 5])) == ["Hel", "lo", [1, 2, 3]]
+        assert server.requests[0] == ("/api/generate", {"model": "tiny", "prompt": "Say hello", "stream": True,
+                                                        "context": [4, 5]})
+    finally:
+        server.close()
+    server = StreamingServer([b'data: {"choices": [{"delta": {"content": "Hi"}}]}\n\ndata: [DONE]\n\n'])
+    try:
+        assert asyncio.run(collect(make_backend("openai", endpoint=server.url), "Hello")) == ["Hi"]
+    finally:
+        server.close()
+    server = StreamingServer([b"model not found"], status=404)
+    try:
+        with pytest.raises(IOError, match="model not found"):
+            asyncio.run(collect(make_backend("ollama-chat", endpoint=server.url), "Hello"))
+    finally:
+        server.close()
+
+
+def test_async_deadline_keeps_partial_answer(tmp_path: Path) -> None:
+    lines = [b'{"response": "Par", "done": false}\n'] + [b'{"response": "t", "done": false}\n'] * 20
+    server = StreamingServer(lines, delay=0.2, chunked=True)
+    try:
+        backend = make_backend("ollama", endpoint=server.url)
+        assistant = Assistant(SessionManager(tmp_path), ai_api=backend, model=backend.model)
+        received: list[str] = []
+
+        async def answer() -> None:
+            async for chunk in assistant.anew_command(CommandData("make", "error", ""), deadline=0.5):
+                received.append(chunk)
+
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            asyncio.run(answer())
+        assert time.monotonic() - start < 2
+        assert received and received[0] == "Par"
+        command = CommandSession.from_file(assistant.session.path).commands[-1]
+        assert command.interrupted and command.ai_response == "".join(received)
+        assert server.disconnected.wait(3)  # The connection was closed, so the server stopped generating
+    finally:
+        server.close()
+
+
+def test_interrupted_answer_is_saved(tmp_path: Path) -> None:
+    def interrupted_api(prompt: str) -> Generator[str, None, None]:
+        yield "Half an"
+        raise KeyboardInterrupt()
+
+    assistant = Assistant(SessionManager(tmp_path), ai_api=interrupted_api)
+    with pytest.raises(KeyboardInterrupt):
+        print_ai_response(assistant.new_command(CommandData("make", "error", "")), out=io.StringIO())
+    command = CommandSession.from_file(assistant.session.path).commands[-1]
+    assert command.ai_response == "Half an" and command.interrupted
+    assert f"Half an\n[{abbreviation}: interrupted]" in command_session_to_prompt(assistant.session)
+
+
+def test_shell_deadline(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    server = StreamingServer([b'{"response": "Slow", "done": false}\n'] * 20, delay=0.2)
+    monkeypatch.setenv("HISTORY", f"311  make | {abbreviation}")
+    monkeypatch.setattr("sys.stdin", io.StringIO("error\n"))
+    try:
+        assert shell(["--path", str(tmp_path), "--endpoint", server.url, "--deadline", "0.5"]) == 1
+    finally:
+        server.close()
+    assert "Slow" in capsys.readouterr().out
+    assert SessionManager(tmp_path).load_most_recent_session().commands[-1].interrupted
+
+
+@pytest.mark.parametrize("latency, load_seconds", [(4.0, 0.0), (0.0, 4.0)])
+def test_deadline_stops_waiting_for_first_token(monkeypatch: pytest.MonkeyPatch, tmp_path: Path,
+                                                latency: float, load_seconds: float) -> None:
+    # With latency, the server sent the headers and is silent. While it loads the model, it didn't send them yet.
+    monkeypatch.setenv("HISTORY", f"315  make | {abbreviation}")
+    monkeypatch.setattr("sys.stdin", io.StringIO("error\n"))
+    with FakeModelServer(latency=latency, load_seconds=load_seconds) as server:
+        start = time.monotonic()
+        assert shell(["--path", str(tmp_path), "--endpoint", server.url, "--deadline", "0.5"]) == 1
+        assert time.monotonic() - start < 2
+        backend = make_backend("ollama", endpoint=server.url)
+        assert backend.pool.endpoints[0].failures == 0  # Not the server's fault
+
+        async def cancelled() -> None:
+            task = asyncio.create_task(collect_async(backend.astream("Hello")))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        start = time.monotonic()
+        asyncio.run(cancelled())
+        assert time.monotonic() - start < 2
+
+
+def test_timings() -> None:
+    timings = Timings(start=0.0)
+    with timings.span("stdin"):
+        pass
+    timings.request_started()
+    timings.chunk_received()
+    timings.chunk_received()
+    timings.request_finished()
+    timings.server.update({"prompt_eval_count": 10, "prompt_eval_duration": 500_000_000, "eval_count": 20,
+                           "eval_duration": 2_000_000_000})
+    assert set(timings.spans) == {"stdin", "first token", "generation"} and timings.chunks == 2
+    assert timings.summary().startswith("Timings: stdin ")
+    assert "Server: prompt 10 tokens in 500.0 ms (20.0 tokens/s), answer 20 tokens in 2.00 s (10.0 tokens/s)" \
+        in timings.summary()
+    assert server_summary({}) == ""
+    record = timings.record(session=3)
+    assert record["session"] == 3 and record["server"]["eval_count"] == 20 and record["chunks"] == 2
+
+
+def test_shell_timings(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    monkeypatch.setenv("HISTORY", f"312  make | {abbreviation}")
+    with FakeModelServer(tokens=5) as server:
+        for _ in range(2):
+            monkeypatch.setattr("sys.stdin", io.StringIO("error\n"))
+            assert shell(["--path", str(tmp_path), "--endpoint", server.url, "--no-cache",
+                          "--timings", "--metrics"]) == 0
+    out = capsys.readouterr().out
+    assert "Timings: history" in out and "first token" in out and "Server: " in out and "answer 5 tokens" in out
+    records = [json.loads(line) for line in (tmp_path / "metrics" / "session.0.jsonl").read_text().splitlines()]
+    assert len(records) == 2
+    assert {"history", "stdin", "session load", "first token", "save"} <= set(records[0]["spans"])
+    assert records[0]["server"]["eval_count"] == 5 and records[0]["backend"] == "ollama"
+    assert records[0]["prompt_tokens"] > 0
+
+
+def test_keep_alive() -> None:
+    assert keep_alive(None) is None and keep_alive("30m") == "30m" and keep_alive("-1") == -1 and keep_alive(600) == 600
+    hours = {"hours": "8-19", "outside": "5m"}
+    assert keep_alive(hours, datetime(2026, 3, 2, 10, 30)) == 8.5 * 3600
+    assert keep_alive(hours, datetime(2026, 3, 2, 19, 0)) == "5m"
+    assert keep_alive({"hours": "22-6"}, datetime(2026, 3, 2, 23, 0)) == 7 * 3600
+    assert keep_alive({"hours": "22-6"}, datetime(2026, 3, 2, 1, 0)) == 5 * 3600
+    assert keep_alive({"hours": "22-6"}, datetime(2026, 3, 2, 12, 0)) is None
+    with pytest.raises(ValueError):
+        keep_alive({"hours": "8"})
+
+
+def test_shell_warm(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    monkeypatch.delenv("HISTORY", raising=False)  # Like from a shell rc file
+    with FakeModelServer(tokens=5, load_seconds=0.3) as server:
+        arguments = ["--path", str(tmp_path), "-e", server.url, "--keep-alive", "-1", "--no-cache"]
+        assert shell([*arguments, "--warm", "wait"]) == 0
+        assert "which wasn't loaded" in capsys.readouterr().out
+        _, request = server.requests[-1]
+        assert request["prompt"] == f"{default_prompt(tmp_path)}\n\n"
+        assert request["options"] == {"num_predict": 1} and request["keep_alive"] == -1
+        assert shell([*arguments, "--warm", "wait"]) == 0
+        assert "which was loaded already" in capsys.readouterr().out
+
+        monkeypatch.setenv("HISTORY", f"330  make | {abbreviation}")
+        assert shell([*arguments, "--timings"], stdin=io.StringIO("error\n")) == 0
+        assert "(warm)" in capsys.readouterr().out
+        server.loaded.clear()
+        assert shell([*arguments, "--timings"], stdin=io.StringIO("error\n")) == 0
+        assert "(cold: 300.0 ms loading the model, " in capsys.readouterr().out
+
+        # The model starts loading while stdin is read.
+        server.loaded.clear()
+        config_path = tmp_path / "config.json"
+        config_path.write_text(json.dumps({"warm_on_start": True}))
+        assert shell([*arguments, "--config", str(config_path)], stdin=io.StringIO("error\n")) == 0
+        options = [request.get("options") for _, request in server.requests[-2:]]
+        assert {"num_predict": 1} in options and None in options
+
+    started: list[list[str]] = []
+    monkeypatch.setattr("subprocess.Popen", lambda args, **kwargs: started.append(args))
+    assert shell(["--warm", "--path", str(tmp_path)]) == 0
+    assert started[0][-4:] == ["--path", str(tmp_path), "--warm", "wait"]
+
+
+def unused_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+def test_endpoint_pool(tmp_path: Path) -> None:
+    pool = EndpointPool(["http://a", "http://b", "http://c"])
+    pool.started("http://a")
+    pool.first_chunk("http://b", 0.5)
+    assert pool.ranked() == ["http://c", "http://b", "http://a"]  # Fewest requests in progress, then fastest
+    pool.finished("http://a", failed=True)
+    assert pool.ranked() == ["http://c", "http://b", "http://a"] and pool.up() == ["http://b", "http://c"]
+    assert "http://a: down for 5 s, 1 requests, 1 failed, no latency yet" in pool.report()
+
+    dead = unused_url()
+    with FakeModelServer(tokens=2, status=503) as busy, FakeModelServer(tokens=2) as server:
+        backend = make_backend("ollama", endpoint=[dead, busy.url, server.url])
+        backend.pool.load(tmp_path / "stats.json")
+        assert list(backend("Hello"))[:3] == ["word0 ", "word1 ", [0, 1]]
+        assert [endpoint.failures for endpoint in backend.pool.endpoints] == [1, 1, 0]
+        assert len(backend.pool.endpoints[2].latencies) == 1
+        # The failed endpoints are tried last now, and the async path fails over the same way.
+        assert backend.pool.ranked()[0] == server.url
+        backend.pool.started(server.url)
+        backend.pool.finished(server.url, failed=True)
+        chunks = asyncio.run(collect_async(backend.astream("Hello")))
+        assert chunks[:2] == ["word0 ", "word1 "] and backend.pool.endpoints[2].failures == 1
+        saved = json.loads((tmp_path / "stats.json").read_text())
+        assert saved[dead]["failures"] >= 1 and saved[server.url]["requests"] == 3
+
+        backend.pool.check_all()
+        assert backend.pool.up() == [server.url]
+    with FakeModelServer(status=400) as bad, FakeModelServer() as server:
+        backend = make_backend("ollama", endpoint=[bad.url, server.url])
+        with pytest.raises(IOError, match="Error 400"):  # A bad request would be bad anywhere
+            list(backend("Hello"))
+        assert server.requests == []
+
+
+async def collect_async(stream: Any) -> list[Any]:
+    return [chunk async for chunk in stream]
+
+
+def test_shell_check_endpoints(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    monkeypatch.setenv("HISTORY", f"315  {abbreviation} --check-endpoints")
+    dead = unused_url()
+    with FakeModelServer() as server:
+        assert shell(["--path", str(tmp_path), "-e", dead, "-e", server.url, "--check-endpoints"]) == 0
+        out = capsys.readouterr().out
+        assert f"{dead}: down for 5 s, 0 requests, 1 failed" in out and f"{server.url}: up, 0 requests" in out
+        monkeypatch.setattr("sys.stdin", io.StringIO("error\n"))
+        monkeypatch.setenv("HISTORY", f"316  make | {abbreviation}")
+        assert shell(["--path", str(tmp_path), "-e", dead, "-e", server.url, "--no-cache"]) == 0
+        assert "word0" in capsys.readouterr().out
+    assert shell(["--path", str(tmp_path), "-e", dead, "--check-endpoints"]) == 1
+
+
+def test_backend_config(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"backend": "openai", "model": "from-config", "options": {"top_k": 5}}))
+    assert parse_option("temperature=0.2") == ("temperature", 0.2)
+    assert parse_option("stop=END") == ("stop", "END")
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_option("temperature")
+    args = get_arg_parser().parse_args(["--config", str(config_path), "--model", "from-cli", "-o", "temperature=0"])
+    config = load_config(Path(args.config))
+    assert setting(args, config, "backend", "ollama") == "openai"
+    assert setting(args, config, "model") == "from-cli"
+    assert setting(args, config, "endpoint", "default") == "default"
+    assert dict(args.option) == {"temperature": 0}
+
+    created: list[ModelBackend] = []
+
+    def recording_make_backend(*args: Any, **kwargs: Any) -> ModelBackend:
+        created.append(make_backend(*args, **kwargs))
+        return created[-1]
+
+    monkeypatch.setattr("shell.make_backend", recording_make_backend)
+    monkeypatch.setenv("HISTORY", f"308  {abbreviation} --listen")
+    monkeypatch.setattr("sys.stdin", io.StringIO("<user request>\n"))
+    assert shell(["--listen", "--path", str(tmp_path), "--config", str(config_path), "-o", "temperature=0"]) == 0
+    assert isinstance(created[0], OpenAICompatibleBackend)
+    assert created[0].model == "from-config" and created[0].options == {"top_k": 5, "temperature": 0}
+
+
+def test_shell_model_router(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({"models": [{"model": "light", "kinds": ["question"]}, "heavy"]}))
+    monkeypatch.setenv("HISTORY", f"320  {abbreviation} what flag does grep use for recursive")
+    with FakeModelServer(tokens=3) as server:
+        assert shell(["--path", str(tmp_path), "--config", str(config_path), "-e", server.url, "-v", "--no-cache"],
+                     stdin=io.StringIO("")) == 0
+        assert "Model light for a question" in capsys.readouterr().out
+        assert shell(["--path", str(tmp_path), "--config", str(config_path), "-e", server.url, "--no-cache",
+                      "-m", "chosen"], stdin=io.StringIO("")) == 0
+        assert [request["model"] for _, request in server.requests if request] == ["light", "chosen"]
+    assert "light" in json.loads((tmp_path / "router" / "models.json").read_text())
+    config_path.write_text(json.dumps({"models": [{"name": "light"}]}))
+    with pytest.raises(argparse.ArgumentTypeError):
+        shell(["--path", str(tmp_path), "--config", str(config_path)], stdin=io.StringIO(""))
+
+
 # TODO: Mock the api call
 def test_query_ollama() -> None:
-    chunks = list(query_ollama("Repeat 'test' back to me once."))
-    assert chunks
-    with pytest.raises(IOError):
-        list(query_ollama("Repeat 'test' back to me once.", url="http://localhost:11434/api/wrongendpoint"))
+    with FakeModelServer(tokens=3) as server:
+        chunks = list(query_ollama("Repeat 'test' back to me once.", url=f"{server.url}/api/generate"))
+        assert chunks[:4] == ["word0 ", "word1 ", "word2 ", [0, 1, 2]]
+        assert isinstance(chunks[4], dict) and chunks[4]["eval_count"] == 3
+        list(query_ollama("test", url=f"{server.url}/api/generate", keep_alive="30m"))
+        assert server.requests[-1][1]["keep_alive"] == "30m"
+        with pytest.raises(IOError):
+            list(query_ollama("Repeat 'test' back to me once.", url=f"{server.url}/api/wrongendpoint"))
+
+
+def test_benchmarks(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    output = tmp_path / "bench_output.txt"
+    assert bench.main(["--quick", "--only", "lookup", "storage", "--output", str(output)]) == 0
+    results = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert {result["benchmark"] for result in results} >= {"session.lookup", "session.save_append", "prompt.build"}
+    assert all(result["median_s"] > 0 and result["quick"] for result in results)
+    capsys.readouterr()
+    assert bench.main(["--quick", "--only", "lookup", "--output", str(tmp_path / "new.txt"),
+                       "--compare", str(output)]) == 0
+    assert "x\n" in capsys.readouterr().out
 
 
 def test_print_ai_response(capsys: pytest.CaptureFixture[str]) -> None:
@@ -153,6 +996,52 @@ def test_print_ai_response(capsys: pytest.CaptureFixture[str]) -> None:
     assert "mock_ai_response" in output
 
 
+def test_stream_renderer() -> None:
+    renderer = StreamRenderer(interval=0.1, size=10)
+    assert renderer.feed("Hello", now=0.0) == "Hello"  # Right away after a pause
+    assert renderer.feed(" wor", now=0.01) is None and renderer.due(now=0.05) == pytest.approx(0.05)
+    assert renderer.feed("ld", now=0.02) is None
+    assert renderer.feed("!!!!", now=0.03) == " world!!!!"  # Too much waiting
+    assert renderer.due(now=0.04) is None
+    assert renderer.feed(".", now=0.2) == "." and renderer.finish() == ""
+
+    text = "# Fix\nRun **make** or `ls *`:\n```bash\nls *.c\n```\n2 * 3\n"
+    expected = f"{RESET}{BOLD}# Fix{RESET}\nRun {RESET}{BOLD}make{RESET} or {RESET}{CODE}ls *{RESET}:\n" \
+               f"{RESET}\x1b[2m```bash{RESET}{CODE}\nls *.c\n{RESET}\x1b[2m```{RESET}\n2 * 3\n"
+    for size in (1, 2, 5, len(text)):  # However the answer is split into chunks
+        formatter = MarkdownFormatter()
+        assert "".join(formatter.feed(text[i:i + size]) for i in range(0, len(text), size)) + formatter.finish() \
+            == expected
+    formatter = MarkdownFormatter()
+    assert formatter.feed("```py\nx = 1") + formatter.finish() == f"{RESET}\x1b[2m```py{RESET}{CODE}\nx = 1{RESET}"
+    assert formatter.feed("``") + formatter.finish() == "``"
+    # Marks that don't pair up on their line are left as written
+    text = "Run ls src/**/*.py, not `ls\n**Note:** 2 ** 3 `a`**\n"
+    expected = f"Run ls src/**/*.py, not `ls\n{RESET}{BOLD}Note:{RESET} 2 ** 3 {RESET}{CODE}a{RESET}**\n"
+    for size in (1, 2, 5, len(text)):
+        formatter = MarkdownFormatter()
+        assert "".join(formatter.feed(text[i:i + size]) for i in range(0, len(text), size)) + formatter.finish() \
+            == expected
+    assert formatter.feed("see src/**") + formatter.finish() == "see src/**"
+
+
+def test_shell_markdown(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    class Api:
+        model = "mock"
+
+        def __call__(self, prompt: str, context: list[int] | None = None) -> Generator[str, None, None]:
+            yield from ["Run ", "`ls`", " now."]
+    monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: Api())
+    monkeypatch.setenv("HISTORY", f"315  {abbreviation}")
+    for argv, expected in ([], "Run `ls` now."), (["--markdown", "always"], f"Run {RESET}{CODE}ls{RESET} now."):
+        monkeypatch.setattr("sys.stdin", io.StringIO("list files\n"))
+        assert shell(["--path", str(tmp_path), "--no-cache", *argv]) == 0
+        assert capsys.readouterr().out.endswith(f"\n{expected}\n")
+    assert use_markdown("auto", cast(TextIO, type("Terminal", (io.StringIO,), {"isatty": lambda self: True})()))
+    with pytest.raises(argparse.ArgumentTypeError):
+        use_markdown("sometimes", io.StringIO())
+
+
 def test_shell_with_pipe(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
     monkeypatch.setenv("HISTORY", f"299  <fake command> | {abbreviation} --listen")
     command_output = "<fake command output>\n"
@@ -183,6 +1072,306 @@ def test_shell_switch_session(monkeypatch: pytest.MonkeyPatch, capsys: pytest.Ca
     assert flag in captured.out.strip()
 
 
+def test_search_index(tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    for title, stdin, answer in [("make", "error: connection refused", "The server is down."),
+                                 ("pytest", "1 failed", "The connection test failed, because the server is down."),
+                                 ("ls", "README.md", "There is a readme.")]:
+        session = session_manager.create_new_session()
+        session.commands.append(CommandData(title, stdin, answer))
+        session.save()
+    index = SearchIndex(tmp_path)
+    assert index.refresh(session_manager) == 0  # Saving indexed every session
+    assert [result.session for result in index.search("connection")] == [1, 0]  # Answers weigh more than stdin
+    assert [result.session for result in index.search("pytest server")] == [1]
+    assert index.search("readm")[0].snippet == "[README].md"  # The last word is a prefix
+    assert index.search('"') == [] and match_query("a:b -c") == '"a" "b" "c"*'
+
+    session = session_manager.load(2)
+    session.commands.append(CommandData("cat README.md", "kj rocks", "Indeed."))
+    session.save()
+    assert index.search("rocks")[0].position == 1
+    (tmp_path / CommandSession.make_filename(0)).unlink()
+    session = CommandSession(id=1, prompt=None, save_dir=str(tmp_path), commands=[], context=[])
+    session._rewrite()  # Saved without the index
+    assert index.refresh(session_manager) == 1
+    assert index.search("connection") == []
+
+
+def test_shell_search(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    for flag in ("first flag", "second flag"):
+        session = session_manager.create_new_session()
+        session.commands.append(CommandData(f"echo {flag}", "", ai_response=flag))
+        session.save()
+    (tmp_path / "search" / SearchIndex.filename).write_text("not a database")
+    monkeypatch.setenv("HISTORY", f"313  {abbreviation} --search second")
+    assert shell(["--path", str(tmp_path), "--search", "second", "fl"]) == 0
+    assert "     1  echo second flag" in capsys.readouterr().out
+    assert shell(["--path", str(tmp_path), "--search", "third"]) == 1
+
+    answers = ["second\n7\n0\n", "\n"]
+    monkeypatch.setattr("shell.open_terminal", lambda stdin: io.StringIO(answers.pop(0)))
+    monkeypatch.setattr("sys.stdin", io.StringIO("<user request>\n"))
+    assert shell(["--listen", "--path", str(tmp_path), "--switch-session"]) == 0
+    out = capsys.readouterr().out
+    assert "     1  echo second flag\n     0  echo first flag" in out  # The most recent first
+    assert out.count("Session id, or words to search for: ") == 3 and "first flag" in out.split(welcome_message(0))[1]
+    assert shell(["--listen", "--path", str(tmp_path), "--switch-session"]) == 1
+
+
+def test_embedding_index(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    for command, stdin, answer in [("make", "error: connection refused", "Start the server."),
+                                   ("pytest", "1 failed", "The test fails."),
+                                   ("ls", "README.md", "There is a readme.")]:
+        session = session_manager.create_new_session()
+        session.commands.append(CommandData(command, stdin, answer))
+        session.save()
+    embedder = HashingEmbedder()
+    vectors = embedder.embed(["connection refused", "Connection refused!", ""])
+    assert vectors[0] @ vectors[1] == pytest.approx(1.0) and not vectors[2].any()
+
+    index = EmbeddingIndex.create(tmp_path, embedder)
+    assert index.refresh(session_manager) == 3 and index.refresh(session_manager) == 0
+    assert [hit[:2] for hit in index.search("curl: connection refused", 3)] == [(0, 0)]
+
+    session = session_manager.load(2)
+    session.commands.append(CommandData("make", "error: connection refused", "Start the server again."))
+    session.save()
+    assert index.refresh(session_manager) == 1  # Only the new command is embedded
+    related = related_commands(session_manager, index, CommandData("make again", "connection refused", ""), 5)
+    assert [(hit.session, hit.position) for hit in related] == [(2, 1), (0, 0)]
+    assert related[0].command.ai_response == "Start the server again."
+
+    monkeypatch.setattr("embedding_index.MIN_COMPACTION_ROWS", 0)
+    for session_id in (0, 1):
+        (tmp_path / CommandSession.make_filename(session_id)).unlink()
+    assert [hit[:2] for hit in index.search("connection refused", 3)] == [(0, 0), (2, 1)]  # Until it is refreshed
+    assert index.refresh(session_manager) == 0
+    assert [hit[:2] for hit in index.search("connection refused", 3)] == [(2, 1)]
+    assert (tmp_path / "embeddings" / "vectors.f32").stat().st_size == 2 * 256 * 4  # The deleted rows were removed
+    assert EmbeddingIndex.create(tmp_path, HashingEmbedder(dimensions=64)).refresh(session_manager) == 1
+    assert (tmp_path / "embeddings" / "vectors.f32").stat().st_size == 2 * 64 * 4
+
+    index = EmbeddingIndex.create(tmp_path, HashingEmbedder(dimensions=64))
+    embed = index.embedder.embed
+
+    def unreachable(texts: list[str]) -> Any:
+        raise ConnectionError("embedding server is down")
+    index.embedder.embed = unreachable  # type: ignore[method-assign, assignment]
+    session.commands.append(CommandData("pytest", "1 failed", ""))
+    session.save()  # Saving doesn't embed
+    with pytest.raises(ConnectionError):
+        index.refresh(session_manager)
+    index.embedder.embed = embed  # type: ignore[method-assign]
+    assert index.refresh(session_manager) == 1  # Tried again
+    assert (tmp_path / "embeddings" / "vectors.f32").stat().st_size == 3 * 64 * 4
+    with pytest.raises(ValueError):
+        make_embedder("nonexistent")
+
+    with FakeModelServer() as server:
+        vectors = make_embedder("ollama", model="tiny", endpoint=server.url).embed(["abc", "cba", "xyz"])
+        assert vectors.shape == (3, 26) and vectors[0] @ vectors[1] == pytest.approx(1.0)
+        assert server.requests[-1] == ("/api/embed", {"model": "tiny", "input": ["abc", "cba", "xyz"]})
+
+
+def test_related_commands_prompt(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str],
+                                 tmp_path: Path) -> None:
+    session_manager = SessionManager(tmp_path)
+    session = session_manager.create_new_session()
+    session.commands.append(CommandData("systemctl start nginx", "bind() to 0.0.0.0:80 failed", "Port 80 is taken."))
+    session.save()
+    session = session_manager.create_new_session()
+    session.commands.append(CommandData("ls", "README.md", "There is a readme."))
+    session.commands.append(CommandData("systemctl start nginx", "bind() to 0.0.0.0:80 failed", ""))
+    earlier = RelatedCommand(0, 0, session_manager.load(0).commands[0], 0.9)
+    build = build_prompt(session, related=[earlier, RelatedCommand(1, 1, session.commands[1], 0.8)])
+    assert build.related == [earlier]  # The newest command is in the prompt anyway
+    assert build.text.index("<related>") < build.text.index("Port 80 is taken.") < build.text.index("<command>\nls")
+    assert "Port 80 is taken." in build.messages()[0]["content"] and "(0:0)" in build.report()
+    assert estimate_tokens(build.text) <= build.tokens <= estimate_tokens(build.text) + 4  # Rounded up per part
+    build = build_prompt(session, token_budget=build.tokens - 1, related=[earlier])
+    assert build.related == [earlier] and build.dropped == 1  # Before older commands of the session
+    newest_only = build_prompt(session, token_budget=1)
+    assert build_prompt(session, token_budget=newest_only.tokens, related=[earlier]).related == []
+    assert build_prompt(session, related=[earlier], max_related=0).related == []
+
+    api = MockContextApi()
+    monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: api)
+    monkeypatch.setenv("HISTORY", f"314  systemctl start nginx 2>&1 | {abbreviation}")
+    monkeypatch.setattr("sys.stdin", io.StringIO("bind() to 0.0.0.0:80 failed\n"))
+    assert shell(["--path", str(tmp_path), "--new-session", "--related", "2", "--timings"]) == 0
+    assert "Port 80 is taken." in api.calls[-1][0] and "There is a readme." not in api.calls[-1][0]
+    assert "related " in capsys.readouterr().out
+    with pytest.raises(argparse.ArgumentTypeError):
+        shell(["--path", str(tmp_path), "--related", "2", "--embedder", "nonexistent"])
+
+
+def test_batch_inputs(tmp_path: Path) -> None:
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "b.log").write_text("".join(f"line {i}\n" for i in range(10)))
+    (logs / "a.log").write_text("error: disk full\n")
+    (logs / "nested").mkdir()
+    inputs = read_inputs(logs, head_lines=2, tail_lines=2)
+    assert [item.name for item in inputs] == ["a.log", "b.log"]
+    assert inputs[0].command.command == f"cat a.log | {abbreviation}" and inputs[0].command.stdin == "error: disk full\n"
+    assert inputs[1].command.stdin_omitted == 6
+
+    (tmp_path / "commands.txt").write_text("how do I list files?\n\nwhat is my ip?\n")
+    assert [(item.name, item.command.command) for item in read_inputs(tmp_path / "commands.txt")] == \
+        [("1", "how do I list files?"), ("3", "what is my ip?")]
+    (tmp_path / "commands.jsonl").write_text('{"command": "make", "stdin": "error 2", "name": "build"}\n{"stdin": ""}\n'
+                                             '{"command": 3}\n["make"]\n{"command": "ls", "stdin": 4}\n{broken\n')
+    inputs = read_inputs(tmp_path / "commands.jsonl")
+    assert inputs[0].command.stdin == "error 2" and inputs[0].error is None
+    assert [item.name for item in inputs if item.error is not None] == ["2", "3", "4", "5", "6"]
+    assert "commands.jsonl:2: expected an object with a \"command\"" in str(inputs[1].error)
+    report = io.StringIO()
+    runner = BatchRunner(MockContextApi(), "mock", "prompt", tmp_path)
+    recorded: list[BatchResult] = []
+    asyncio.run(runner.run(inputs, BatchWriter(None, report), recorded.append))
+    assert runner.stats.inputs == 6 and runner.stats.failed == 5 and [result.name for result in recorded] == ["build"]
+    assert sorted(json.loads(line)["input"] for line in report.getvalue().splitlines()) == ["2", "3", "4", "5", "6", "build"]
+
+    async def run(runner: BatchRunner) -> float:
+        start = time.perf_counter()
+        await runner.run(read_inputs(logs), BatchWriter(None, io.StringIO()))
+        return time.perf_counter() - start
+    runner = BatchRunner(MockContextApi(), "mock", "prompt", tmp_path, rate=10)
+    assert asyncio.run(run(runner)) >= 0.1 and runner.stats.inputs == 2
+    writer = BatchWriter(tmp_path / "answers", io.StringIO())
+    paths = [writer.output_path(name) for name in ("../escape", "/etc/passwd", "..", ".", ".hidden", "a b.log")]
+    assert [path.name for path in paths if path is not None] == \
+        ["_escape.txt", "_etc_passwd.txt", "_.txt", "_.txt", "hidden.txt", "a_b.log.txt"]
+    assert all(path is not None and path.parent == tmp_path / "answers" for path in paths)
+    writer.close()
+    # The same name twice, and a name that is the same once replaced: none overwrites another's answer
+    (tmp_path / "named.jsonl").write_text('{"command": "one", "name": "a_b"}\n{"command": "two", "name": "a b"}\n'
+                                          '{"command": "three", "name": "a_b"}\n')
+    writer = BatchWriter(tmp_path / "named", io.StringIO())
+    asyncio.run(BatchRunner(MockContextApi(), "mock", "prompt", tmp_path).run(read_inputs(tmp_path / "named.jsonl"),
+                                                                              writer))
+    writer.close()
+    records = [json.loads(line) for line in (tmp_path / "named" / "report.jsonl").read_text().splitlines()]
+    assert sorted((record["command"], record["file"]) for record in records) == \
+        [("one", "a_b.txt"), ("three", "a_b-3.txt"), ("two", "a_b-2.txt")]
+    answers = {(tmp_path / "named" / record["file"]).read_text() for record in records}
+    assert len(answers) == 3 and all(answer.startswith("response ") for answer in answers)
+    with pytest.raises(ValueError):
+        BatchRunner(MockContextApi(), "mock", "prompt", tmp_path, jobs=0)
+
+
+def test_shell_batch(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    monkeypatch.delenv("HISTORY", raising=False)  # Like from cron
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    for i in range(3):
+        (logs / f"job{i}.log").write_text(f"job {i} failed\n")
+    with FakeModelServer(tokens=3, latency=0.3) as server:
+        start = time.perf_counter()
+        assert shell(["--path", str(tmp_path), "--batch", str(logs), "--jobs", "3", "-e", server.url]) == 0
+        assert time.perf_counter() - start < 0.8  # At the same time
+    captured = capsys.readouterr()
+    records = [json.loads(line) for line in captured.out.splitlines() if line.startswith("{")]
+    assert sorted(record["input"] for record in records) == ["job0.log", "job1.log", "job2.log"]
+    assert all(record["answer"] == "word0 word1 word2 " and record["tokens"] == 3 for record in records)
+    assert "Batch: 3 inputs, 0 failed, 0 from the cache" in captured.err and "3 at most" in captured.err
+    with FakeModelServer(tokens=3) as server:
+        assert shell(["--path", str(tmp_path), "--batch", str(logs), "-e", server.url]) == 0
+        assert not server.requests  # Answered from the cache
+    assert "3 from the cache" in capsys.readouterr().err
+
+    api = MockContextApi(reject_context=True)
+    monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: api)
+    (tmp_path / "commands.txt").write_text("first\nsecond\n")
+    assert shell(["--path", str(tmp_path), "--batch", "commands.txt", "--batch-output", "answers", "--record",
+                  "--new-session", "--no-cache"], cwd=tmp_path) == 0
+    assert sorted(path.name for path in (tmp_path / "answers").iterdir()) == ["1.txt", "2.txt", "report.jsonl"]
+    assert (tmp_path / "answers" / "1.txt").read_text().startswith("response ")
+    assert "answer" not in json.loads((tmp_path / "answers" / "report.jsonl").read_text().splitlines()[0])
+    session = SessionManager(tmp_path).load_most_recent_session()
+    assert sorted(command.command for command in session.commands) == ["first", "second"]
+    assert all(command.ai_response.startswith("response ") and command.model == "mock" for command in session.commands)
+
+    with FakeModelServer(status=400) as server:
+        monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: make_backend("ollama", endpoint=server.url))
+        assert shell(["--path", str(tmp_path), "--batch", "commands.txt", "--no-cache"], cwd=tmp_path) == 1
+    assert "2 failed" in capsys.readouterr().err
+    with pytest.raises(argparse.ArgumentTypeError):
+        shell(["--path", str(tmp_path), "--batch", "missing.txt"], cwd=tmp_path)
+
+
+def test_follow_window() -> None:
+    triggers = FollowTriggers(lines=5, idle=10)
+    window = FollowWindow(4)
+    assert window.due(triggers, 0) is None and window.trigger(triggers, 0) is None
+    window.add("building\n", 1)
+    assert window.due(triggers, 2) == 9 and window.trigger(triggers, 2) is None
+    assert window.trigger(triggers, 11) == "no new lines for 10 s"
+    window.add("error: missing ;\n", 3, error=True)
+    assert window.due(triggers, 3) == ERROR_SETTLE and window.trigger(triggers, 3) is None
+    window.add("  at line 3\n", 3.5)
+    assert window.trigger(triggers, 3.5 + ERROR_SETTLE) == "1 new error line"
+    command = window.take("make", "1 new error line")
+    assert command.command == f"make  # {abbreviation}: 1 new error line"
+    assert command.stdin == "building\nerror: missing ;\n  at line 3\n" and window.trigger(triggers, 100) is None
+    for i in range(5):
+        window.add(f"line {i}\n", 20)
+    assert window.trigger(triggers, 20) == "5 new lines"
+    command = window.take("make", "5 new lines")
+    assert command.stdin_omitted == 4 and "4 earlier lines were left out" in command.stdin
+    assert command.stdin.endswith("line 1\nline 2\nline 3\nline 4\n")
+    window.add("line 5\n", 21)
+    assert "the 1 lines since the last answer follow.]\nline 5\n" in window.take("make", "").stdin
+
+
+def test_shell_follow(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
+    monkeypatch.setenv("HISTORY", "1  tail -f build.log | kj --follow")
+    monkeypatch.setattr("follow.ERROR_SETTLE", 0.1)
+    api = MockContextApi()
+    answered = threading.Event()
+
+    def slow_api(prompt: str, context: list[int] | None = None) -> Generator[str | list[int], None, None]:
+        time.sleep(0.3)
+        yield from api(prompt, context)
+        answered.set()
+    slow_api.model = "mock"  # type: ignore[attr-defined]
+    monkeypatch.setattr("shell.make_backend", lambda *args, **kwargs: slow_api)
+    read_fd, write_fd = os.pipe()
+
+    def produce() -> None:
+        with os.fdopen(write_fd, "w") as pipe:
+            pipe.write("compiling\nERROR: disk full\n")
+            pipe.flush()
+            time.sleep(0.2)
+            # These arrive while the first answer is generated, and lead to one more query after it.
+            for i in range(6):
+                pipe.write(f"retry {i} failed\n")
+                pipe.flush()
+                time.sleep(0.02)
+            answered.wait(5)
+            time.sleep(0.6)  # For the second answer
+            pipe.write("done\n")
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    with os.fdopen(read_fd) as stdin:
+        assert shell(["--path", str(tmp_path), "--follow", "--follow-idle", "0", "--no-cache"], stdin=stdin) == 0
+    producer.join()
+    out = capsys.readouterr().out
+    assert "ERROR: disk full" in out and f"[{abbreviation}: 1 new error line]" in out
+    session = SessionManager(tmp_path).load_most_recent_session()
+    assert [command.command.split("# ")[-1] for command in session.commands] == \
+           [f"{abbreviation}: 1 new error line", f"{abbreviation}: 6 new error lines", f"{abbreviation}: the input ended"]
+    assert len(api.calls) == 3
+    assert session.commands[0].stdin == "compiling\nERROR: disk full\n"
+    assert "since the last answer follow.]\ndone\n" in session.commands[2].stdin
+    with pytest.raises(argparse.ArgumentTypeError):
+        shell(["--path", str(tmp_path), "--follow", "--follow-pattern", "("], stdin=io.StringIO(""))
+
+
 def test_shell_new_session(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str], tmp_path: Path) -> None:
     session_manager = SessionManager(tmp_path)
     flag = "This is the new session test"
@@ -194,7 +1383,211 @@ def test_shell_new_session(monkeypatch: pytest.MonkeyPatch, capsys: pytest.Captu
     assert shell(["--listen", "--path", str(tmp_path), "--new-session"]) == 0
     captured = capsys.readouterr()
     assert captured.out.strip() == welcome_message(1)
-    assert sum(1 for f in tmp_path.iterdir() if f.is_file()) == 2
+    assert len(session_manager.get_session_files()) == 2
+
+
+def test_capture_stdin_window(tmp_path: Path) -> None:
+    stream = io.StringIO("".join(f"line {i}\n" for i in range(1000)))
+    echo = io.StringIO()
+    capture = capture_stdin(stream, echo=echo, head_lines=3, tail_lines=2, spill_path=tmp_path / "spill.log")
+    assert echo.getvalue() == stream.getvalue()
+    assert (tmp_path / "spill.log").read_text() == stream.getvalue()
+    assert capture.lines == 1000 and capture.bytes == len(stream.getvalue())
+    assert capture.omitted_lines == 995 and capture.truncated
+    lines = capture.text.splitlines()
+    assert lines[:3] == ["line 0", "line 1", "line 2"] and lines[-2:] == ["line 998", "line 999"]
+    assert "995 of 1000 lines" in lines[3] and str(tmp_path / "spill.log") in lines[3]
+
+    capture = capture_stdin(io.StringIO("short\ninput"), head_lines=3, tail_lines=2)
+    assert capture.text == "short\ninput" and not capture.truncated
+
+
+def test_capture_stdin_long_lines() -> None:
+    lines = list(split_lines(["a" * 3000, "b" * 3000, "\nshort\n", "end"], max_line_length=100))
+    assert lines == ["a" * 100 + " [kj: 5900 more characters]\n", "short\n", "end"]
+
+
+def test_capture_stdin_from_pipe() -> None:
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, "first\nsecond ä\n".encode())
+    os.close(write_fd)
+    with open(read_fd, encoding="utf-8") as stream:
+        capture = capture_stdin(stream)
+    assert capture.text == "first\nsecond ä\n" and capture.bytes == len("first\nsecond ä\n".encode())
+
+
+def test_shell_truncated_stdin(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("HISTORY", f"307  seq 1000 | {abbreviation} --listen")
+    monkeypatch.setattr("sys.stdin", io.StringIO("".join(f"{i}\n" for i in range(1000))))
+    assert shell(["--listen", "--path", str(tmp_path), "--stdin-head", "5", "--stdin-tail", "5", "--spill-stdin",
+                  "--raw-stdin"]) == 0
+    command = SessionManager(tmp_path).load_most_recent_session().commands[-1]
+    assert command.stdin_omitted == 990
+    assert command.stdin_spill is not None and Path(command.stdin_spill).read_text().count("\n") == 1000
+    assert len(command.stdin.splitlines()) == 11
+
+
+def test_compact_lines() -> None:
+    ping = [f"64 bytes from 93.184.216.34: icmp_seq={i} ttl=56 time={10 + i / 10:.1f} ms\n" for i in range(1, 101)]
+    lines = ["\x1b[1;32mPING example.com\x1b[0m\n", *ping[:50], "ping: sendmsg: Network error\n", *ping[50:],
+             "Downloading 10%\rDownloading 50%\rDownloading 100%\n", "done"]
+    compactor = LogCompactor()
+    assert list(compact_lines(lines, compactor)) == [
+        "PING example.com\n",
+        ping[0], "[kj: 48 similar lines]\n", ping[49],
+        "ping: sendmsg: Network error\n",
+        ping[50], "[kj: 48 similar lines]\n", ping[99],
+        "Downloading 100%\n",
+        "done",
+    ]
+    assert compactor.stats.lines_in == len(lines) and compactor.stats.lines_out == 10
+    assert compactor.stats.ratio > 10
+
+
+def test_capture_stdin_progress_bar() -> None:
+    chunks = ["building\r\n", "[#   ] 10%\r[##  ] 50%\r", "[####] 100%\r", "\nok\r", "\n"]
+    assert list(split_lines(chunks, overwrite_carriage_returns=True)) == ["building\r\n", "[####] 100%\r\n", "ok\r\n"]
+    assert list(split_lines(["a\rb\n"])) == ["a\rb\n"]
+    capture = capture_stdin(io.StringIO("\n".join(["step 1", "step 2", "step 3", "step 4", "Error: step 5"])), compact=True)
+    assert capture.text == "step 1\n[kj: 2 similar lines]\nstep 4\nError: step 5"
+    assert capture.compaction is not None and "Compacted stdin from 5 lines" in capture.report()
+
+
+def test_daemon(tmp_path: Path) -> None:
+    socket_path = tmp_path / "kj.sock"
+    daemon = KjDaemon(socket_path, idle_timeout=60)
+    thread = threading.Thread(target=daemon.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+
+    def run(argv: list[str], stdin: bytes, history: str) -> tuple[int, str, str]:
+        for _ in range(500):
+            sock = connect(socket_path)
+            if sock is not None:
+                break
+            time.sleep(0.01)
+        assert sock is not None
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, stdin)
+        os.close(write_fd)
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        try:
+            code = run_remote(sock, argv, history, stdin_fd=read_fd, stdout=stdout, stderr=stderr)
+        finally:
+            os.close(read_fd)
+        return code, stdout.getvalue().decode(), stderr.getvalue().decode()
+
+    try:
+        code, out, _ = run(["--listen", "--path", str(tmp_path)], b"<piped output>\n", f"309  ls | {abbreviation} --listen")
+        assert code == 0
+        assert welcome_message(0) in out and "<piped output>" in out
+        code, out, _ = run(["--listen", "--path", str(tmp_path)], b"", f"310  ls | {abbreviation} --listen")
+        assert code == 0 and welcome_message(0) in out
+        session_manager = daemon.session_managers[tmp_path]
+        assert [command.stdin for command in session_manager.load(0).commands] == ["<piped output>\n", ""]
+
+        code, out, _ = run(["--help"], b"", f"311  {abbreviation} --help")
+        assert code == 0 and f"usage: {abbreviation}" in out
+        code, _, err = run(["--no-such-option"], b"", f"312  {abbreviation} --no-such-option")
+        assert code == 2 and "unrecognized arguments" in err
+        # Not the history of the daemon's own environment
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setenv("HISTORY", f"312  {abbreviation} --listen")
+            code, _, err = run(["--path", str(tmp_path)], b"", "")
+        assert code == 1 and "Command history is not available" in err
+        code, _, err = run(["--path", str(tmp_path), "-s"], b"", f"313  {abbreviation} -s")
+        assert code == 1 and "picking a session needs a terminal" in err
+
+        # A second daemon for the same socket exits right away
+        KjDaemon(socket_path).serve_forever()
+        assert thread.is_alive()
+    finally:
+        daemon.stop()
+        thread.join()
+    assert not socket_path.exists()
+
+
+def test_daemon_starts_without_history(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    started: list[dict[str, Any]] = []
+    monkeypatch.setattr("subprocess.Popen", lambda args, **kwargs: started.append(kwargs))
+    monkeypatch.setattr("kj_client.AUTOSTART_TIMEOUT", 0.05)
+    monkeypatch.setenv("HISTORY", f"314  {abbreviation} --listen")
+    assert kj_client.start_daemon(tmp_path / "kj.sock") is None
+    assert "HISTORY" not in started[0]["env"] and "PATH" in started[0]["env"]
+
+
+def test_daemon_idle_timeout(tmp_path: Path) -> None:
+    daemon = KjDaemon(tmp_path / "kj.sock", idle_timeout=0.05)
+    started = time.monotonic()
+    daemon.serve_forever(poll_interval=0.01)
+    assert time.monotonic() - started < 5
+
+
+def test_client_falls_back_to_shell(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("KJ_DAEMON_SOCKET", str(tmp_path / "missing.sock"))
+    monkeypatch.setattr("kj_client.start_daemon", lambda socket_path: None)
+    monkeypatch.setenv("HISTORY", f"313  {abbreviation} --listen")
+    monkeypatch.setattr("sys.stdin", io.StringIO("<user request>\n"))
+    assert kj_client.main(["--listen", "--path", str(tmp_path)]) == 0
+    assert SessionManager(tmp_path).load(0).commands[0].stdin == "<user request>\n"
+
+
+@pytest.mark.parametrize("argv, picks", [
+    (["-s"], True), (["--switch-session", "--listen"], True), (["--switch"], True), (["-ns"], True),
+    (["-s", "3"], False), (["--switch-session=3"], False), (["--search", "s"], False), (["--", "-s"], False),
+    (["--listen"], False),
+])
+def test_client_picks_session_without_daemon(argv: list[str], picks: bool) -> None:
+    assert kj_client.picks_session(argv) == picks
+
+
+def test_parse_last_command() -> None:
+    assert parse_last_command("301  ls -la\n302  git status | kj\n") == (302, "git status | kj")
+    assert parse_last_command(f"303  {abbreviation}") == (303, abbreviation)
+    with pytest.raises(EnvironmentError):
+        parse_last_command("301  ls\ngit status | kj")
+
+
+def test_default_prompt_is_cached(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    prompt = default_prompt(tmp_path)
+    # The usage of the options, without the whole help text, which would take thousands of tokens
+    assert f"usage: {abbreviation} [-h]" in prompt and "--batch-output DIR" in prompt
+    assert "show this help message" not in prompt and estimate_tokens(prompt) < 600
+    cache_path, = tmp_path.glob(".systemprompt.*.txt")
+    assert cache_path.read_text(encoding="utf-8") == prompt == default_prompt()
+    cache_path.write_text("cached prompt", encoding="utf-8")
+    assert default_prompt(tmp_path) == "cached prompt"
+    session = SessionManager(tmp_path).create_new_session()
+    assert build_prompt(session).text.startswith("cached prompt")
+    # A change to the usage, like a new option, is a new prompt.
+    monkeypatch.setattr("prompts.PROMPT_SOURCES", ("prompts.py", "cli.py", "config.py", "abbreviation.py", "shell.py"))
+    prompt_source_hash.cache_clear()
+    try:
+        assert default_prompt(tmp_path) == prompt
+    finally:
+        prompt_source_hash.cache_clear()
+
+
+# Modules that take long to import, and that only some invocations need
+HEAVY_MODULES = {"shell": ("requests", "urllib3", "numpy", "sqlite3", "asyncio", "subprocess", "orjson"),
+                 "kj_client": ("requests", "urllib3", "numpy", "sqlite3", "asyncio", "subprocess", "shell", "argparse")}
+
+
+@pytest.mark.parametrize("module", HEAVY_MODULES.keys())
+def test_startup_imports(module: str) -> None:
+    script = f"import sys, {module}\nprint(' '.join(sorted(set({HEAVY_MODULES[module]!r}) & set(sys.modules))))"
+    result = subprocess.run([sys.executable, "-c", script], cwd=Path(__file__).parent, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip() == ""
+
+
+def test_listen_does_not_import_requests(tmp_path: Path) -> None:
+    script = "import io, sys, shell\n" \
+             "sys.stdin = io.StringIO('<user request>')\n" \
+             f"shell.shell(['--listen', '--path', {str(tmp_path)!r}])\n" \
+             "print('requests' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", script], cwd=Path(__file__).parent, capture_output=True, text=True,
+                            env={**os.environ, "HISTORY": f"314  {abbreviation} --listen"}, check=True)
+    assert result.stdout.strip().endswith("False")
 
 
 def test_missing_history(monkeypatch: pytest.MonkeyPatch) -> None:
@@ -255,7 +1648,7 @@ def test_shell_all_options_have_help() -> None:
     assert not missing_help, f"Missing help for options: {missing_help}"
 
 def test_keyboard_interupt(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
-    monkeypatch.setattr("shell.read_stdin", lambda forward_input: (_ for _ in ()).throw(KeyboardInterrupt()))
+    monkeypatch.setattr("shell.read_stdin", lambda forward_input, **kwargs: (_ for _ in ()).throw(KeyboardInterrupt()))
     monkeypatch.setenv("HISTORY", f"306  {abbreviation} --listen")
     with pytest.raises(SystemExit):
         shell(["--listen", "--path", str(tmp_path)])
@@ -0,0 +1,128 @@
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+NANOSECONDS = 1e9
+# A model that took longer than this to load wasn't loaded yet when the request arrived.
+COLD_LOAD = 0.25
+
+
+def format_duration(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+
+def server_summary(stats: dict[str, int]) -> str:
+    """Describes the statistics Ollama sends with the last chunk of an answer."""
+    parts = []
+    if "load_duration" in stats:
+        parts.append(f"model load {format_duration(stats['load_duration'] / NANOSECONDS)}")
+    for name, label in (("prompt_eval", "prompt"), ("eval", "answer")):
+        if f"{name}_count" not in stats:
+            continue
+        count, duration = stats[f"{name}_count"], stats.get(f"{name}_duration", 0) / NANOSECONDS
+        part = f"{label} {count} tokens"
+        if duration:
+            part += f" in {format_duration(duration)} ({count / duration:.1f} tokens/s)"
+        parts.append(part)
+    if "total_duration" in stats:
+        parts.append(f"total {format_duration(stats['total_duration'] / NANOSECONDS)}")
+    return ", ".join(parts)
+
+
+class Timings:
+    """Where the time of one kj invocation went: spans measured here, like reading stdin or waiting for the first
+    token, and the statistics the model server sends with the answer."""
+    spans: dict[str, float]
+    server: dict[str, int]
+    # Other numbers worth keeping with the timings, like the size of the prompt
+    info: dict[str, Any]
+    chunks: int
+    start: float
+    _request_start: float | None
+    _first_chunk: float | None
+    _last_chunk: float | None
+
+    def __init__(self, start: float | None = None):
+        self.spans = {}
+        self.server = {}
+        self.info = {}
+        self.chunks = 0
+        self.start = time.perf_counter() if start is None else start
+        self._request_start = self._first_chunk = self._last_chunk = None
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    def request_started(self) -> None:
+        self._request_start = time.perf_counter()
+        self._first_chunk = self._last_chunk = None
+        self.chunks = 0
+
+    def chunk_received(self) -> None:
+        now = time.perf_counter()
+        if self._first_chunk is None and self._request_start is not None:
+            self._first_chunk = now
+            self.spans["first token"] = now - self._request_start
+        self._last_chunk = now
+        self.chunks += 1
+
+    def request_finished(self) -> None:
+        if self._first_chunk is not None and self._last_chunk is not None:
+            self.spans["generation"] = self._last_chunk - self._first_chunk
+
+    def first_token(self) -> float | None:
+        """Seconds from sending the last request to its first chunk, if it sent one."""
+        if self._first_chunk is None or self._request_start is None:
+            return None
+        return self._first_chunk - self._request_start
+
+    def cold_start(self) -> bool | None:
+        """Whether the server had to load the model first, if it said how long loading took."""
+        if "load_duration" not in self.server:
+            return None
+        return self.server["load_duration"] / NANOSECONDS >= COLD_LOAD
+
+    def tokens_per_second(self) -> float | None:
+        """The speed of the answer, as the server measured it, or else from the chunks received."""
+        if self.server.get("eval_count") and self.server.get("eval_duration"):
+            return self.server["eval_count"] / (self.server["eval_duration"] / NANOSECONDS)
+        generation = self.spans.get("generation")
+        return self.chunks / generation if generation and self.chunks > 1 else None
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def summary(self) -> str:
+        parts = []
+        for name, seconds in self.spans.items():
+            part = f"{name} {format_duration(seconds)}"
+            if name == "generation" and seconds > 0:
+                part += f" ({self.chunks} chunks, {self.chunks / seconds:.1f}/s)"
+            if name == "first token" and (cold := self.cold_start()) is not None:
+                load = self.server["load_duration"] / NANOSECONDS
+                part += f" (cold: {format_duration(load)} loading the model, {format_duration(max(0.0, seconds - load))} " \
+                        f"warm)" if cold else " (warm)"
+            parts.append(part)
+        summary = f"Timings: {', '.join(parts + [f'total {format_duration(self.total)}'])}"
+        if self.server:
+            summary += f"\nServer: {server_summary(self.server)}"
+        return summary
+
+    def record(self, **fields: Any) -> dict[str, Any]:
+        return {"time": time.time(), **fields, **self.info, "total": self.total, "spans": self.spans,
+                "chunks": self.chunks, "server": self.server, "cold_start": self.cold_start()}
+
+    @staticmethod
+    def append(path: Path, record: dict[str, Any]) -> None:
+        """Appends a record to a JSON lines metrics file."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")